@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+import os
+import uuid
+
+
+class AtomicOutput(object):
+
+    def __init__(self, output_file, allow_existing=False):
+        """
+            Transactional output of a processing step
+
+            The tool writes to a temporary name in the same directory as output_file ('.tmp-<id>-<name>'),
+            and only when the step finished without an exception the temporary files are renamed to their
+            final names. A rename inside a directory is atomic, so output_file is either complete or missing,
+            even if the process is killed in the middle - without copying the input before the step.
+
+            Every file in the directory that starts with the temporary prefix is renamed, so side outputs of
+            the tool (e.g. the MCFLIRT .par file or the FAST _bias image) are committed as well.
+            output_file itself is renamed last, as the stages use it to check that they were performed.
+
+            When the tool didn't write the temporary output_file the step fails, even if an older output_file
+            exists - it isn't the output of this step.
+
+            Usage
+                with AtomicOutput(out_file) as output:
+                    tool.inputs.out_file = output.temp()
+                    tool.run()
+
+            Parameters
+                allow_existing = an existing output_file is kept when the tool didn't write a new one
+                                 (for tools that may skip writing an up to date output)
+        """
+        self._output_file = os.path.abspath(output_file)
+        self._allow_existing = allow_existing
+        self._directory = os.path.dirname(self._output_file)
+        self._prefix = '.tmp-{}-'.format(uuid.uuid4().hex[:8])
+
+    def temp(self, path=None):
+        """
+            Returns the temporary name of path (default: the output file)
+
+            path can also be a basename for tools that derive their output names from it (FAST)
+        """
+        path = os.path.abspath(path or self._output_file)
+        if os.path.dirname(path) != self._directory:
+            raise ValueError("{} isn't in the output directory {}".format(path, self._directory))
+
+        return os.path.join(self._directory, self._prefix + os.path.basename(path))
+
+    def temp_files(self):
+        return sorted(os.path.join(self._directory, name) for name in os.listdir(self._directory)
+                      if name.startswith(self._prefix))
+
+    def commit(self):
+        main_file = self.temp()
+        if not os.path.exists(main_file) and not (self._allow_existing and os.path.exists(self._output_file)):
+            self.rollback()
+            raise IOError("{} wasn't created".format(self._output_file))
+
+        for temp_file in self.temp_files():
+            if temp_file != main_file:
+                os.rename(temp_file, temp_file.replace(self._prefix, '', 1))
+
+        if os.path.exists(main_file):
+            os.rename(main_file, self._output_file)
+
+    def rollback(self):
+        for temp_file in self.temp_files():
+            os.remove(temp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
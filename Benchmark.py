@@ -0,0 +1,457 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import nibabel
+import numpy as np
+from OpenFMRIData import OpenFMRIData
+from QualityAnalyzer import QualityAnalyzer
+import MotionMetrics
+from NeighborhoodIndex import NeighborhoodIndex, NeighborhoodQueryEngine
+from FastSearchlight import FastSearchlight
+
+
+CONDITIONS = ['G1', 'G2', 'G3', 'G4']
+
+
+class SyntheticStudy(object):
+
+    def __init__(self, data_dir, study_name='SYNTH', subjects=2, runs=2, shape=(32, 32, 24), volumes=120, tr=2.0,
+                 trials=6, seed=0):
+        """
+            A synthetic study in the openfmri structure, as it is after the preprocessing (no FSL needed)
+
+            Every subject has
+                anatomy/highres001.nii.gz
+                BOLD/task001_runxxx/bold_mcf.nii.gz = 4D float32 run: an ellipsoid brain with drifts, noise and
+                                                      a condition-specific response in a blob, and background
+                                                      noise outside it (bold.nii.gz links to it)
+                BOLD/task001_runxxx/bold_mcf.nii.gz.par = MCFLIRT-like random walk motion parameters
+                masks/task001_runxxx/gray.nii.gz, non_brain.nii.gz
+                behav/task001_runxxx/behavdata.txt = Onset, Stimulus (G1-G4), Response
+            and the study has task_order.txt, task_mapping.txt, task_key.txt and mapping_subject.json.
+
+            Parameters
+                data_dir = the study is created in data_dir/study_name
+                subjects, runs = number of subjects / runs of task001 of every subject
+                shape = size of the volumes in voxels (3mm isotropic)
+                volumes = number of volumes of every run
+                tr = TR in seconds
+                trials = trials of every condition in every run
+                seed = seed of the random generator, the same arguments always give the same study
+        """
+        self._data_dir = data_dir
+        self._study_name = study_name
+        self._subjects = subjects
+        self._runs = runs
+        self._shape = tuple(shape)
+        self._volumes = volumes
+        self._tr = tr
+        self._trials = trials
+        self._seed = seed
+
+    def config(self):
+        return {'subjects': self._subjects, 'runs': self._runs, 'shape': list(self._shape),
+                'volumes': self._volumes, 'tr': self._tr, 'trials': self._trials, 'seed': self._seed}
+
+    def study_dir(self):
+        return os.path.join(self._data_dir, self._study_name)
+
+    def run_names(self):
+        return ['task001_run{:0>3d}'.format(run) for run in range(1, self._runs + 1)]
+
+    def subject_codes(self):
+        return range(1, self._subjects + 1)
+
+    def fmri_data(self):
+        return OpenFMRIData(self._data_dir, os.path.join(self._data_dir, 'raw'), self._study_name)
+
+    def create(self):
+        """
+            Writes the study (an existing directory is replaced)
+        """
+        if os.path.isdir(self.study_dir()):
+            shutil.rmtree(self.study_dir())
+        os.makedirs(self.study_dir())
+
+        self.__write_metadata__()
+
+        rng = np.random.RandomState(self._seed)
+        brain_mask, nonbrain_mask, blob = self.masks()
+        for subcode in self.subject_codes():
+            self.__create_subject__(rng, subcode, brain_mask, nonbrain_mask, blob)
+
+    def masks(self):
+        """
+            (brain, non brain, responding blob) boolean masks of the volumes
+        """
+        grid = np.meshgrid(*[np.linspace(-1, 1, size) for size in self._shape], indexing='ij')
+        radius = np.sqrt(sum((axis / 0.75) ** 2 for axis in grid))
+
+        blob_center = [0.3, 0.0, 0.0]
+        blob_radius = np.sqrt(sum((axis - center) ** 2 for axis, center in zip(grid, blob_center)))
+
+        return radius <= 1, radius >= 1.15, (blob_radius <= 0.25) & (radius <= 1)
+
+    def events(self, rng):
+        """
+            Trials of a run: list of (onset in seconds, condition, response), the conditions in random order
+        """
+        conditions = [condition for condition in CONDITIONS for _ in range(self._trials)]
+        rng.shuffle(conditions)
+
+        spacing = self._volumes * self._tr / (len(conditions) + 1)
+        return [(round(spacing * (index + 1), 1), condition, rng.randint(1, 3))
+                for index, condition in enumerate(conditions)]
+
+    def betas(self, subcode=1):
+        """
+            A synthetic GLM dataset (one pattern per trial) of a subject, the input of the searchlight
+
+            Returns
+                (samples x voxels) float32 matrix, conditions, chunks (run index) and the (voxels x 3) indices
+                of the brain voxels
+        """
+        rng = np.random.RandomState(self._seed + subcode)
+        brain_mask, _, blob = self.masks()
+        in_blob = blob[brain_mask]
+
+        patterns = dict((condition, rng.normal(0, 0.5, in_blob.sum())) for condition in CONDITIONS)
+        conditions = [condition for _ in range(self._runs) for condition in CONDITIONS for _ in range(self._trials)]
+        chunks = [run for run in range(self._runs) for _ in range(len(CONDITIONS) * self._trials)]
+
+        samples = rng.normal(0, 1, (len(conditions), brain_mask.sum())).astype(np.float32)
+        for index, condition in enumerate(conditions):
+            samples[index, in_blob] += patterns[condition]
+
+        return samples, np.array(conditions), np.array(chunks), np.column_stack(np.nonzero(brain_mask))
+
+    def __write_metadata__(self):
+        study_dir = self.study_dir()
+
+        with open(os.path.join(study_dir, 'task_order.txt'), 'w') as fh:
+            fh.write('\n'.join(self.run_names()) + '\n')
+        with open(os.path.join(study_dir, 'task_mapping.txt'), 'w') as fh:
+            fh.write(''.join('MVPA_run{}\t{}\n'.format(index + 1, name) for index, name in enumerate(self.run_names())))
+        with open(os.path.join(study_dir, 'task_key.txt'), 'w') as fh:
+            fh.write('task001\tsynthetic\n')
+        with open(os.path.join(study_dir, 'mapping_subject.json'), 'w') as fh:
+            json.dump(dict(('SYN{:0>3d}'.format(subcode), subcode) for subcode in self.subject_codes()), fh)
+
+    def __create_subject__(self, rng, subcode, brain_mask, nonbrain_mask, blob):
+        subject_dir = os.path.join(self.study_dir(), 'sub{:0>3d}'.format(subcode))
+        affine = np.diag([3.0, 3.0, 3.0, 1.0])
+
+        for directory in ['anatomy', os.path.join('masks', 'anatomy')]:
+            os.makedirs(os.path.join(subject_dir, directory))
+
+        # brightness of the brain varies smoothly in space, as the coil sensitivity does
+        grid = np.meshgrid(*[np.linspace(-1, 1, size) for size in self._shape], indexing='ij')
+        baseline = (800 + 150 * grid[0] + 50 * grid[1] ** 2) * brain_mask
+        nibabel.save(nibabel.Nifti1Image(baseline.astype(np.float32), affine),
+                     os.path.join(subject_dir, 'anatomy', 'highres001.nii.gz'))
+
+        for run_name in self.run_names():
+            run_dirs = dict((name, os.path.join(subject_dir, name, run_name)) for name in ['BOLD', 'masks', 'behav'])
+            run_dirs.update(('model{:0>3d}'.format(model),
+                             os.path.join(subject_dir, 'model', 'model{:0>3d}'.format(model), 'onsets', run_name))
+                            for model in range(1, 4))
+            for directory in run_dirs.values():
+                os.makedirs(directory)
+
+            events = self.events(rng)
+            with open(os.path.join(run_dirs['behav'], 'behavdata.txt'), 'w') as fh:
+                fh.write('Onset\tStimulus\tResponse\n')
+                fh.write(''.join('{}\t{}\t{}\n'.format(*event) for event in events))
+
+            bold = self.__bold__(rng, baseline, brain_mask, blob, events)
+            img = nibabel.Nifti1Image(bold, affine)
+            img.header.set_zooms((3.0, 3.0, 3.0, self._tr))
+            img.header.set_xyzt_units('mm', 'sec')
+            nibabel.save(img, os.path.join(run_dirs['BOLD'], 'bold_mcf.nii.gz'))
+            os.symlink('bold_mcf.nii.gz', os.path.join(run_dirs['BOLD'], 'bold.nii.gz'))
+
+            np.savetxt(os.path.join(run_dirs['BOLD'], 'bold_mcf.nii.gz.par'), self.__motion__(rng), fmt='%.6f')
+
+            for name, mask in [('gray', brain_mask), ('non_brain', nonbrain_mask)]:
+                nibabel.save(nibabel.Nifti1Image(mask.astype(np.uint8), affine),
+                             os.path.join(run_dirs['masks'], name + '.nii.gz'))
+
+    def __bold__(self, rng, baseline, brain_mask, blob, events):
+        """
+            4D float32 run: baseline with a linear drift, 1% noise, a 2% response of the blob to G1 / G4 during
+            the 2 volumes after their onsets, and background (non brain) noise
+        """
+        volumes = self._volumes
+        drift = 1 + 0.02 * np.linspace(0, 1, volumes, dtype=np.float32)
+
+        response = np.zeros(volumes, dtype=np.float32)
+        for onset, condition, _ in events:
+            if condition in ['G1', 'G4']:
+                start = int(onset / self._tr)
+                response[start:start + 2] = 0.02
+
+        bold = np.empty(self._shape + (volumes,), dtype=np.float32)
+        for volume in range(volumes):
+            noise = rng.normal(0, 1, self._shape).astype(np.float32)
+            bold[..., volume] = baseline * (drift[volume] + 0.01 * noise + response[volume] * blob) + \
+                                np.abs(20 * noise) * ~brain_mask
+        return bold
+
+    def __motion__(self, rng):
+        """
+            (volumes x 6) random walk of rotations (radians) and translations (mm) with a few spikes
+        """
+        steps = np.hstack([rng.normal(0, 0.0005, (self._volumes, 3)), rng.normal(0, 0.02, (self._volumes, 3))])
+        spikes = rng.randint(1, self._volumes, 3)
+        steps[spikes, 3:] += rng.normal(0, 0.5, (len(spikes), 3))
+        return np.cumsum(steps, axis=0)
+
+
+class Benchmark(object):
+
+    BENCHMARKS = ['qa_metrics', 'qa_stream', 'qa_detrend', 'motion_metrics', 'evs', 'subject_dir', 'neighborhoods',
+                  'fast_correlation', 'fast_gnb', 'fast_lda', 'dataset', 'searchlight']
+
+    def __init__(self, study, repeat=3, searchlight_centers=200, radius=2):
+        """
+            Times the native numeric paths on a SyntheticStudy
+
+                qa_metrics = QualityAnalyzer.run_metrics of every run (whole runs in memory)
+                qa_stream = QualityAnalyzer.stream_run of every run (chunks of volumes, with the detrended maps)
+                qa_detrend = QualityAnalyzer.detrend_run of every run
+                motion_metrics = MotionMetrics.analyze_study (FD, DVARS and scrubbing of all the runs)
+                evs = OpenFMRIData.create_subject_evs of every subject (behavdata.txt to EV files)
+                subject_dir = OpenFMRIData.load_subject_dir of every subject (validation and the directory tree)
+                neighborhoods = NeighborhoodIndex.build of the spheres of all the brain voxels
+                fast_correlation, fast_gnb, fast_lda = FastSearchlight accuracy of all the spheres of the synthetic
+                                                       betas of a subject
+                dataset = mvpa2 datasets of all the runs of a subject, detrended and z-scored as in make_ds
+                searchlight = the cross-validated searchlight of pymvpa2_cv_setup.py on the synthetic betas
+                              of a subject, for searchlight_centers spheres
+
+            dataset and searchlight need PyMVPA2, they are skipped when it isn't installed.
+
+            Parameters
+                study = SyntheticStudy (already created)
+                repeat = times every benchmark is run, the best time is the result
+                searchlight_centers = number of searchlight spheres scored
+                radius = searchlight radius in voxels
+        """
+        self._study = study
+        self._repeat = repeat
+        self._searchlight_centers = searchlight_centers
+        self._radius = radius
+        self._fmri_data = study.fmri_data()
+
+    def run(self, names=None):
+        """
+            Returns
+                dictionary of <benchmark, dictionary of times (seconds), best, mean, items (runs / subjects /
+                spheres timed) and per_item (best / items)> or <benchmark, dictionary of skipped (reason)>
+        """
+        results = dict()
+        for name in names or self.BENCHMARKS:
+            if name not in self.BENCHMARKS:
+                raise ValueError("Unknown benchmark {}".format(name))
+
+            try:
+                function, items = getattr(self, name)()
+            except ImportError as e:
+                results[name] = {'skipped': str(e)}
+                print ">>> {:<20}skipped ({})".format(name, e)
+                continue
+
+            times = []
+            for _ in range(self._repeat):
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+
+            results[name] = {'times': times, 'best': min(times), 'mean': float(np.mean(times)), 'items': items,
+                             'per_item': min(times) / items}
+            print ">>> {:<20}{:>10.3f}s best{:>10.3f}s per item ({} items)".format(
+                name, min(times), min(times) / items, items)
+
+        return results
+
+    # Every benchmark returns (function to time, number of items it processes)
+
+    def qa_metrics(self):
+        analyzer, runs = self.__qa_runs__()
+        return lambda: [analyzer.run_metrics(run['bold'], run['mask'], run['nonbrain']) for run in runs], len(runs)
+
+    def qa_stream(self):
+        analyzer, runs = self.__qa_runs__()
+        return lambda: [analyzer.stream_run(run['bold'], run['mask'], run['nonbrain'], run['qa_dir'])
+                        for run in runs], len(runs)
+
+    def qa_detrend(self):
+        analyzer, runs = self.__qa_runs__()
+        return lambda: [analyzer.detrend_run(run['bold'], run['mask'], run['qa_dir']) for run in runs], len(runs)
+
+    def motion_metrics(self):
+        metrics = MotionMetrics.MotionMetrics()
+        return lambda: metrics.analyze_study(self._study.study_dir()), len(self.__qa_runs__()[1])
+
+    def evs(self):
+        subject_dirs = ['sub{:0>3d}'.format(subcode) for subcode in self._study.subject_codes()]
+        return lambda: [self._fmri_data.create_subject_evs(subject_dir) for subject_dir in subject_dirs], \
+               len(subject_dirs)
+
+    def subject_dir(self):
+        subcodes = self._study.subject_codes()
+        return lambda: [self._fmri_data.load_subject_dir(subcode=subcode) for subcode in subcodes], len(subcodes)
+
+    def neighborhoods(self):
+        voxel_indices = self._study.betas()[3]
+        return lambda: NeighborhoodIndex.build(voxel_indices, self._radius), len(voxel_indices)
+
+    def fast_correlation(self):
+        return self.__fast_searchlight__('correlation')
+
+    def fast_gnb(self):
+        return self.__fast_searchlight__('gnb')
+
+    def fast_lda(self):
+        return self.__fast_searchlight__('lda')
+
+    def dataset(self):
+        from mvpa2.base.dataset import vstack
+        from mvpa2.datasets.mri import fmri_dataset
+        from make_ds import detrend
+
+        _, runs = self.__qa_runs__()
+        runs = [run for run in runs if run['subject'] == 1]
+        volumes = [nibabel.load(run['bold']).shape[3] for run in runs]
+
+        def build():
+            datasets = [fmri_dataset(run['bold'], mask=run['mask'], chunks=[chunk] * volumes[chunk])
+                        for chunk, run in enumerate(runs)]
+            return detrend(vstack(datasets))
+
+        return build, len(runs)
+
+    def searchlight(self):
+        from mvpa2.datasets.base import Dataset
+        from mvpa2.measures.searchlight import Searchlight
+        from pymvpa2_cv_setup import obj as cv
+
+        samples, conditions, chunks, voxel_indices = self._study.betas()
+        ds = Dataset(samples, sa={'condition': conditions, 'targets': conditions, 'chunks': chunks},
+                     fa={'voxel_indices': voxel_indices})
+
+        centers = min(self._searchlight_centers, ds.nfeatures)
+        center_ids = np.linspace(0, ds.nfeatures - 1, centers).astype(int)
+        sl = Searchlight(cv, queryengine=NeighborhoodQueryEngine(self._radius), roi_ids=center_ids, nproc=1)
+        return lambda: sl(ds), centers
+
+    def __fast_searchlight__(self, backend):
+        samples, conditions, chunks, voxel_indices = self._study.betas()
+        index = NeighborhoodIndex.build(voxel_indices, self._radius)
+        searchlight = FastSearchlight(backend)
+        return lambda: searchlight.accuracy(samples, conditions, chunks, index), len(index)
+
+    def __qa_runs__(self):
+        analyzer = QualityAnalyzer(self._fmri_data)
+        return analyzer, [run for subcode in self._study.subject_codes() for run in analyzer.run_files(subcode)]
+
+
+def environment():
+    """
+        The commit and the machine the benchmarks ran on
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def git(*args):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.check_output(['git'] + list(args), cwd=repo_dir, stderr=devnull).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', 'HEAD'),
+            'dirty': bool(status) if status is not None else None,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'nibabel': nibabel.__version__,
+            'cpus': multiprocessing.cpu_count()}
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+        Prints the best time of every benchmark of results next to its time in baseline (both as written by main)
+    """
+    print ">>> {} compared to {}".format((results['environment']['commit'] or '')[:8],
+                                         (baseline['environment']['commit'] or '')[:8])
+    if results['study'] != baseline['study']:
+        print "Warning: the synthetic studies differ {} {}".format(results['study'], baseline['study'])
+
+    for name in sorted(set(results['benchmarks']) & set(baseline['benchmarks'])):
+        current, previous = results['benchmarks'][name], baseline['benchmarks'][name]
+        if 'best' not in current or 'best' not in previous:
+            continue
+        ratio = current['best'] / previous['best'] if previous['best'] > 0 else 1.0
+        flag = 'slower' if ratio > 1 + threshold else 'faster' if ratio < 1 - threshold else ''
+        print "{:<20}{:>10.3f}s ->{:>10.3f}s{:>8.0%} {}".format(name, previous['best'], current['best'], ratio - 1, flag)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the native numeric paths on a synthetic study')
+    parser.add_argument('--output', help='JSON results file (default: benchmark-<commit>.json)')
+    parser.add_argument('--compare', help='JSON results of another commit to compare with')
+    parser.add_argument('--data-dir', help='where the synthetic study is created (default: a temporary directory, '
+                                           'removed afterwards)')
+    parser.add_argument('--benchmarks', nargs='+', choices=Benchmark.BENCHMARKS, help='default: all of them')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--shape', type=int, nargs=3, default=[32, 32, 24])
+    parser.add_argument('--volumes', type=int, default=120)
+    parser.add_argument('--trials', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--centers', type=int, default=200, help='number of searchlight spheres scored')
+    parser.add_argument('--radius', type=int, default=2, help='searchlight radius in voxels')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='benchmark-')
+    study = SyntheticStudy(data_dir, subjects=args.subjects, runs=args.runs, shape=args.shape,
+                           volumes=args.volumes, trials=args.trials, seed=args.seed)
+    try:
+        start = time.time()
+        study.create()
+        print ">>> Synthetic study in {} ({:.1f}s)".format(study.study_dir(), time.time() - start)
+
+        benchmarks = Benchmark(study, args.repeat, args.centers, args.radius).run(args.benchmarks)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    config = study.config()
+    config.update({'repeat': args.repeat, 'centers': args.centers, 'radius': args.radius})
+    results = {'environment': environment(), 'study': config, 'benchmarks': benchmarks}
+
+    output = args.output or 'benchmark-{}.json'.format((results['environment']['commit'] or 'unknown')[:8])
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print ">>> Results written to {}".format(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import time
+import shutil
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from AtomicOutput import AtomicOutput
+
+
+def nifti_ext(output_type):
+    return {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}[output_type]
+
+
+def nifti_file(directory, name, output_type):
+    """
+        Path of the image name (without extension) in directory
+
+        An existing image is returned in whichever format it was written, so a stage finds its input whether
+        it was left uncompressed or was compressed later, otherwise the path in output_type format
+    """
+    ext = nifti_ext(output_type)
+    for candidate in [ext] + [other for other in ['.nii', '.nii.gz'] if other != ext]:
+        path = os.path.join(directory, name + candidate)
+        if os.path.exists(path):
+            return path
+
+    return os.path.join(directory, name + ext)
+
+
+class Compressor(object):
+
+    def __init__(self, n_jobs=None, cache=None, compresslevel=6):
+        """
+            Background compression of uncompressed NIfTI deliverables (.nii -> .nii.gz)
+
+            gzip is single threaded, and every FSL stage that writes NIFTI_GZ spends most of its CPU time on it.
+            When the stages write plain .nii, the final outputs are compressed here while the pipeline
+            goes on with the next stages. zlib releases the GIL, so a thread pool compresses files in parallel.
+
+            Parameters
+                n_jobs = number of files compressed concurrently (None = number of cores)
+                cache = StageCache whose sidecars are moved with the files (so downstream stages stay current)
+                compresslevel = gzip level (6 = the FSL default)
+        """
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._cache = cache
+        self._compresslevel = compresslevel
+        self._pool = None
+        self._pending = []
+        self._timings = []
+        self._lock = threading.Lock()
+
+    def submit(self, nifti_files):
+        """
+            Compresses the .nii files asynchronously, every other file is ignored
+        """
+        for nifti_file in nifti_files:
+            if not nifti_file.endswith('.nii') or not os.path.isfile(nifti_file):
+                continue
+
+            if self._pool is None:
+                self._pool = ThreadPool(self._n_jobs)
+            self._pending.append(self._pool.apply_async(self.__compress__, (nifti_file,)))
+
+    def join(self):
+        """
+            Waits for all the submitted files
+
+            Raises
+                the first compression error, after all the files have finished
+        """
+        if self._pool is None:
+            return
+
+        self._pool.close()
+        try:
+            errors = []
+            for pending in self._pending:
+                try:
+                    pending.get()
+                except Exception as ex:
+                    errors.append(ex)
+            if errors:
+                raise errors[0]
+        finally:
+            self._pool.join()
+            self._pool = None
+            self._pending = []
+
+    def rate(self):
+        """
+            Measured compression rate (uncompressed bytes per second), None before any file was compressed
+        """
+        with self._lock:
+            seconds = sum(elapsed for nifti_file, size, elapsed in self._timings)
+            size = sum(size for nifti_file, size, elapsed in self._timings)
+        return size / seconds if seconds > 0 else None
+
+    def report(self, intermediates):
+        """
+            Prints an estimate of the gzip time the uncompressed intermediates saved
+
+            Only the compression of the deliverables is measured. The time the intermediates would have
+            taken is extrapolated from their size and the measured rate, it isn't a measurement.
+
+            Parameters
+                intermediates = dictionary of <stage name, list of the .nii files the stage wrote>
+
+            Returns
+                dictionary of <stage name, estimated seconds saved>
+        """
+        rate = self.rate()
+        if rate is None:
+            return dict()
+
+        with self._lock:
+            compressed = sum(size for nifti_file, size, elapsed in self._timings)
+            print ">>> Compressed {} deliverables ({:.1f}MB at {:.1f}MB/s)".format(
+                len(self._timings), compressed / 1e6, rate / 1e6)
+
+        print ">>> Estimated gzip time saved (size of the intermediates / measured rate, not measured)"
+        saved = dict()
+        for stage, nifti_files in sorted(intermediates.iteritems()):
+            size = sum(os.path.getsize(nifti_file) for nifti_file in nifti_files
+                       if nifti_file.endswith('.nii') and os.path.isfile(nifti_file))
+            saved[stage] = size / rate
+            print "{:<30}{:>10.1f}MB{:>10.1f}s estimated".format(stage, size / 1e6, saved[stage])
+        print "{:<30}{:>22.1f}s estimated (+ the decompression by the next stage)".format('total',
+                                                                                          sum(saved.values()))
+
+        return saved
+
+    def __compress__(self, nifti_file):
+        start = time.time()
+        size = os.path.getsize(nifti_file)
+
+        with AtomicOutput(nifti_file + '.gz') as output:
+            with open(nifti_file, 'rb') as src:
+                dst = gzip.open(output.temp(), 'wb', self._compresslevel)
+                try:
+                    shutil.copyfileobj(src, dst, 1 << 24)
+                finally:
+                    dst.close()
+
+        if self._cache is not None:
+            self._cache.relocate(nifti_file, nifti_file + '.gz')
+        os.remove(nifti_file)
+
+        with self._lock:
+            self._timings.append((nifti_file, size, time.time() - start))
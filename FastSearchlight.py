@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+import numpy as np
+from scipy import sparse
+from KernelCV import nfold_splits
+
+
+class FastSearchlight(object):
+
+    BACKENDS = ['correlation', 'gnb', 'lda']
+
+    def __init__(self, backend='correlation', shrinkage=None, batch_size=2000):
+        """
+            Cross validated accuracy of closed-form classifiers, for all the spheres at once
+
+            Instead of training a classifier per sphere, the classifiers are computed for all the spheres of a
+            fold together: the per-voxel statistics (class means, variances, products with the test samples)
+            are summed over every sphere by a single sparse product with the sphere membership matrix of the
+            NeighborhoodIndex, and the LDA covariances are solved as stacked batches of spheres of equal size.
+            The folds are leave-one-chunk-out and the score is the mean accuracy over the folds, as in
+            pymvpa2_cv_setup.py.
+
+            Backends
+                correlation = nearest class centroid by correlation distance
+                gnb = Gaussian naive Bayes (per class variances, class frequency priors)
+                lda = linear discriminant with the pooled within-class covariance shrunk towards a scaled
+                      identity (Ledoit-Wolf shrinkage unless given)
+
+            Parameters
+                backend = 'correlation', 'gnb' or 'lda'
+                shrinkage = LDA shrinkage in [0, 1] (None = Ledoit-Wolf)
+                batch_size = number of LDA spheres solved together
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown searchlight backend {}".format(backend))
+
+        self._backend = backend
+        self._shrinkage = shrinkage
+        self._batch_size = batch_size
+
+    def accuracy(self, samples, labels, chunks, index, centers=None):
+        """
+            Parameters
+                samples = (samples x features) matrix
+                labels, chunks = sample labels (condition) and chunks
+                index = NeighborhoodIndex of the features
+                centers = feature ids of the spheres scored (None = all of them)
+
+            Returns
+                float32 array of the mean accuracy of every sphere
+        """
+        return self.scores(samples, [labels], chunks, index, centers)[0]
+
+    def scores(self, samples, labels, chunks, index, centers=None):
+        """
+            Parameters
+                labels = list of label arrays (e.g. the original labels and their permutations)
+
+            Returns
+                (label arrays x spheres) float32 matrix of the mean accuracies
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        centers = np.arange(len(index)) if centers is None else np.asarray(centers)
+        labels = [np.asarray(permutation) for permutation in labels]
+
+        membership = sparse.csr_matrix((np.ones(len(index.indices())), index.indices(), index.indptr()),
+                                       shape=(len(index), samples.shape[1]))[centers]
+
+        folds = nfold_splits(chunks)
+        scores = np.zeros((len(labels), len(centers)))
+        for train, test in folds:
+            if self._backend == 'lda':
+                spheres = [index[center] for center in centers]
+                fold_scores = self.__lda__(samples, labels, train, test, spheres)
+            else:
+                fold_scores = self.__separable__(samples, labels, train, test, membership)
+            scores += fold_scores
+
+        return (scores / len(folds)).astype(np.float32)
+
+    def __separable__(self, samples, labels, train, test, membership):
+        """
+            Correlation and GNB, whose sphere statistics are sums of per-voxel terms
+        """
+        test_samples = samples[test]
+        sizes = np.asarray(membership.sum(axis=1)).ravel()[:, np.newaxis]
+
+        # (spheres x test samples) sums of the test samples, the same for every label array
+        sum_x = membership.dot(test_samples.T)
+        sum_xx = membership.dot((test_samples ** 2).T)
+
+        fold_scores = []
+        for permutation in labels:
+            classes = np.unique(permutation[train])
+            means = np.array([samples[train][permutation[train] == label].mean(axis=0) for label in classes])
+
+            evidence = []
+            for label, mean in zip(classes, means):
+                if self._backend == 'correlation':
+                    sum_m = membership.dot(mean)[:, np.newaxis]
+                    sum_mm = membership.dot(mean ** 2)[:, np.newaxis]
+                    sum_xm = membership.dot((test_samples * mean).T)
+                    covariance = sizes * sum_xm - sum_x * sum_m
+                    variance = (sizes * sum_xx - sum_x ** 2) * (sizes * sum_mm - sum_m ** 2)
+                    evidence.append(covariance / np.sqrt(np.maximum(variance, 1e-20)))
+                else:
+                    members = samples[train][permutation[train] == label]
+                    variance = members.var(axis=0) + 1e-9
+                    prior = np.log(len(members) / float(len(train)))
+                    log_likelihood = -0.5 * np.log(2 * np.pi * variance) - \
+                                     (test_samples - mean) ** 2 / (2 * variance)
+                    evidence.append(membership.dot(log_likelihood.T) + prior)
+
+            predictions = classes[np.argmax(evidence, axis=0)]
+            fold_scores.append((predictions == permutation[test]).mean(axis=1))
+
+        return np.array(fold_scores)
+
+    def __lda__(self, samples, labels, train, test, spheres):
+        """
+            Shrinkage LDA, the spheres of equal size are solved as stacked (batch x features x features) systems
+        """
+        fold_scores = np.zeros((len(labels), len(spheres)))
+        sizes = np.array([len(sphere) for sphere in spheres])
+
+        for size in np.unique(sizes):
+            positions = np.nonzero(sizes == size)[0]
+            for start in range(0, len(positions), self._batch_size):
+                batch = positions[start:start + self._batch_size]
+                features = np.array([spheres[position] for position in batch])
+
+                # (batch x samples x features)
+                train_data = np.rollaxis(samples[train][:, features], 1)
+                test_data = np.rollaxis(samples[test][:, features], 1)
+
+                for row, permutation in enumerate(labels):
+                    fold_scores[row, batch] = self.__lda_batch__(train_data, test_data, permutation[train],
+                                                                 permutation[test])
+        return fold_scores
+
+    def __lda_batch__(self, train_data, test_data, train_labels, test_labels):
+        classes = np.unique(train_labels)
+        means = np.array([train_data[:, train_labels == label].mean(axis=1) for label in classes])  # (k x b x p)
+
+        centered = train_data.copy()
+        for label, mean in zip(classes, means):
+            centered[:, train_labels == label] -= mean[:, np.newaxis]
+
+        n, p = centered.shape[1], centered.shape[2]
+        covariance = np.einsum('bnp,bnq->bpq', centered, centered) / n
+        mu = np.trace(covariance, axis1=1, axis2=2) / p
+
+        shrinkage = self._shrinkage
+        if shrinkage is None:
+            # Ledoit-Wolf: the shrinkage that minimizes the expected squared error of the covariance
+            squares = centered ** 2
+            beta = ((squares.sum(axis=2) ** 2).sum(axis=1) / n - (covariance ** 2).sum(axis=(1, 2))) / (n * p)
+            delta = ((covariance - mu[:, np.newaxis, np.newaxis] * np.eye(p)) ** 2).sum(axis=(1, 2)) / p
+            shrinkage = np.where(delta > 0, np.minimum(beta, delta) / np.maximum(delta, 1e-20), 0)
+        shrinkage = np.asarray(shrinkage, dtype=np.float64).reshape(-1, 1, 1)
+
+        covariance = (1 - shrinkage) * covariance + shrinkage * mu[:, np.newaxis, np.newaxis] * np.eye(p)
+        covariance += 1e-9 * np.eye(p)
+
+        # (b x p x k) weights of every class
+        weights = np.linalg.solve(covariance, np.rollaxis(means, 0, 3))
+        offsets = -0.5 * np.einsum('kbp,bpk->bk', means, weights) + \
+                  np.log([np.mean(train_labels == label) for label in classes])
+
+        discriminants = np.einsum('bnp,bpk->bnk', test_data, weights) + offsets[:, np.newaxis, :]
+        return (classes[np.argmax(discriminants, axis=2)] == test_labels).mean(axis=1)
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import multiprocessing
+import nibabel
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data, mask_data
+
+
+def running_line_matrix(volumes, sigma):
+    """
+        The Gaussian-weighted running line smoother of fslmaths -bptf as a (volumes x volumes) matrix K
+
+        Row t of K gives the value at volume t of the straight line fitted by least squares to the volumes
+        within int(3 * sigma) of t, weighted by a Gaussian of sd sigma around t (the window of fslmaths).
+        Where the window is a single volume fslmaths leaves the volume as it is, so the row of K is 0.
+        K only depends on the run length, so the trend of all the voxels is K * data.
+
+        Parameters
+            volumes = number of volumes
+            sigma = sd of the Gaussian weights, in volumes (fslmaths highpass sigma)
+    """
+    times = np.arange(volumes, dtype=np.float64)
+    distance = times[np.newaxis, :] - times[:, np.newaxis]
+    weights = np.exp(-distance ** 2 / (2.0 * sigma ** 2))
+    weights[np.abs(distance) > int(sigma * 3)] = 0
+
+    s0 = weights.sum(axis=1)[:, np.newaxis]
+    s1 = (weights * distance).sum(axis=1)[:, np.newaxis]
+    s2 = (weights * distance ** 2).sum(axis=1)[:, np.newaxis]
+
+    # weighted least squares line (intercept at distance 0) in closed form
+    denominator = s0 * s2 - s1 ** 2
+    fitted = denominator[:, 0] != 0
+    kernel = np.zeros((volumes, volumes))
+    kernel[fitted] = (weights * (s2 - s1 * distance))[fitted] / denominator[fitted]
+    return kernel
+
+
+def dct_basis(volumes, cutoff):
+    """
+        Orthonormal discrete cosine basis of the drifts slower than cutoff (as SPM's spm_dctmtx)
+
+        Parameters
+            volumes = number of volumes
+            cutoff = the shortest period removed, in volumes
+
+        Returns
+            (volumes x order) matrix, without the constant
+    """
+    order = int(2.0 * volumes / cutoff + 1)
+    times = np.arange(volumes, dtype=np.float64)[:, np.newaxis]
+    frequencies = np.arange(1, order, dtype=np.float64)[np.newaxis, :]
+    return np.sqrt(2.0 / volumes) * np.cos(np.pi * (2 * times + 1) * frequencies / (2.0 * volumes))
+
+
+def sigma_from_cutoff(cutoff, tr):
+    """
+        The fslmaths highpass sigma (in volumes) of a cutoff in seconds, as FEAT sets it
+    """
+    return cutoff / (2.0 * tr)
+
+
+def repetition_time(img):
+    """
+        TR of a 4D image in seconds, from its header
+    """
+    tr = float(img.header.get_zooms()[3])
+    if img.header.get_xyzt_units()[1] == 'msec':
+        tr /= 1000.0
+    return tr
+
+
+class HighpassFilter(object):
+
+    def __init__(self, sigma=None, cutoff=None, method='running_line', keep_mean=False, n_jobs=None, block_size=20000):
+        """
+            Temporal highpass filter of (time x voxels) matrices
+
+            The filter of a run is a single (volumes x volumes) matrix, so filtering is one matrix product,
+            done in blocks of voxels by a thread pool (numpy releases the GIL in the product).
+
+            Methods
+                running_line = fslmaths -bptf (FSL >= 5.0.7): the Gaussian-weighted running line, fitted in a
+                               window of +-int(3 * sigma) volumes, is removed
+                dct = the discrete cosine drifts slower than the cutoff are removed (SPM)
+
+            Parameters
+                sigma = sd of the running line in volumes (fslmaths highpass sigma)
+                cutoff = cutoff period in seconds, sigma = cutoff / (2 * TR) - requires the TR of the run
+                method = 'running_line' or 'dct'
+                keep_mean = add the temporal mean of every voxel back, as FEAT does after fslmaths -bptf
+                            (-add tempMean). Without it the running line output has the mean removed, as the
+                            output of fslmaths, and the dct output is centered
+                n_jobs = number of voxel blocks filtered concurrently (None = number of cores)
+                block_size = number of voxels in a block
+        """
+        if (sigma is None) == (cutoff is None):
+            raise ValueError("Exactly one of sigma and cutoff should be given")
+        if method not in ['running_line', 'dct']:
+            raise ValueError("Unknown highpass method {}".format(method))
+
+        self._sigma = sigma
+        self._cutoff = cutoff
+        self._method = method
+        self._keep_mean = keep_mean
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._block_size = block_size
+        self._operators = dict()
+
+    def sigma(self, tr=None):
+        """
+            The running line sigma in volumes (for a cutoff, of a run with this TR)
+        """
+        if self._sigma is not None:
+            return self._sigma
+        if tr is None:
+            raise ValueError("A cutoff in seconds requires the TR of the run")
+        return sigma_from_cutoff(self._cutoff, tr)
+
+    def operator(self, volumes, tr=None):
+        """
+            The (volumes x volumes) matrix that filters a run
+        """
+        sigma = self.sigma(tr)
+        if (volumes, sigma) not in self._operators:
+            if self._method == 'running_line':
+                # (I - K) removes the line
+                operator = np.eye(volumes) - running_line_matrix(volumes, sigma)
+                if self._keep_mean:
+                    operator += 1.0 / volumes
+            else:
+                # cutoff period in volumes = 2 * sigma, the basis has no constant so the mean is kept
+                basis = dct_basis(volumes, 2 * sigma)
+                operator = np.eye(volumes) - basis.dot(basis.T)
+                if not self._keep_mean:
+                    operator -= 1.0 / volumes
+            self._operators[(volumes, sigma)] = operator
+
+        return self._operators[(volumes, sigma)]
+
+    def filter(self, data, tr=None):
+        """
+            Parameters
+                data = (time x voxels) matrix
+                tr = TR of the run in seconds (needed only for a cutoff in seconds)
+
+            Returns
+                float32 (time x voxels) matrix
+        """
+        operator = self.operator(data.shape[0], tr)
+        filtered = np.empty(data.shape, dtype=np.float32)
+
+        def filter_block(start):
+            block = np.asarray(data[:, start:start + self._block_size], dtype=np.float64)
+            filtered[:, start:start + self._block_size] = operator.dot(block)
+
+        starts = range(0, data.shape[1], self._block_size)
+        if self._n_jobs == 1 or len(starts) <= 1:
+            map(filter_block, starts)
+        else:
+            pool = ThreadPool(min(self._n_jobs, len(starts)))
+            try:
+                pool.map(filter_block, starts)
+            finally:
+                pool.close()
+                pool.join()
+
+        return filtered
+
+    def filter_image(self, in_file, out_file, mask_file=None):
+        """
+            Filters the voxels of a 4D image inside the mask, everything outside it is 0 in out_file
+
+            Parameters
+                mask_file = None: the voxels that are non zero in the first volume (the runs are masked
+                            before the motion correction)
+        """
+        img = nibabel.load(in_file)
+        data = float32_data(img)
+        if mask_file is None:
+            brain_mask = data[..., 0] != 0
+        else:
+            brain_mask = mask_data(mask_file)
+
+        tr = repetition_time(img) if self._sigma is None else None
+        filtered = self.filter(data[brain_mask].T, tr)
+
+        data[:] = 0
+        data[brain_mask] = filtered.T
+
+        out_img = nibabel.Nifti1Image(data, img.affine, img.header.copy())
+        out_img.set_data_dtype(np.float32)
+        with AtomicOutput(out_file) as output:
+            nibabel.save(out_img, output.temp())
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+
+import nibabel
+import numpy as np
+
+
+def float32_data(img):
+    """
+        The data of an image as a float32 array
+
+        The array proxy is read in its own dtype and cast afterwards: nibabel < 3 doesn't accept a dtype in
+        np.asarray(img.dataobj, dtype), and the cast doesn't copy data that already is float32.
+
+        Parameters
+            img = nibabel image or image file
+    """
+    if isinstance(img, basestring):
+        img = nibabel.load(img)
+    return np.asarray(img.dataobj).astype(np.float32, copy=False)
+
+
+def mask_data(mask_file):
+    """
+        Boolean array of the nonzero voxels of a mask image (file)
+    """
+    return np.asanyarray(nibabel.load(mask_file).dataobj) > 0
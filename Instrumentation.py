@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import functools
+import threading
+import nibabel
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+# The stage / run a thread is working on, so the tool invocations inside it are keyed by it
+_context = threading.local()
+_write_lock = threading.Lock()
+
+
+def _snapshot():
+    times = os.times()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    snapshot = {'wall': time.time(),
+                'cpu_user': times[0],
+                'cpu_system': times[1],
+                'children_user': times[2],
+                'children_system': times[3],
+                'children_blocks_in': children.ru_inblock,
+                'children_blocks_out': children.ru_oublock,
+                'max_child_rss_so_far_kb': children.ru_maxrss,
+                'read_bytes': 0,
+                'write_bytes': 0}
+
+    try:
+        with open('/proc/self/io', 'r') as fh:
+            for line in fh:
+                name, value = line.split(':')
+                if name in ['read_bytes', 'write_bytes']:
+                    snapshot[name] = int(value)
+    except IOError:
+        pass  # not linux
+
+    return snapshot
+
+
+def _image_info(path):
+    if not isinstance(path, basestring) or not os.path.isfile(path):
+        return None
+
+    info = {'path': path, 'bytes': os.path.getsize(path)}
+    if '.nii' in path:
+        try:
+            info['shape'] = list(nibabel.load(path).header.get_data_shape())
+        except Exception:
+            pass
+    return info
+
+
+def instrumented(stage):
+    """
+        Decorator of the PreProcessing stage methods (method(self, subject, ...)): the stage is measured as
+        a whole, and its runs and tool invocations are keyed by its name
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, subject, *args, **kwargs):
+            with self._instrumentation.measure(subject, stage):
+                return method(self, subject, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Instrumentation(object):
+
+    def __init__(self, log_file=None):
+        """
+            Performance records of the preprocessing, written as JSON lines to log_file
+
+            Every record is keyed by subject / task / run / stage (/ tool) and holds
+                wall = elapsed seconds
+                cpu_user, cpu_system = CPU seconds of this process (the native engines)
+                children_user, children_system = CPU seconds of the external tools (FSL)
+                max_child_rss_so_far_kb = the largest peak RSS of all the external tools this process finished so
+                                          far (RUSAGE_CHILDREN is a running maximum, nipype doesn't expose the
+                                          pid of a tool, so it can't be measured per invocation) - it's an upper
+                                          bound of the tool's RSS, and may belong to an earlier or concurrent tool
+                read_bytes, write_bytes = bytes this process read / wrote (/proc/self/io)
+                children_blocks_in, children_blocks_out = 512 byte blocks the external tools read / wrote
+                inputs, outputs = path, size and shape of the images
+            The counters are per process: when runs are processed concurrently (run_jobs > 1) they overlap.
+
+            Parameters
+                log_file = JSON lines file the records are appended to (None = nothing is recorded)
+        """
+        self._log_file = log_file
+        self._session = time.strftime('%Y%m%d-%H%M%S-') + str(os.getpid())
+
+    @contextmanager
+    def measure(self, subject, stage=None, directory=None, inputs=(), outputs=(), tool=None):
+        """
+            Measures the enclosed block
+
+            Parameters
+                subject = SubjectDir
+                stage = stage name (None = the stage of the enclosing measure block of this thread)
+                directory = run directory (taskxxx_runxxx) for the per-run blocks
+                inputs, outputs = images the block reads / writes, their sizes are recorded
+                tool = name of the external tool
+        """
+        if self._log_file is None:
+            yield
+            return
+
+        parent = getattr(_context, 'key', {})
+        key = dict(parent)
+        key['subject'] = subject.subcode() if hasattr(subject, 'subcode') else subject
+        key['stage'] = stage or parent.get('stage')
+        if directory is not None:
+            task, run = os.path.basename(directory.rstrip('/')).split('_')
+            key.update({'task': task, 'run': run})
+        if tool is not None:
+            key['tool'] = tool
+
+        _context.key = key
+        before = _snapshot()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            after = _snapshot()
+            _context.key = parent
+
+            record = dict(key)
+            record.update((name, after[name] - before[name]) for name in before if name != 'max_child_rss_so_far_kb')
+            record['max_child_rss_so_far_kb'] = after['max_child_rss_so_far_kb']
+            record.update({'session': self._session,
+                           'level': 'tool' if tool is not None else 'run' if 'run' in key else 'stage',
+                           'status': status,
+                           'start': before['wall'],
+                           'inputs': filter(None, map(_image_info, inputs)),
+                           'outputs': filter(None, map(_image_info, outputs))})
+            self.__write__(record)
+
+    def run_tool(self, interface, name=None):
+        """
+            Runs a nipype interface inside a measure block keyed by the stage / run of the calling thread
+        """
+        inputs = [getattr(interface.inputs, trait, None) for trait in ['in_file', 'in_files']]
+        inputs = [path for value in inputs for path in (value if isinstance(value, list) else [value])]
+
+        context = getattr(_context, 'key', {})
+        with self.measure(context.get('subject'), inputs=inputs,
+                          outputs=[getattr(interface.inputs, 'out_file', None)],
+                          tool=name or interface.__class__.__name__):
+            return interface.run()
+
+    def current(self):
+        """
+            (subject, stage) of the innermost measure block of this thread
+        """
+        context = getattr(_context, 'key', {})
+        return context.get('subject'), context.get('stage')
+
+    def __write__(self, record):
+        line = json.dumps(record, sort_keys=True, default=str)
+        with _write_lock:
+            log_dir = os.path.dirname(self._log_file)
+            if log_dir and not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            with open(self._log_file, 'a') as fh:
+                fh.write(line + '\n')
+
+
+def load_records(log_file, session=None):
+    """
+        The records of log_file (of a single session: 'latest', 'previous' or a session id)
+    """
+    with open(log_file, 'r') as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+
+    if session is None:
+        return records
+
+    sessions = sorted(set(record['session'] for record in records))
+    if session in ['latest', 'previous']:
+        index = -1 if session == 'latest' else -2
+        if len(sessions) < -index:
+            return []
+        session = sessions[index]
+    return [record for record in records if record['session'] == session]
+
+
+def stage_times(records):
+    """
+        Mean wall / CPU seconds of every stage (the stage level records)
+    """
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for record in records:
+        if record['level'] == 'stage':
+            total = totals[record['stage']]
+            total[0] += 1
+            total[1] += record['wall']
+            total[2] += record['cpu_user'] + record['cpu_system'] + record['children_user'] + record['children_system']
+    return dict((stage, (wall / count, cpu / count)) for stage, (count, wall, cpu) in totals.iteritems())
+
+
+def report(records, baseline=None, top=10, threshold=0.2):
+    """
+        Prints the slowest stages / runs / tools, the per-subject totals and the stages that got slower
+        than in the baseline records by more than threshold
+    """
+    cpu = lambda record: record['cpu_user'] + record['cpu_system'] + record['children_user'] + record['children_system']
+    describe = lambda record: ' '.join(str(record[name]) for name in ['subject', 'stage', 'task', 'run', 'tool']
+                                       if record.get(name) is not None)
+
+    print ">>> Slowest"
+    for record in sorted([record for record in records if record['level'] != 'stage'],
+                         key=lambda record: -record['wall'])[:top]:
+        print "{:<60}{:>10.1f}s{:>10.1f}s cpu".format(describe(record), record['wall'], cpu(record))
+
+    print ">>> Per subject"
+    subjects = defaultdict(lambda: [0.0, 0.0, 0])
+    for record in records:
+        if record['level'] == 'stage':
+            subjects[record['subject']][0] += record['wall']
+            subjects[record['subject']][1] += cpu(record)
+            subjects[record['subject']][2] += record['status'] != 'ok'
+    for subject, (wall, cpu_time, failed) in sorted(subjects.iteritems()):
+        print "sub{:0>3}{:>12.1f}s{:>12.1f}s cpu{:>6} failed stages".format(subject, wall, cpu_time, failed)
+
+    if baseline:
+        print ">>> Compared to the baseline"
+        current, previous = stage_times(records), stage_times(baseline)
+        for stage in sorted(set(current) & set(previous)):
+            ratio = current[stage][0] / previous[stage][0] if previous[stage][0] > 0 else 1.0
+            flag = 'REGRESSION' if ratio > 1 + threshold else ''
+            print "{:<30}{:>10.1f}s ->{:>10.1f}s{:>8.0%} {}".format(
+                stage, previous[stage][0], current[stage][0], ratio - 1, flag)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report of the preprocessing instrumentation log')
+    parser.add_argument('log_file', help='JSON lines log (study_dir/logs/preprocessing.jsonl)')
+    parser.add_argument('--session', default='latest', help="session to report: 'latest' or a session id")
+    parser.add_argument('--baseline', help="log file to compare with (default: the previous session of log_file)")
+    parser.add_argument('--baseline-session', default=None, help="session of the baseline log (default: latest)")
+    parser.add_argument('--top', type=int, default=10, help='number of slowest blocks shown')
+    args = parser.parse_args()
+
+    records = load_records(args.log_file, args.session)
+    if args.baseline:
+        baseline = load_records(args.baseline, args.baseline_session or 'latest')
+    else:
+        baseline = load_records(args.log_file, 'previous')
+
+    if not records:
+        print "No records in {}".format(args.log_file)
+        sys.exit(1)
+
+    report(records, baseline, args.top)
+
+
+if __name__ == '__main__':
+    main()
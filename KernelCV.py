@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import numpy as np
+
+
+def nfold_splits(chunks):
+    """
+        Leave-one-chunk-out folds (as NFoldPartitioner()): list of (training indices, testing indices)
+    """
+    chunks = np.asarray(chunks)
+    return [(np.nonzero(chunks != chunk)[0], np.nonzero(chunks == chunk)[0]) for chunk in np.unique(chunks)]
+
+
+def kernel_folds(samples, chunks, C=-1.0):
+    """
+        The linear kernel blocks of every leave-one-chunk-out fold of a sphere
+
+        Parameters
+            samples = (samples x features) matrix of the sphere
+            chunks = sample chunks
+            C = the SVM C, a negative C is scaled as in PyMVPA: -C / (mean norm of the training samples) ** 2
+
+        Returns
+            list of (training indices, testing indices, training kernel, testing kernel, C of the fold)
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    kernel = samples.dot(samples.T)
+    norms = np.sqrt(np.diag(kernel))
+
+    folds = []
+    for train, test in nfold_splits(chunks):
+        fold_C = C if C > 0 else -C / norms[train].mean() ** 2
+        folds.append((train, test, kernel[np.ix_(train, train)], kernel[np.ix_(test, train)], fold_C))
+    return folds
+
+
+class PrecomputedKernelCV(object):
+
+    def __init__(self, C=-1.0, tol=5e-5):
+        """
+            Cross validated accuracy of a linear C-SVM trained on a precomputed linear kernel
+
+            The equivalent of the pymvpa2_cv_setup.py measure (LinearCSVMC, NFoldPartitioner, mean_match_accuracy,
+            mean_sample) for the label permutations of a sphere: the kernel X * X' of the sphere's samples
+            only depends on its features, so it is computed once and its fold blocks are reused for every
+            fold and every permutation - only the labels change. libsvm (scikit-learn SVC) is trained on the
+            kernel block, without touching the features again.
+
+            Parameters
+                C = the SVM C, a negative C is scaled as in PyMVPA: -C / (mean norm of the training samples) ** 2
+                tol = libsvm stopping tolerance (as LinearCSVMC's epsilon)
+        """
+        try:
+            from sklearn.svm import SVC  # optional, only the gram engine needs it
+        except ImportError:
+            raise ImportError("The precomputed kernel (--gram) engine needs scikit-learn: pip install scikit-learn")
+
+        self._svc = SVC
+        self._C = C
+        self._tol = tol
+
+    def folds(self, samples, chunks):
+        """
+            The kernel blocks of every fold of a sphere (see kernel_folds)
+        """
+        return kernel_folds(samples, chunks, self._C)
+
+    def score(self, folds, labels):
+        """
+            Mean accuracy over the folds for one set of labels
+        """
+        labels = np.asarray(labels)
+        accuracies = []
+        for train, test, train_kernel, test_kernel, C in folds:
+            clf = self._svc(kernel='precomputed', C=C, tol=self._tol)
+            clf.fit(train_kernel, labels[train])
+            accuracies.append(np.mean(clf.predict(test_kernel) == labels[test]))
+        return np.mean(accuracies)
+
+    def scores(self, samples, labels, chunks):
+        """
+            Parameters
+                samples = (samples x features) matrix of the sphere
+                labels = list of label arrays (the original and the permutations)
+
+            Returns
+                float32 array of the mean accuracy of every label array
+        """
+        folds = self.folds(samples, chunks)
+        return np.array([self.score(folds, permutation) for permutation in labels], dtype=np.float32)
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import os
+import numpy as np
+from glob import glob
+from Scheduler import RunPool
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data, mask_data
+
+
+METRICS_FILE = 'motion_metrics.txt'
+SCRUB_FILE = 'motion_scrub.txt'
+
+
+def read_par(par_file):
+    """
+        MCFLIRT motion parameters: (volumes x 6) array, rotations (radians) then translations (mm)
+    """
+    return np.loadtxt(par_file, ndmin=2)
+
+
+def run_par_file(directory):
+    """
+        The .par file of the motion corrected run in directory (bold_mcf / bold_mask_mcf), or None
+    """
+    par_files = sorted(glob(os.path.join(directory, '*_mcf.nii*.par')))
+    return par_files[0] if par_files else None
+
+
+def framewise_displacement(params, lengths=None, radius=50):
+    """
+        Framewise displacement (Power et al. 2012)
+
+        Sum of the absolute changes of the 6 parameters from the previous volume, the rotations are converted
+        to mm as the arc length on a sphere of the given radius.
+
+        Parameters
+            params = (volumes x 6) MCFLIRT parameters, several runs can be concatenated
+            lengths = number of volumes of every concatenated run (None = a single run)
+            radius = head radius (mm)
+
+        Returns
+            (volumes,) array, 0 on the first volume of every run
+    """
+    deltas = np.abs(np.diff(np.vstack([params[:1], params]), axis=0))
+    fd = deltas[:, 3:].sum(axis=1) + radius * deltas[:, :3].sum(axis=1)
+
+    if lengths is not None:
+        fd[np.cumsum([0] + list(lengths[:-1]))] = 0
+
+    return fd
+
+
+def run_brain_mask(directory):
+    """
+        The brain mask of the subject of a run directory (subxxx/BOLD/taskxxx_runxxx), or None when it's missing
+    """
+    subject_dir = os.path.dirname(os.path.dirname(os.path.abspath(directory)))
+    mask_file = os.path.join(subject_dir, 'masks', 'anatomy', 'brain.nii.gz')
+    return mask_file if os.path.isfile(mask_file) else None
+
+
+def intensity_mask(data, brain_threshold=10):
+    """
+        The brain voxels of an unmasked run, by the intensity threshold of FEAT: the voxels of the mean volume
+        above brain_threshold % of the robust range (2nd to 98th percentile) of the intensities
+
+        Parameters
+            data = 4D array of the run
+    """
+    mean = data.mean(axis=3)
+    low, high = np.percentile(mean, [2, 98])
+    return mean > low + (high - low) * brain_threshold / 100.0
+
+
+def dvars(brain_data):
+    """
+        DVARS: RMS over the voxels of the signal change from the previous volume
+
+        Parameters
+            brain_data = (time x voxels) matrix
+
+        Returns
+            (volumes,) array, 0 on the first volume
+    """
+    return np.concatenate([[0], np.sqrt((np.diff(brain_data, axis=0) ** 2).mean(axis=1))])
+
+
+def outliers(fd, dvars_values, fd_threshold=0.5, dvars_threshold=3.0):
+    """
+        Volumes with FD above fd_threshold (mm), or DVARS more than dvars_threshold standard deviations
+        above the mean DVARS of the run
+    """
+    changes = dvars_values[1:]
+    dvars_z = np.zeros(len(dvars_values))
+    if len(changes) > 1 and changes.std() > 0:
+        dvars_z[1:] = (changes - changes.mean()) / changes.std()
+
+    return (fd > fd_threshold) | (dvars_z > dvars_threshold)
+
+
+def scrub_mask(flags, before=1, after=2):
+    """
+        The volumes to keep: every flagged volume is dropped along with the volumes around it
+        (one before and two after, as in Power et al. 2012)
+
+        Returns
+            boolean (volumes,) array, True = keep
+    """
+    flagged = np.flatnonzero(flags)
+    dropped = np.zeros(len(flags), dtype=bool)
+    for shift in range(-before, after + 1):
+        shifted = flagged + shift
+        dropped[shifted[(shifted >= 0) & (shifted < len(flags))]] = True
+
+    return ~dropped
+
+
+def load_scrub(run_dir):
+    """
+        The scrubbing mask of a run (see MotionMetrics), or None when it wasn't computed
+    """
+    scrub_file = os.path.join(run_dir, SCRUB_FILE)
+    if not os.path.isfile(scrub_file):
+        return None
+
+    return np.loadtxt(scrub_file, dtype=int, ndmin=1).astype(bool)
+
+
+class MotionMetrics(object):
+
+    def __init__(self, fd_threshold=0.5, dvars_threshold=3.0, radius=50, n_jobs=None, memory_limit=None):
+        """
+            Motion metrics of motion corrected runs, computed from the MCFLIRT .par files and the masked BOLD
+
+            Outputs (in every run directory):
+                motion_metrics.txt = fd, dvars and outlier (0/1) columns, one row per volume
+                motion_scrub.txt = 1 for every volume to keep, 0 for the volumes dropped by scrubbing
+
+            Parameters
+                fd_threshold = framewise displacement (mm) above which a volume is an outlier
+                dvars_threshold = DVARS z-score above which a volume is an outlier
+                radius = head radius used to convert the rotations to mm
+                n_jobs = number of runs whose BOLD is read concurrently (None = number of cores)
+                memory_limit = bytes the concurrently read runs may use (None = 75% of the physical memory),
+                               see RunPool
+        """
+        self._fd_threshold = fd_threshold
+        self._dvars_threshold = dvars_threshold
+        self._radius = radius
+        self._run_pool = RunPool(n_jobs, memory_limit)
+
+    def analyze_study(self, study_dir):
+        """
+            Motion metrics of every motion corrected run of the study (study_dir/subxxx/BOLD/taskxxx_runxxx)
+
+            The .par files of all the runs are parsed together and their FD computed as a single array.
+            The BOLD of the runs (needed for DVARS) is read by a RunPool, which starts a run only when its
+            footprint fits in the memory limit. DVARS is computed in the brain mask of the subject
+            (masks/anatomy/brain.nii.gz), or in the intensity_mask of the run when it's missing.
+
+            Returns
+                dictionary of <run directory, dictionary of fd, dvars, outliers, scrub arrays>
+        """
+        run_dirs = sorted(glob(os.path.join(study_dir, 'sub[0-9][0-9][0-9]', 'BOLD',
+                                            'task[0-9][0-9][0-9]_run[0-9][0-9][0-9]')))
+        par_files = filter(None, [run_par_file(directory) for directory in run_dirs])
+        if not par_files:
+            return dict()
+
+        params = [read_par(par_file) for par_file in par_files]
+        lengths = [len(run_params) for run_params in params]
+        fd = framewise_displacement(np.vstack(params), lengths, self._radius)
+
+        directories = [os.path.dirname(par_file) for par_file in par_files]
+        bold_files = dict((os.path.dirname(par_file), par_file[:-len('.par')]) for par_file in par_files)
+        run_fd = dict(zip(directories, np.split(fd, np.cumsum(lengths)[:-1])))
+        results = dict()
+
+        def analyze(directory):
+            results[directory] = self.__analyze__(bold_files[directory], run_brain_mask(directory),
+                                                  run_fd[directory], directory)
+
+        self._run_pool.map(analyze, directories, [bold_files[directory] for directory in directories])
+
+        print ">>> Motion metrics of {} runs, {} volumes scrubbed".format(
+            len(results), sum(np.count_nonzero(~result['scrub']) for result in results.values()))
+
+        return results
+
+    def analyze_run(self, par_file, bold_file, mask_file=None, output_dir=None):
+        """
+            Motion metrics of a single run
+
+            Parameters
+                par_file = MCFLIRT parameters of the run
+                bold_file = the motion corrected run
+                mask_file = voxels used for DVARS (None = the intensity_mask of the run)
+                output_dir = where the output files are written (None = the directory of bold_file)
+        """
+        fd = framewise_displacement(read_par(par_file), radius=self._radius)
+        return self.__analyze__(bold_file, mask_file, fd, output_dir or os.path.dirname(bold_file))
+
+    def __analyze__(self, bold_file, mask_file, fd, output_dir):
+        data = float32_data(bold_file)
+        if mask_file is None:
+            brain_mask = intensity_mask(data)
+        else:
+            brain_mask = mask_data(mask_file)
+            if brain_mask.shape != data.shape[:3]:
+                raise ValueError("{} doesn't match the dimensions of {}".format(mask_file, bold_file))
+
+        if data.shape[3] != len(fd):
+            raise ValueError("{} has {} volumes and {} motion parameters".format(bold_file, data.shape[3], len(fd)))
+
+        dvars_values = dvars(data[brain_mask].T)
+        del data
+
+        flags = outliers(fd, dvars_values, self._fd_threshold, self._dvars_threshold)
+        keep = scrub_mask(flags)
+
+        with AtomicOutput(os.path.join(output_dir, METRICS_FILE)) as output:
+            np.savetxt(output.temp(), np.column_stack([fd, dvars_values, flags]), fmt=['%.6f', '%.6f', '%d'],
+                       header='fd dvars outlier')
+        with AtomicOutput(os.path.join(output_dir, SCRUB_FILE)) as output:
+            np.savetxt(output.temp(), keep, fmt='%d')
+
+        return {'fd': fd, 'dvars': dvars_values, 'outliers': flags, 'scrub': keep}
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+from AtomicOutput import AtomicOutput
+
+try:
+    from mvpa2.misc.neighborhood import QueryEngineInterface
+except ImportError:
+    QueryEngineInterface = object  # the index itself doesn't need PyMVPA
+
+
+# The indexes loaded by this process, so every permutation / condition pair reuses them
+_loaded = dict()
+
+
+def sphere_offsets(radius):
+    """
+        The integer offsets within radius voxels of the center (euclidean distance, as PyMVPA's Sphere)
+
+        Returns
+            (offsets x 3) int array
+    """
+    extent = int(np.floor(radius))
+    grid = np.mgrid[-extent:extent + 1, -extent:extent + 1, -extent:extent + 1].reshape(3, -1).T
+    return grid[np.sqrt((grid ** 2).sum(axis=1)) <= radius]
+
+
+def neighborhood_key(voxel_indices, radius):
+    """
+        The key of the neighborhoods of a mask: a hash of its voxel indices (in feature order) and the radius
+    """
+    voxel_indices = np.ascontiguousarray(voxel_indices, dtype=np.int32)
+    digest = hashlib.sha1(voxel_indices.tobytes()).hexdigest()
+    return '{}_r{:g}'.format(digest[:16], radius)
+
+
+class NeighborhoodIndex(object):
+
+    def __init__(self, indptr, indices, radius, key):
+        """
+            Sphere neighborhoods of every feature of a dataset in compressed sparse row form
+
+            The feature ids of the sphere around center c are indices[indptr[c]:indptr[c + 1]] (sorted), so the
+            neighborhoods of 50000 voxels take a few MB and load in milliseconds. The index only depends on
+            the voxel indices of the features and the radius, so all the permutations, condition pairs and
+            subjects with the same mask share it.
+
+            Use NeighborhoodIndex.build / load / cached to create one.
+
+            Parameters
+                indptr = (centers + 1) int64 array
+                indices = feature ids of all the spheres, int32
+                radius = sphere radius in voxels
+                key = neighborhood_key of the mask and radius
+        """
+        self._indptr = indptr
+        self._indices = indices
+        self._radius = radius
+        self._key = key
+
+    @classmethod
+    def build(cls, voxel_indices, radius):
+        """
+            Parameters
+                voxel_indices = (features x 3) voxel coordinates of the features (dataset.fa.voxel_indices)
+                radius = sphere radius in voxels
+        """
+        voxel_indices = np.asarray(voxel_indices, dtype=np.int64)
+        features = len(voxel_indices)
+
+        # feature id of every voxel of the bounding box (-1 outside the mask), padded by the radius
+        pad = int(np.floor(radius))
+        origin = voxel_indices.min(axis=0) - pad
+        coordinates = voxel_indices - origin
+        lookup = -np.ones(tuple(coordinates.max(axis=0) + pad + 1), dtype=np.int32)
+        lookup[tuple(coordinates.T)] = np.arange(features, dtype=np.int32)
+
+        centers, neighbors = [], []
+        for offset in sphere_offsets(radius):
+            ids = lookup[tuple((coordinates + offset).T)]
+            inside = ids >= 0
+            centers.append(np.nonzero(inside)[0].astype(np.int32))
+            neighbors.append(ids[inside])
+        centers = np.concatenate(centers)
+        neighbors = np.concatenate(neighbors)
+
+        order = np.lexsort((neighbors, centers))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(centers, minlength=features))]).astype(np.int64)
+
+        return cls(indptr, neighbors[order], radius, neighborhood_key(voxel_indices, radius))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as archive:
+            return cls(archive['indptr'], archive['indices'], float(archive['radius']), str(archive['key']))
+
+    @classmethod
+    def cached(cls, voxel_indices, radius, cache_dir=None):
+        """
+            The index of the mask and radius: from this process' memory, from cache_dir/<key>.npz, or built
+            (and saved to cache_dir)
+
+            Parameters
+                cache_dir = directory of the saved indexes (None = kept in memory only)
+        """
+        key = neighborhood_key(voxel_indices, radius)
+        if key in _loaded:
+            return _loaded[key]
+
+        path = None if cache_dir is None else os.path.join(cache_dir, key + '.npz')
+        if path is not None and os.path.isfile(path):
+            index = cls.load(path)
+        else:
+            start = time.time()
+            index = cls.build(voxel_indices, radius)
+            print ">>>> Neighborhoods of {} features (radius {}) built in {:.1f}s".format(
+                len(index), radius, time.time() - start)
+            if path is not None:
+                index.save(path)
+
+        _loaded[key] = index
+        return index
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with AtomicOutput(path) as output:
+            # a file object, so numpy doesn't append .npz to the temporary name
+            with open(output.temp(), 'wb') as fh:
+                np.savez(fh, indptr=self._indptr, indices=self._indices, radius=self._radius, key=self._key)
+
+    def key(self):
+        return self._key
+
+    def radius(self):
+        return self._radius
+
+    def indptr(self):
+        return self._indptr
+
+    def indices(self):
+        return self._indices
+
+    def sizes(self):
+        """
+            Number of features in every sphere
+        """
+        return np.diff(self._indptr)
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    def __getitem__(self, center):
+        return self._indices[self._indptr[center]:self._indptr[center + 1]]
+
+
+class NeighborhoodQueryEngine(QueryEngineInterface):
+
+    def __init__(self, radius, space='voxel_indices', cache_dir=None):
+        """
+            PyMVPA query engine of spheres backed by a NeighborhoodIndex, a drop-in replacement of the
+            IndexQueryEngine that sphere_searchlight creates:
+
+                Searchlight(measure, queryengine=NeighborhoodQueryEngine(radius, cache_dir=cache_dir), ...)
+
+            Training on a dataset looks the index up (see NeighborhoodIndex.cached) instead of searching the
+            spheres again, so a searchlight that is called again on a permuted dataset doesn't rebuild them.
+
+            Parameters
+                radius = sphere radius in voxels
+                space = the feature attribute of the voxel coordinates
+                cache_dir = directory of the saved indexes (None = kept in memory only)
+        """
+        self._radius = radius
+        self._space = space
+        self._cache_dir = cache_dir
+        self._index = None
+
+    def train(self, dataset):
+        self._index = NeighborhoodIndex.cached(dataset.fa[self._space].value, self._radius, self._cache_dir)
+
+    def untrain(self):
+        self._index = None
+
+    def index(self):
+        return self._index
+
+    def query_byid(self, fid):
+        return self._index[fid].tolist()
+
+    def query(self, **kwargs):
+        raise NotImplementedError("Spheres are queried by the feature id of their center")
+
+    def __getitem__(self, fid):
+        return self.query_byid(fid)
+
+    @property
+    def ids(self):
+        return np.arange(len(self._index))
+
+
+def main():
+    """
+        Builds (or checks) the saved index of a dataset: NeighborhoodIndex.py <dataset.hdf5> <radius> <cache_dir>
+    """
+    from mvpa2.base.hdf5 import h5load
+
+    dataset, radius, cache_dir = h5load(sys.argv[1]), float(sys.argv[2]), sys.argv[3]
+    index = NeighborhoodIndex.cached(dataset.fa.voxel_indices, radius, cache_dir)
+    print "{}: {} spheres, {:.1f} features on average".format(index.key(), len(index), index.sizes().mean())
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,13 @@
 
 import os
 import json
-import re
+import numpy as np
 import pandas as pd
 
 from glob import glob
+from multiprocessing.pool import ThreadPool
 from SubjectDir import SubjectDir
+from RawIndex import RawIndex
 
 
 class OpenFMRIData(object):
@@ -27,6 +29,8 @@ class OpenFMRIData(object):
         self._study_dir               = os.path.join(self._data_dir, self._study_name)
 
         self._subject_mapping_file    = os.path.join(self._study_dir, 'mapping_subject.json')
+        self._raw_index_file          = os.path.join(self._study_dir, 'raw_index.json')
+        self._raw_index               = None
 
         self._task_order = self.load_task_order()
         self.load_subject_mapping()
@@ -80,8 +84,19 @@ class OpenFMRIData(object):
         Example: RM_lab_Roee_KrNo_20150618_1320
         :return:Array of subject names based on the directory of the raw data
         '''
-        rgx = re.compile("RM_lab.*_(.*)_[0-9]{8}_[0-9]{4}")
-        return [rgx.search(dirname).group(1) for dirname in os.listdir(self._raw_data_dir)]
+        return self.raw_index().subject_names()
+
+    def raw_index(self, refresh = False):
+        '''
+        The index of the raw dicom series of the study (see RawIndex), saved in the study directory as raw_index.json
+        It is brought up to date the first time it's used by this object, only changed directories are read again
+        '''
+        if self._raw_index is None:
+            self._raw_index = RawIndex(self._raw_data_dir, self._raw_index_file)
+            refresh = True
+        if refresh:
+            self._raw_index.refresh()
+        return self._raw_index
 
     def mapping_json(self):
         return self._subject_mapping
@@ -120,22 +135,67 @@ class OpenFMRIData(object):
     def __subcode_to_dir_format__(self, code):
         return os.path.join(self.study_dir(), "sub{:0>3d}".format(int(code)))
 
-    def create_subject_dir(self, subject_name, overwrite = False, create_behav_dict = None):
+    def create_subject_dir(self, subject_name, overwrite = False, create_behav_dict = None, dcm_jobs = None):
         """
             Creates the openfmri structure by creating SubjectDir
 
             Parameters
                 subject_name = (string)
                 create_behav_dict = dictionary[2] {'func': function that creates the conditions of the models, 'behav': behavioural path}
+                dcm_jobs = number of dicom series converted concurrently (None = number of cores)
             Returns:
                 SubjectDir Object
         """
+        subject_code, raw_dir, taskOrder = self.__register_subject__(subject_name, overwrite)
+
+        # With overwrite an existing subject is refreshed - only new or changed dicom series are converted again
+        return SubjectDir(subject_code, self.__subcode_to_dir_format__(subject_code), raw_dir, taskOrder, self._task_mapping, create_behav_dict, dcm_jobs, reingest=overwrite,
+                          raw_series=self.raw_index().raw_series(subject_name))
+
+    def create_subject_dirs(self, subject_names, overwrite = False, create_behav_dict = None, n_jobs = None, dcm_jobs = None):
+        """
+            Creates the openfmri structure of several subjects, converting their dicom files concurrently
+
+            The subject codes are assigned in the order of subject_names before any conversion starts
+
+            Parameters
+                subject_names = list of subject names
+                n_jobs = number of subjects converted concurrently (None = all of them)
+                dcm_jobs = number of dicom series of each subject converted concurrently (None = number of cores)
+            Returns:
+                List of SubjectDir Objects
+        """
+        registered = []
+        for subject_name in subject_names:
+            registered.append(self.__register_subject__(subject_name, overwrite, [code for code, _, _ in registered]))
+        raw_series = [self.raw_index().raw_series(subject_name) for subject_name in subject_names]
+
+        def create(subject):
+            (subject_code, raw_dir, taskOrder), series = subject
+            return SubjectDir(subject_code, self.__subcode_to_dir_format__(subject_code), raw_dir, taskOrder,
+                              self._task_mapping, create_behav_dict, dcm_jobs, reingest=overwrite, raw_series=series)
+
+        pool = ThreadPool(n_jobs or len(registered) or 1)
+        try:
+            return pool.map(create, zip(registered, raw_series))
+        finally:
+            pool.close()
+            pool.join()
+
+    def __register_subject__(self, subject_name, overwrite, reserved_codes = ()):
+        """
+            Assigns a subject code to the subject and saves it to the subject mapping
 
+            Parameters
+                reserved_codes = codes already given to subjects whose directories don't exist yet
+            Returns:
+                (subject code, raw directory, task order)
+        """
         if overwrite and subject_name in self._subject_mapping:
             subject_code = self._subject_mapping[subject_name]
         else:
             # Gets the largest/latest subject code + 1 (from the study directory)
-            subject_code = self.__get_latest_subject_directory__()
+            subject_code = max([self.__get_latest_subject_directory__()] + [int(code) + 1 for code in reserved_codes])
 
         # Adds the the new subject name to the subject_mapping dictionary
         self._subject_mapping[subject_name] = subject_code
@@ -143,17 +203,20 @@ class OpenFMRIData(object):
         taskOrder = self.load_task_order(subject_name)
 
         # Check whether subject raw directory exists before adding the mapping
-        raw_dirs = glob('{}/*{}*'.format(self.raw_study_dir(), subject_name))
+        raw_dir = self.raw_index().subject_dir(subject_name)
 
-        if len(raw_dirs) == 0:
+        if raw_dir is None:
             raise BaseException("No subject by the name of {}".format(subject_name))
 
-        raw_dir = raw_dirs[0]
+        raw_dir = os.path.join(self.raw_study_dir(), raw_dir)
+
+        for problem in self.raw_index().check(subject_name, taskOrder):
+            print("Warning: {}".format(problem))
 
         # Saves the subject mapping to a file
         self.__write_subject_mapping__()
 
-        return SubjectDir(subject_code, self.__subcode_to_dir_format__(subject_code), raw_dir, taskOrder, self._task_mapping, create_behav_dict)
+        return subject_code, raw_dir, taskOrder
 
     def load_subject_dir(self, **kwargs):
         """
@@ -170,6 +233,8 @@ class OpenFMRIData(object):
         """
         raw_dir         = None
         subject_code 	= None
+        subject_name    = None
+        taskOrder       = self._task_order
 
         if 'subcode' in kwargs:
             subject_code = kwargs['subcode']
@@ -178,12 +243,12 @@ class OpenFMRIData(object):
             subject_name = kwargs['subname']
 
             # Check whether subject raw directory exists before adding the mapping
-            raw_dirs = glob('{}/*{}*'.format(self.raw_study_dir(), subject_name))
+            raw_dir = self.raw_index().subject_dir(subject_name)
 
-            if len(raw_dirs) == 0:
+            if raw_dir is None:
                 raise BaseException("No subject by the name of {}".format(subject_name))
 
-            raw_dir = raw_dirs[0]
+            raw_dir = os.path.join(self.raw_study_dir(), raw_dir)
 
             if subject_name in self._subject_mapping:
                 subject_code = self._subject_mapping[subject_name]
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import nibabel
+import numpy as np
+from numpy.lib.format import open_memmap
+from AtomicOutput import AtomicOutput
+
+
+def mask_hash(voxel_indices):
+    """
+        Hash of the voxel indices of the features (in feature order)
+    """
+    return hashlib.sha1(np.ascontiguousarray(voxel_indices, dtype=np.int32).tobytes()).hexdigest()[:16]
+
+
+class PermutationStore(object):
+
+    SCORES = 'scores_{:06d}.npy'
+    DONE = 'done_{:06d}.npy'
+    VOXELS = 'voxel_indices.npy'
+    METADATA = 'metadata.json'
+
+    def __init__(self, path):
+        """
+            Searchlight maps of the original labels and of their permutations, a (label sets x voxels) float32
+            array per subject and contrast, kept in a directory in blocks of rows:
+
+                scores_<first row>.npy = (block_rows x voxels) maps, row 0 of the store = the original labels,
+                                         row i = permutation i (NaN until written)
+                done_<first row>.npy = 1 for every row of the block that was written
+                voxel_indices.npy = (voxels x 3) voxel coordinates of the columns
+                metadata.json = shape, block size, mask hash, seed, radius, measure ... of the maps
+
+            A block is created when one of its rows is first written, and a write only opens the blocks of its
+            rows (memory-mapped), so several processes can write disjoint rows at the same time and more
+            permutations can be appended later (see create). Readers load only the rows / voxels they slice.
+
+            Use PermutationStore.create to make a new store, PermutationStore(path) opens an existing one.
+        """
+        self._path = path
+        with open(os.path.join(path, self.METADATA), 'r') as fh:
+            self._metadata = json.load(fh)
+
+    @classmethod
+    def create(cls, path, rows, voxel_indices, metadata=None, block_rows=16):
+        """
+            Creates the store, or opens it when it already exists with the same voxels and metadata
+
+            The store is created in a temporary directory that is renamed to path, renaming a directory onto
+            an existing one fails, so when several writers create the same store at once they all end up
+            with the one that was renamed first.
+
+            An existing store with fewer rows is extended to rows (the permutations of a seed don't depend on
+            their number, so more of them can be appended). Extend a store from a single process.
+
+            Parameters
+                rows = number of label sets (permutations + 1)
+                voxel_indices = (voxels x 3) voxel coordinates of the features
+                metadata = dictionary saved with the maps (seed, radius, measure, affine ...)
+                block_rows = number of rows in a block file (of a new store)
+        """
+        metadata = dict(metadata or dict())
+        metadata.update({'voxels': len(voxel_indices), 'dtype': 'float32', 'mask': mask_hash(voxel_indices)})
+
+        if not os.path.isdir(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            temp_dir = os.path.join(parent, '.tmp-{}-{}'.format(uuid.uuid4().hex[:8], os.path.basename(path)))
+            os.makedirs(temp_dir)
+            try:
+                np.save(os.path.join(temp_dir, cls.VOXELS), np.asarray(voxel_indices, dtype=np.int32))
+                with open(os.path.join(temp_dir, cls.METADATA), 'w') as fh:
+                    json.dump(dict(metadata, shape=[rows, len(voxel_indices)], block_rows=block_rows,
+                                   created=time.strftime('%Y-%m-%d %H:%M:%S')), fh, indent=2, sort_keys=True)
+
+                os.rename(temp_dir, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # another writer created it first
+            finally:
+                if os.path.isdir(temp_dir):
+                    shutil.rmtree(temp_dir)
+
+        store = cls(path)
+        different = [key for key in metadata if store.metadata().get(key) != metadata[key]]
+        if different:
+            raise ValueError("{} exists with a different {}".format(path, ', '.join(sorted(different))))
+        if rows > store.shape()[0]:
+            store.__extend__(rows)
+        return store
+
+    def path(self):
+        return self._path
+
+    def metadata(self):
+        return self._metadata
+
+    def shape(self):
+        return tuple(self._metadata['shape'])
+
+    def block_rows(self):
+        return self._metadata['block_rows']
+
+    def voxel_indices(self):
+        return np.load(os.path.join(self._path, self.VOXELS))
+
+    def done(self):
+        """
+            Boolean array of the rows that were written
+        """
+        done = np.zeros(self.shape()[0], dtype=bool)
+        for first in self.__blocks__():
+            done_file = self.__block_file__(self.DONE, first)
+            if os.path.isfile(done_file):
+                flags = np.load(done_file, mmap_mode='r')
+                done[first:first + len(flags)] = flags[:len(done) - first] > 0
+        return done
+
+    def missing_rows(self, rows=None):
+        """
+            The rows (of rows, default all of them) that weren't written yet
+        """
+        rows = np.arange(self.shape()[0]) if rows is None else np.asarray(rows)
+        return rows[~self.done()[rows]]
+
+    def write(self, rows, values):
+        """
+            Writes rows of maps and marks them done (the scores of a block are flushed before its done flags)
+
+            Parameters
+                rows = row numbers
+                values = (len(rows) x voxels) matrix
+        """
+        rows = np.asarray(rows)
+        values = np.asarray(values, dtype=np.float32)
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.shape()[0]):
+            raise IndexError("rows outside the {} rows of {}".format(self.shape()[0], self._path))
+
+        for first in np.unique(rows - rows % self.block_rows()):
+            in_block = (rows >= first) & (rows < first + self.block_rows())
+            local = rows[in_block] - first
+            self.__create_block__(first)
+
+            scores = open_memmap(self.__block_file__(self.SCORES, first), mode='r+')
+            scores[local] = values[in_block]
+            scores.flush()
+            del scores
+
+            done = open_memmap(self.__block_file__(self.DONE, first), mode='r+')
+            done[local] = 1
+            done.flush()
+            del done
+
+    def read(self, rows=None, voxels=None):
+        """
+            Loads a slice of the maps, only the blocks of the rows are opened
+
+            Parameters
+                rows = row number, row numbers or slice (None = all, row 0 is the original labels)
+                voxels = column numbers (None = all)
+        """
+        selected = np.arange(self.shape()[0])[slice(None) if rows is None else rows]
+        single = np.ndim(selected) == 0
+        selected = np.atleast_1d(selected)
+        columns = np.arange(self.shape()[1]) if voxels is None else np.asarray(voxels)
+
+        values = np.empty((len(selected), len(columns)), dtype=np.float32)
+        values[:] = np.nan
+        for first in np.unique(selected - selected % self.block_rows()):
+            scores_file = self.__block_file__(self.SCORES, first)
+            if not os.path.isfile(scores_file):
+                continue
+            in_block = (selected >= first) & (selected < first + self.block_rows())
+            scores = np.load(scores_file, mmap_mode='r')
+            values[in_block] = scores[np.ix_(selected[in_block] - first, columns)]
+
+        return values[0] if single else values
+
+    def original(self):
+        return self.read(0)
+
+    def permutations(self, voxels=None):
+        return self.read(slice(1, None), voxels)
+
+    def image(self, row=0):
+        """
+            A row as a NIfTI image, with the volume shape and affine of the metadata
+        """
+        if 'voxel_dim' not in self._metadata:
+            raise ValueError("{} has no volume shape in its metadata".format(self._path))
+
+        volume = np.zeros(self._metadata['voxel_dim'], dtype=np.float32)
+        volume[tuple(self.voxel_indices().T)] = self.read(row)
+        return nibabel.Nifti1Image(volume, np.array(self._metadata.get('affine', np.eye(4))))
+
+    def __blocks__(self):
+        return range(0, self.shape()[0], self.block_rows())
+
+    def __block_file__(self, pattern, first):
+        return os.path.join(self._path, pattern.format(first))
+
+    def __create_block__(self, first):
+        """
+            Creates the NaN scores and the done flags of the block starting at row first, unless they exist
+
+            The files are written to temporary names and hard linked to their names: unlike a rename, a link
+            fails when the name exists, so a block another writer created first (and may be writing to) is kept.
+        """
+        for pattern, dtype, fill in [(self.DONE, np.uint8, 0), (self.SCORES, np.float32, np.nan)]:
+            block_file = self.__block_file__(pattern, first)
+            if os.path.isfile(block_file):
+                continue
+
+            shape = (self.block_rows(),) if pattern == self.DONE else (self.block_rows(), self.shape()[1])
+            temp_file = os.path.join(self._path, '.tmp-{}-{}'.format(uuid.uuid4().hex[:8], pattern.format(first)))
+            try:
+                block = open_memmap(temp_file, mode='w+', dtype=dtype, shape=shape)
+                block[:] = fill
+                block.flush()
+                del block
+                try:
+                    os.link(temp_file, block_file)
+                except OSError:
+                    if not os.path.isfile(block_file):
+                        raise
+                    # another writer created it first
+            finally:
+                os.remove(temp_file)
+
+    def __extend__(self, rows):
+        self._metadata['shape'] = [rows, self.shape()[1]]
+        with AtomicOutput(os.path.join(self._path, self.METADATA)) as output:
+            with open(output.temp(), 'w') as fh:
+                json.dump(self._metadata, fh, indent=2, sort_keys=True)
@@ -8,6 +8,15 @@ import signal
 import pre_proc_fromexample as pp
 from SubjectDir import SubjectDir
 from OpenFMRIData import OpenFMRIData
+from Scheduler import SubjectScheduler, RunPool
+from StageCache import StageCache
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data, mask_data
+from Compressor import Compressor, nifti_file
+from Highpass import HighpassFilter, repetition_time
+from SliceTiming import SliceTimer
+from Smoothing import GaussianSmoother
+from Instrumentation import Instrumentation, instrumented
 import nibabel as nib
 import numpy as np
 
@@ -16,9 +25,35 @@ from nipype.interfaces import fsl
 
 class PreProcessing(object):
 
-    def __init__(self, fmri_data, subjects):
+    def __init__(self, fmri_data, subjects, run_jobs=1, memory_limit=None, intermediate_format='NIFTI_GZ',
+                 compress_jobs=None, instrument=True, adopt_legacy=False):
+        """
+            Parameters
+                fmri_data = OpenFMRIData object
+                subjects = list of subject codes or SubjectDir objects
+                run_jobs = number of runs of a subject processed concurrently by the per-run stages
+                memory_limit = bytes the concurrently processed runs may use (None = 75% of the physical memory)
+                intermediate_format = format of the 4D chain (bold_mask -> _mcf -> _hp -> _stc -> _smooth):
+                                      'NIFTI_GZ', or 'NIFTI' to write plain .nii files. With 'NIFTI' only the
+                                      final outputs of the chain are compressed, in the background (see Compressor)
+                compress_jobs = number of files compressed concurrently (None = number of cores)
+                instrument = record the time, CPU, memory and I/O of every stage, run and tool invocation
+                             to study_dir/logs/preprocessing.jsonl (see Instrumentation)
+                adopt_legacy = outputs without a provenance sidecar (made before the sidecars existed) are taken
+                               as up to date instead of being recomputed, whatever parameters made them
+
+            A stage is skipped only when its output was produced from the same inputs with the same parameters
+            (see StageCache), so changing e.g. the BET fraction recomputes the brain extraction and everything
+            that depends on it.
+        """
         self._fmri_data = fmri_data
         self._subjects_list = []
+        self._run_pool = RunPool(run_jobs, memory_limit)
+        self._cache = StageCache(adopt_legacy)
+        self._intermediate_format = intermediate_format
+        self._compress_jobs = compress_jobs
+        self._instrumentation = Instrumentation(
+            os.path.join(fmri_data.study_dir(), 'logs', 'preprocessing.jsonl') if instrument else None)
 
         self.__load_subjects__(subjects)
 
@@ -40,130 +75,307 @@ class PreProcessing(object):
     def add_subject(self, subject_dir):
         self._subjects_list.append(subject_dir)
 
-    def analyze(self, **kwargs):
+    def analyze(self, n_jobs=1, **kwargs):
+        """
+            Runs the preprocessing chain on all the loaded subjects
+
+            Each subject's chain is independent, so with n_jobs > 1 the subjects are processed concurrently
+            in a process pool. A failure of one subject doesn't stop the others, and a per-subject
+            success/failure summary is printed at the end.
+
+            Parameters
+                n_jobs = number of subjects processed concurrently (None = number of cores)
+                kwargs = passed to analyze_subject
+
+            Returns
+                OrderedDict of <subject code, SubjectResult>
+
+            Raises
+                SubjectsFailed (with the results) after all the subjects finished, when any of them failed
+        """
+        if n_jobs != 1:
+            # There is no terminal to approve the brain extraction from inside the pool workers
+            kwargs['automatic_approval'] = True
+
+        return SubjectScheduler(n_jobs).run(self, self._subjects_list, kwargs)
+
+    def analyze_subject(self, subject, **kwargs):
+        """
+            Runs the preprocessing stages of a single subject in order
+
+            Parameters
+                subject = Subject Dir object
+                mc_merge = merge the runs of each task before motion correction
+                time_repetition = TR of data (used by the slice time correction, default: 2 for fsl, from the header
+                                  of every run for the native engine)
+                stc_engine, slice_order = see slice_time_correction
+                fwhm, brightness_threshold = when both are given the data is smoothed (the native engine needs
+                                             only fwhm)
+                smoothing_engine = 'susan' or 'native' (see functional_smoothing)
+                func_seg = segment the functional images instead of the anatomy
+                automatic_approval = skip the fslview approval of the brain extraction
+                fused_chain = motion correct the unmasked runs and do the masking, intensity normalisation and
+                              highpass in one native stage (see mask_intnorm_highpass) instead of applymask_bold
+                              and highpassfilter
+        """
+        print "Started:{}".format(subject)
 
         # Brain Extraction and bias field estimation
-        for subject in self._subjects_list:
-            print "Started:{}".format(subject)
-            brain_image = self.extract_brain(subject)
-            anat_image = self.estimate_bias_field(subject, brain_image)
-
-        # Motion Correction
-        for subject in self._subjects_list:
-            if 'mc_merge' in kwargs:
-                self.motion_correction(subject, kwargs['mc_merge'])
-            else:
-                self.motion_correction(subject)
+        brain_image = self.extract_brain(subject, automatic_approval=kwargs.get('automatic_approval', False))
+        anat_image = self.estimate_bias_field(subject, brain_image)
 
-        # Slice‐time correction
-        for subject in self._subjects_list:
-            self.slice_time_correction(subject)
+        # The deliverables of the functional chain are compressed while the registration and segmentation run
+        compressor = Compressor(self._compress_jobs, self._cache)
 
-        # Spatial  filtering  ( Smoothing)
-        if('fwhm' in kwargs and 'brightness_threshold' in kwargs):
-            for subject in self._subjects_list:
-                self.anatomical_smoothing(subject,kwargs['fwhm'],kwargs['brightness_threshold'])
-                self.functional_smoothing(subject,kwargs['fwhm'],kwargs['brightness_threshold'])
+        try:
+            fused_chain = kwargs.get('fused_chain', False)
+            if not fused_chain:
+                self.applymask_bold(subject)
+
+            # Motion Correction
+            self.motion_correction(subject, kwargs.get('mc_merge', False), 'bold' if fused_chain else 'bold_mask')
 
-        # Anatomical Registration
-        for subject in self._subjects_list:
+            # Temporal filtering and Slice-time correction
+            if fused_chain:
+                self.mask_intnorm_highpass(subject)
+            else:
+                self.highpassfilter(subject)
+            # the native engine reads the TR of every run from its header unless it is given
+            stc_engine = kwargs.get('stc_engine', 'fsl')
+            self.slice_time_correction(subject, kwargs.get('time_repetition', 2 if stc_engine == 'fsl' else None),
+                                       stc_engine, kwargs.get('slice_order'))
+            deliverables = self.__run_files__(subject, 'bold_mask_mcf_hp_stc')
+
+            # Spatial  filtering  ( Smoothing)
+            smoothing_engine = kwargs.get('smoothing_engine', 'susan')
+            if('fwhm' in kwargs and ('brightness_threshold' in kwargs or smoothing_engine == 'native')):
+                self.anatomical_smoothing(subject,kwargs['fwhm'],kwargs.get('brightness_threshold'),
+                                          engine=smoothing_engine)
+                self.functional_smoothing(subject,kwargs['fwhm'],kwargs.get('brightness_threshold'),
+                                          engine=smoothing_engine)
+                deliverables += self.__run_files__(subject, 'bold_mcf_hp_stc_smooth_{}mm'.format(kwargs['fwhm']))
+
+            compressor.submit(deliverables)
+
+            # Anatomical Registration
             self.anatomical_registration(subject)
 
-        # Functional Registration
-        for subject in self._subjects_list:
+            # Functional Registration
             self.functional_registration(subject)
 
-        # Segmentation
-        for subject in self._subjects_list:
+            # Segmentation
             if 'func_seg' in kwargs:
                 self.functional_segmentation(subject)
             else:
                 self.segmentation(subject)
                 self.generate_functional_gm_masks(subject)
+        finally:
+            compressor.join()
 
+        compressor.report({'applymask': self.__run_files__(subject, 'bold_mask'),
+                           'motion_correction': self.__run_files__(subject, 'bold_mcf' if fused_chain else 'bold_mask_mcf'),
+                           'highpass': self.__run_files__(subject, 'bold_mask_mcf_hp')})
+
+    @instrumented('functional_gm_mask')
     def generate_functional_gm_masks(self, subject):
         print ">>> Creating functional gray matter masks"
 
         mask_name = 'grey.nii.gz'
         gm_mask = os.path.join(subject.masks_dir(), 'anatomy', mask_name)
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
-                run_name = directory.split('/')[-1]
-                reg_dir = os.path.join(directory, 'reg')
 
-                gm2func_mask = fsl.preprocess.ApplyXfm()
-                gm2func_mask.inputs.in_matrix_file = os.path.join(
-                    reg_dir, 'highres2example_func.mat')
-                gm2func_mask.inputs.reference = os.path.join(
-                    reg_dir, 'example_func.nii.gz')
-                gm2func_mask.inputs.in_file = gm_mask
-                gm2func_mask.inputs.out_file = os.path.join(
-                    subject.masks_dir(), run_name, mask_name)
-                gm2func_mask.run()
+        def process(directory):
+            run_name = directory.split('/')[-1]
+            reg_dir = os.path.join(directory, 'reg')
 
+            gm2func_mask = fsl.preprocess.ApplyXfm()
+            gm2func_mask.inputs.in_matrix_file = os.path.join(
+                reg_dir, 'highres2example_func.mat')
+            gm2func_mask.inputs.reference = os.path.join(
+                reg_dir, 'example_func.nii.gz')
+            gm2func_mask.inputs.in_file = gm_mask
+            gm2func_mask.inputs.out_file = os.path.join(
+                subject.masks_dir(), run_name, mask_name)
 
-    def highpassfilter(self, subject):
+            inputs = [gm_mask, gm2func_mask.inputs.in_matrix_file, gm2func_mask.inputs.reference]
+            if self._cache.is_current(gm2func_mask.inputs.out_file, 'functional_gm_mask', inputs, {}):
+                return
 
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
+            self._instrumentation.run_tool(gm2func_mask)
+            self._cache.record(gm2func_mask.inputs.out_file, 'functional_gm_mask', inputs, {})
 
-                bold_file = os.path.join(directory, 'bold_mask_mcf.nii.gz')
-                hp_file = bold_file.replace('.nii.gz', '_hp.nii.gz')
+        self.__for_each_run__(subject, process, os.path.join('reg', 'example_func.nii.gz'))
 
-                if os.path.isfile(hp_file):
-                    print ">>>> High Pass Filtering has already been performed for {}".format(directory)
-                    continue
+    @instrumented('highpass')
+    def highpassfilter(self, subject, highpass_sigma=28, cutoff=None, engine='fsl', method='running_line',
+                       keep_mean=False):
+        """
+            High pass temporal filtering
+
+            Outputs:
+                BOLD/*run_name*/bold_mask_mcf_hp.nii.gz
 
+            Parameters
+                subject = Subject Dir object
+                highpass_sigma = sd of the running line in volumes (used when cutoff is None)
+                cutoff = cutoff period in seconds, the sigma of every run is cutoff / (2 * TR) with the TR
+                         from the header of the run
+                engine = 'fsl' (fslmaths -bptf) or 'native' (see Highpass, filters the brain voxels only)
+                method = 'running_line' (as fslmaths) or 'dct', native engine only
+                keep_mean = add the temporal mean back (as FEAT does after fslmaths), native engine only
+        """
+        if engine == 'fsl' and method != 'running_line':
+            raise ValueError("fslmaths supports only the running line highpass")
+        if engine == 'fsl' and keep_mean:
+            raise ValueError("fslmaths removes the temporal mean, keep_mean requires the native engine")
+
+        def process(directory):
+            bold_file = self.__run_file__(directory, 'bold_mask_mcf')
+            hp_file = self.__run_file__(directory, 'bold_mask_mcf_hp')
+
+            sigma = highpass_sigma  #in volumes
+            if cutoff is not None:
+                sigma = cutoff / (2.0 * repetition_time(nibabel.load(bold_file)))
+            params = {'highpass_sigma': sigma}
+            if engine != 'fsl':
+                # fslmaths outputs recorded before there were engines stay current
+                params.update({'engine': engine, 'method': method, 'keep_mean': keep_mean})
+
+            if self._cache.is_current(hp_file, 'highpass', [bold_file], params):
+                print ">>>> High Pass Filtering has already been performed for {}".format(directory)
+                return
+
+            print ">>>> High Pass Filtering {}".format(bold_file)
+            if engine == 'native':
+                HighpassFilter(sigma=sigma, method=method, keep_mean=keep_mean).filter_image(bold_file, hp_file)
+            else:
                 filter = fsl.maths.TemporalFilter()
                 filter.inputs.in_file = bold_file
-                filter.inputs.out_file = hp_file
-                filter.inputs.highpass_sigma = 28  #in volumes
-                #TODO change to hardcoded sigma
+                filter.inputs.highpass_sigma = sigma
+                filter.inputs.output_type = self._intermediate_format
 
-                print ">>>> High Pass Filtering {}".format(bold_file)
-                filter.run()
+                with AtomicOutput(hp_file) as output:
+                    filter.inputs.out_file = output.temp()
+                    self._instrumentation.run_tool(filter)
+            self._cache.record(hp_file, 'highpass', [bold_file], params)
 
-    def slice_time_correction(self,subject,time_repetition):
+        self.__for_each_run__(subject, process, 'bold_mask_mcf')
+
+    @instrumented('mask_intnorm_highpass')
+    def mask_intnorm_highpass(self, subject, highpass_sigma=28, intnorm=True, grand_mean=10000, cutoff=None,
+                              method='running_line', keep_mean=False):
         """
-            Slice Time Correction
+            Brain masking, grand mean intensity normalisation and highpass filtering in a single pass
+
+            The motion corrected run is read once, the three voxelwise steps are done on the in-mask voxels only
+            (see Highpass for the filter, the fslmaths -bptf running line) and a single file is written,
+            instead of applymask_bold / the intnorm of the example pipeline / highpassfilter each reading and
+            writing the whole 4D run.
 
             Outputs:
-                 BOLD/*run_name*/bold_stc.nii.gz
+                BOLD/*run_name*/bold_mask_mcf_hp.nii.gz (the name the separate stages give it)
 
             Parameters
                 subject = Subject Dir object
-                time_repetition = TR of data
-
+                highpass_sigma = sd of the highpass running line, in volumes
+                intnorm = scale the run so the median of the in-mask voxels is grand_mean
+                grand_mean = the target median
+                cutoff, method, keep_mean = see highpassfilter
         """
-        print ">>> Slice Time Correction"
+        print ">>> Masking, intensity normalisation and high pass filtering"
 
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
+        mask_file = os.path.join(subject.masks_dir(), 'anatomy', 'brain.nii.gz')
+        highpass = HighpassFilter(sigma=highpass_sigma if cutoff is None else None, cutoff=cutoff, method=method,
+                                  keep_mean=keep_mean)
 
-                bold_file = os.path.join(directory, 'bold_mask_mcf_hp.nii.gz')
-                stc_file = bold_file.replace('.nii.gz', '_stc.nii.gz')
+        def process(directory):
+            bold_file = self.__run_file__(directory, 'bold_mcf')
+            hp_file = self.__run_file__(directory, 'bold_mask_mcf_hp')
+            bold = nibabel.load(bold_file)
+            params = {'highpass_sigma': highpass.sigma(repetition_time(bold)), 'method': method, 'keep_mean': keep_mean,
+                      'intnorm': intnorm, 'grand_mean': grand_mean}
 
-                if os.path.isfile(stc_file):
-                    print ">>>> STC has already been performed for {}".format(directory)
-                    continue
+            if self._cache.is_current(hp_file, 'mask_intnorm_highpass', [bold_file, mask_file], params):
+                print ">>>> Masking and High Pass Filtering have already been performed for {}".format(directory)
+                return
+
+            print ">>>> Masking and High Pass Filtering {}".format(bold_file)
+            brain_mask = mask_data(mask_file)
+            if brain_mask.shape != bold.shape[:3]:
+                raise Exception("{} doesn't match the dimensions of {}".format(mask_file, bold_file))
+
+            data = np.zeros(bold.shape, dtype=np.float32)
+            # (time x voxels) matrix of the brain
+            brain_data = float32_data(bold)[brain_mask].T
+
+            if intnorm:
+                brain_data *= grand_mean / np.median(brain_data)
 
-                st = fsl.SliceTimer()
-                st.inputs.in_file = bold_file
-                st.inputs.out_file = stc_file
-                st.inputs.interleaved = True
-                st.inputs.time_repetition = time_repetition # TR of data
-                #st.inputs.slice_direction = 3 # direction of slice acquisition (x=1, y=2, z=3) - default is z
-                #st.inputs.global_shift = 0.5 # shift in fraction of TR, range 0:1 (default is 0.5 = no shift)
+            data[brain_mask] = highpass.filter(brain_data, repetition_time(bold)).T
 
-                try:
-                    self.__beforechange__(bold_file,'stc')
-                    result = st.run()
-                    self.__afterchange__(bold_file,stc_file,'stc',True)
-                except Exception as ex:
-                    print ex
-                    self.__afterchange__(bold_file,stc_file,'stc',False)
+            out_img = nibabel.Nifti1Image(data, bold.affine, bold.header.copy())
+            out_img.set_data_dtype(np.float32)
+            with AtomicOutput(hp_file) as output:
+                nibabel.save(out_img, output.temp())
+            self._cache.record(hp_file, 'mask_intnorm_highpass', [bold_file, mask_file], params)
+
+        self.__for_each_run__(subject, process, 'bold_mcf')
+
+    @instrumented('slice_time_correction')
+    def slice_time_correction(self,subject,time_repetition,engine='fsl',slice_order=None):
+        """
+            Slice Time Correction
+
+            Outputs:
+                 BOLD/*run_name*/bold_mask_mcf_hp_stc.nii.gz
+
+            Parameters
+                subject = Subject Dir object
+                time_repetition = TR of data (native engine: None = from the header of the run)
+                engine = 'fsl' (slicetimer, interleaved) or 'native' (see SliceTiming: the slice times come from
+                         slice_order, the run's JSON sidecar (bold.json) or NIfTI header, and default to interleaved)
+                slice_order = slice indices (0 based) in the order of acquisition, native engine only
 
-    def anatomical_smoothing(self,subject,fwhm,brightness_threshold,use_median = True):
+        """
+        print ">>> Slice Time Correction"
+
+        slice_timer = SliceTimer(time_repetition, slice_order)
+
+        def process(directory):
+            bold_file = self.__run_file__(directory, 'bold_mask_mcf_hp')
+            stc_file = self.__run_file__(directory, 'bold_mask_mcf_hp_stc')
+            sidecar = os.path.join(directory, 'bold.json')
+            params = {'interleaved': True, 'time_repetition': time_repetition}
+            if engine == 'native':
+                times, tr, slice_axis, source = slice_timer.slice_times(bold_file, sidecar=sidecar)
+                params = {'engine': engine, 'slice_times': list(times), 'time_repetition': tr, 'slice_axis': slice_axis}
+
+            if self._cache.is_current(stc_file, 'slice_time_correction', [bold_file], params):
+                print ">>>> STC has already been performed for {}".format(directory)
+                return
+
+            if engine == 'native':
+                slice_timer.correct_image(bold_file, stc_file, sidecar=sidecar)
+                self._cache.record(stc_file, 'slice_time_correction', [bold_file], params)
+                return
+
+            st = fsl.SliceTimer()
+            st.inputs.in_file = bold_file
+            st.inputs.interleaved = True
+            st.inputs.time_repetition = time_repetition # TR of data
+            st.inputs.output_type = self._intermediate_format
+            #st.inputs.slice_direction = 3 # direction of slice acquisition (x=1, y=2, z=3) - default is z
+            #st.inputs.global_shift = 0.5 # shift in fraction of TR, range 0:1 (default is 0.5 = no shift)
+
+            # a failure is raised by the run pool after the other runs, and fails the subject
+            with AtomicOutput(stc_file) as output:
+                st.inputs.out_file = output.temp()
+                self._instrumentation.run_tool(st)
+            self._cache.record(stc_file, 'slice_time_correction', [bold_file], params)
+
+        self.__for_each_run__(subject, process, 'bold_mask_mcf_hp')
+
+    @instrumented('anatomical_smoothing')
+    def anatomical_smoothing(self,subject,fwhm,brightness_threshold,use_median = True,engine = 'susan',mask_normalized = False):
         """
             Using SUSAN to perform smoothing
 
@@ -177,19 +389,26 @@ class PreProcessing(object):
                                        than contrast of edges to be preserved.
                 use_median = whether to use a local median filter in the cases where single-point
                              noise is detected
+                engine = 'susan' or 'native' (separable Gaussian, see Smoothing - brightness_threshold and
+                         use_median don't apply)
+                mask_normalized = native engine: smooth within the non zero voxels only
 
         """
         print ">>> Anatomical Smoothing"
 
         anat_file = subject.anatomical_nii()
         smooth_file = subject.anatomical_nii('smooth')
+        params = self.__smoothing_params__(fwhm, brightness_threshold, use_median, engine, mask_normalized)
 
-        if not os.path.isfile(smooth_file):
-             self.__smoothing__(anat_file,smooth_file,fwhm,brightness_threshold,use_median)
+        if not self._cache.is_current(smooth_file, 'smoothing', [anat_file], params):
+             self.__smoothing__(anat_file,smooth_file,fwhm,brightness_threshold,use_median,
+                                engine=engine,mask_normalized=mask_normalized)
+             self._cache.record(smooth_file, 'smoothing', [anat_file], params)
         else:
             print(">>>> Already performed")
 
-    def functional_smoothing(self,subject,fwhm,brightness_threshold,use_median = True):
+    @instrumented('functional_smoothing')
+    def functional_smoothing(self,subject,fwhm,brightness_threshold,use_median = True,engine = 'susan',mask_normalized = False):
         """
             Using SUSAN to perform smoothing
 
@@ -203,21 +422,28 @@ class PreProcessing(object):
                                        than contrast of edges to be preserved.
                 use_median = whether to use a local median filter in the cases where single-point
                              noise is detected
+                engine = 'susan' or 'native' (separable Gaussian, see Smoothing - brightness_threshold and
+                         use_median don't apply)
+                mask_normalized = native engine: smooth within the non zero voxels only
 
         """
         print ">>> Functional Smoothing"
 
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
+        def process(directory):
+            bold_file = self.__run_file__(directory, 'bold_mask_mcf_hp_stc')
+            smooth_file = self.__run_file__(directory, 'bold_mcf_hp_stc_smooth_{}mm'.format(fwhm))
+            params = self.__smoothing_params__(fwhm, brightness_threshold, use_median, engine, mask_normalized)
 
-                bold_file = os.path.join(directory, 'bold_mcf_hp_stc.nii.gz')
-                smooth_file = os.path.join(directory, 'bold_mcf_hp_stc_smooth_{}mm.nii.gz'.format(fwhm))
+            if not self._cache.is_current(smooth_file, 'smoothing', [bold_file], params):
+                self.__smoothing__(bold_file,smooth_file,fwhm,brightness_threshold,use_median,
+                                   self._intermediate_format,engine,mask_normalized)
+                self._cache.record(smooth_file, 'smoothing', [bold_file], params)
+            else:
+                print ">>>> Smoothing has already been performed for {}".format(directory)
 
-                if not os.path.isfile(smooth_file):
-                    self.__smoothing__(bold_file,smooth_file,fwhm,brightness_threshold,use_median)
-                else:
-                    print ">>>> Smoothing has already been performed for {}".format(directory)
+        self.__for_each_run__(subject, process, 'bold_mask_mcf_hp_stc')
 
+    @instrumented('functional_registration')
     def functional_registration(self, subject):
         """
             Functional Registration
@@ -236,71 +462,76 @@ class PreProcessing(object):
 
         brain_image = subject.anatomical_nii('brain')
 
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
-                bold_file = os.path.join(directory, 'bold_mcf.nii.gz')
-                bold_length = nibabel.load(bold_file).shape[3]
-                reg_dir = os.path.join(directory, 'reg')
-                if os.path.isfile(
-                    os.path.join(
-                        reg_dir,
-                        'highres2example_func.mat')):
-                    print ">>>> Registration has already been performed for {}".format(directory)
-                    continue
-
-                print ">>>> Working on {}".format(directory)
-                if not os.path.isdir(reg_dir):
-                    os.mkdir(reg_dir)
-                else:
-                    shutil.rmtree(reg_dir)
+        def process(directory):
+            bold_file = self.__run_file__(directory, 'bold_mcf')
+            bold_length = nibabel.load(bold_file).shape[3]
+            reg_dir = os.path.join(directory, 'reg')
+            reg_mat = os.path.join(reg_dir, 'highres2example_func.mat')
+            inputs = [bold_file, brain_image,
+                      os.path.join(subject.anatomical_dir(), 'reg', 'highres2standard_warp.nii.gz')]
+            if self._cache.is_current(reg_mat, 'functional_registration', inputs, {}):
+                print ">>>> Registration has already been performed for {}".format(directory)
+                return
+
+            print ">>>> Working on {}".format(directory)
+            if not os.path.isdir(reg_dir):
+                os.mkdir(reg_dir)
+            else:
+                shutil.rmtree(reg_dir)
 
-                log_file = os.path.join(directory, 'log_reg')
-                mid_file = os.path.join(directory, 'mid_func.nii.gz')
+            log_file = os.path.join(directory, 'log_reg')
+            mid_file = os.path.join(directory, 'mid_func.nii.gz')
 
-                # Uses FSL Fslroi command to extract region of interest (ROI) from an image.
-                extract_mid = fsl.ExtractROI(in_file=bold_file,
-                                             roi_file=mid_file, # Output
-                                             t_min=bold_length / 2, # Time (middle)
-                                             t_size=1)
-                result = extract_mid.run()
+            # Uses FSL Fslroi command to extract region of interest (ROI) from an image.
+            extract_mid = fsl.ExtractROI(in_file=bold_file,
+                                         roi_file=mid_file, # Output
+                                         t_min=bold_length / 2, # Time (middle)
+                                         t_size=1)
+            result = self._instrumentation.run_tool(extract_mid)
 #				cmd = 'mainfeatreg -F 6.00 -d {} -l {} -i {} -h {} -w BBR -x 90 > /dev/null'.format(directory,log_file,mid_file, brain_image)
 
-                #  Mainfeatreg performs the registrations for FEAT ( as well as some fieldmap related operations )
-                cmd = 'mainfeatreg -F 6.00 -d {} -l {} -i {} -h {} -w 6 -x 90  > /dev/null'.format(
-                    directory, log_file, mid_file, brain_image)
+            #  Mainfeatreg performs the registrations for FEAT ( as well as some fieldmap related operations )
+            cmd = 'mainfeatreg -F 6.00 -d {} -l {} -i {} -h {} -w 6 -x 90  > /dev/null'.format(
+                directory, log_file, mid_file, brain_image)
+            with self._instrumentation.measure(subject, tool='mainfeatreg'):
                 subprocess.call(cmd, shell=True)
 
-                anat_reg_dir = os.path.join(subject.anatomical_dir(), 'reg')
-                highres2mni_mat = os.path.join(
-                    anat_reg_dir, 'highres2standard.mat')
-                highres2standard_warp = os.path.join(
-                    anat_reg_dir, 'highres2standard_warp.nii.gz')
-                example_func2highres_mat = os.path.join(
-                    reg_dir, 'example_func2highres.mat')
-                example_func2standard_warp = os.path.join(
-                    reg_dir, 'example_func2standard_warp.nii.gz')
-
-                standard_image = fsl.Info.standard_image(
-                    'MNI152_T1_2mm_brain.nii.gz')
-
-                # combining multiple transforms into one.
-                convert_warp = fsl.utils.ConvertWarp(
-                    reference=standard_image,
-                    premat=example_func2highres_mat, # filename for pre-transform (affine matrix)
-                    warp1=highres2standard_warp, #  Name of file containing initial warp-fields/coefficients
-                    out_file=example_func2standard_warp)
-                convert_warp.run()
-
-                # Use applywarp to apply the results of a FNIRT registration
-                apply_warp = fsl.preprocess.ApplyWarp(
-                    ref_file=standard_image,
-                    in_file=mid_file,
-                    field_file=example_func2standard_warp, # file containing warp field
-                    out_file=os.path.join(
-                        reg_dir,
-                        'example_func2standard.nii.gz'))
-                apply_warp.run()
-
+            anat_reg_dir = os.path.join(subject.anatomical_dir(), 'reg')
+            highres2mni_mat = os.path.join(
+                anat_reg_dir, 'highres2standard.mat')
+            highres2standard_warp = os.path.join(
+                anat_reg_dir, 'highres2standard_warp.nii.gz')
+            example_func2highres_mat = os.path.join(
+                reg_dir, 'example_func2highres.mat')
+            example_func2standard_warp = os.path.join(
+                reg_dir, 'example_func2standard_warp.nii.gz')
+
+            standard_image = fsl.Info.standard_image(
+                'MNI152_T1_2mm_brain.nii.gz')
+
+            # combining multiple transforms into one.
+            convert_warp = fsl.utils.ConvertWarp(
+                reference=standard_image,
+                premat=example_func2highres_mat, # filename for pre-transform (affine matrix)
+                warp1=highres2standard_warp, #  Name of file containing initial warp-fields/coefficients
+                out_file=example_func2standard_warp)
+            self._instrumentation.run_tool(convert_warp)
+
+            # Use applywarp to apply the results of a FNIRT registration
+            apply_warp = fsl.preprocess.ApplyWarp(
+                ref_file=standard_image,
+                in_file=mid_file,
+                field_file=example_func2standard_warp, # file containing warp field
+                out_file=os.path.join(
+                    reg_dir,
+                    'example_func2standard.nii.gz'))
+            self._instrumentation.run_tool(apply_warp)
+
+            self._cache.record(reg_mat, 'functional_registration', inputs, {})
+
+        self.__for_each_run__(subject, process, 'bold_mcf')
+
+    @instrumented('anatomical_registration')
     def anatomical_registration(self, subject, standard_image_name='MNI152_T1_2mm_brain.nii.gz' ):
         """
             Anatomical Registration
@@ -328,10 +559,12 @@ class PreProcessing(object):
         out_mat_file = os.path.join(reg_dir, 'highres2standard.mat')
 
         standard_image = fsl.Info.standard_image(standard_image_name)
+        flirt_inputs = [brain_image, standard_image]
 
-        if not os.path.isfile(out_mat_file):
+        if not self._cache.is_current(out_mat_file, 'flirt', flirt_inputs, {}):
             print ">>>> FLIRT"
-            os.mkdir(reg_dir)
+            if not os.path.isdir(reg_dir):
+                os.mkdir(reg_dir)
             flirt = fsl.FLIRT(in_file=brain_image,
                               reference=standard_image,
                               out_file=out_file,
@@ -342,7 +575,8 @@ class PreProcessing(object):
                               searchr_y=[-90, 90], # search angles along y-axis, in degrees
                               searchr_z=[-90, 90], # search angles along z-axis, in degrees
                               interp='trilinear') # 'trilinear' or 'nearestneighbour' or 'sinc' or 'spline'
-            flirt.run()
+            self._instrumentation.run_tool(flirt)
+            self._cache.record(out_mat_file, 'flirt', flirt_inputs, {})
         else:
             print(">>>> FLIRT has already been performed")
 
@@ -356,7 +590,9 @@ class PreProcessing(object):
         standard_mask = fsl.Info.standard_image(
             'MNI152_T1_2mm_brain_mask_dil.nii.gz')
 
-        if not os.path.isfile(output_fielf_coeff):
+        fnirt_inputs = [anatomical_head, out_mat_file, standard_head, standard_mask]
+
+        if not self._cache.is_current(output_fielf_coeff, 'fnirt', fnirt_inputs, {}):
             print ">>>> FNIRT"
             # non-linear registration.
             fnirt = fsl.FNIRT(warped_file=out_file, # warped image
@@ -367,13 +603,15 @@ class PreProcessing(object):
                               config_file='T1_2_MNI152_2mm', # 'T1_2_MNI152_2mm' or 'FA_2_FMRIB58_1mm'
                               ref_file=standard_head, # name of reference image
                               refmask_file=standard_mask) # name of file with mask in reference space
-            fnirt.run()
+            self._instrumentation.run_tool(fnirt)
+            self._cache.record(output_fielf_coeff, 'fnirt', fnirt_inputs, {})
             cmd = 'fslview {} {} -t 0.5 '.format(standard_image, out_file)
             pro = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                    shell=True, preexec_fn=os.setsid)
         else:
             print(">>>> FNIRT has already been performed")
 
+    @instrumented('functional_segmentation')
     def functional_segmentation(self, subject):
         """
             Functional Segmentation
@@ -387,44 +625,43 @@ class PreProcessing(object):
         """
         print ">>> Functional Segmentation"
 
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in directories:
-                run_name = directory.split('/')[-1]
-                gm_mask_name = os.path.join(
-                    subject.masks_dir(), run_name, 'grey.nii.gz')
-
-                if os.path.isfile(gm_mask_name):
-                    continue
-
-                bold_file = os.path.join(directory, 'mid_func.nii.gz')
-                out_basename = os.path.join(
-                    subject.masks_dir(), run_name, 'seg')
-
-                # Fixing FAST bug
-                lastcwd = os.getcwd()
-                os.chdir(directory)
-
-                fast = fsl.FAST(in_files=bold_file,
-                                out_basename=out_basename,
-                                img_type=2,
-                                number_classes=3,
-                                hyper=0.1,
-                                output_biascorrected=True,
-                                output_biasfield=True,
-                                bias_iters=5,
-                                iters_afterbias=2,
-                                segments=True)
-                try:
-                    result = fast.run()
-                    os.chdir(lastcwd)
-                    gm_pve_file = result.outputs.partial_volume_files[0]
-                except:
-                    gm_pve_file = '{}_pve_0.nii.gz'.format(out_basename)
-                try:
-                    os.rename(gm_pve_file, gm_mask_name)
-                except:
-                    pass
-
+        def process(directory):
+            run_name = directory.split('/')[-1]
+            gm_mask_name = os.path.join(
+                subject.masks_dir(), run_name, 'grey.nii.gz')
+            bold_file = os.path.join(directory, 'mid_func.nii.gz')
+
+            if self._cache.is_current(gm_mask_name, 'functional_segmentation', [bold_file], {}):
+                return
+
+            out_basename = os.path.join(
+                subject.masks_dir(), run_name, 'seg')
+
+            fast = fsl.FAST(in_files=bold_file,
+                            out_basename=out_basename,
+                            img_type=2,
+                            number_classes=3,
+                            hyper=0.1,
+                            output_biascorrected=True,
+                            output_biasfield=True,
+                            bias_iters=5,
+                            iters_afterbias=2,
+                            segments=True)
+
+            # Fixing FAST bug - it has to run from the run directory. The runs share the process's cwd,
+            # so instead of os.chdir we start the command line from the run directory
+            with self._instrumentation.measure(subject, tool='FAST'):
+                subprocess.call(fast.cmdline, shell=True, cwd=directory)
+            gm_pve_file = '{}_pve_0.nii.gz'.format(out_basename)
+            try:
+                os.rename(gm_pve_file, gm_mask_name)
+                self._cache.record(gm_mask_name, 'functional_segmentation', [bold_file], {})
+            except:
+                pass
+
+        self.__for_each_run__(subject, process, 'mid_func.nii.gz')
+
+    @instrumented('segmentation')
     def segmentation(self, subject):
         """
             Segmentation
@@ -440,10 +677,13 @@ class PreProcessing(object):
 
         gm_mask_name = os.path.join(
             subject.masks_dir(), 'anatomy', 'grey.nii.gz')
-        if os.path.isfile(gm_mask_name):
+        brain_image = subject.anatomical_nii("brain")
+
+        if self._cache.is_current(gm_mask_name, 'segmentation', [brain_image], {}):
             return
 
-        brain_image = subject.anatomical_nii("brain")
+        gm_seg_file = os.path.join(
+            subject.masks_dir(), 'anatomy', 'seg_seg_1.nii.gz')
 
         # Fixing FAST bug
         lastcwd = os.getcwd()
@@ -460,14 +700,12 @@ class PreProcessing(object):
             segments=True)
 
         try:
-            result = fast.run()
+            result = self._instrumentation.run_tool(fast)
             os.chdir(lastcwd)
             gm_pve_file = result.outputs.partial_volume_files[1]
         except:
             gm_pve_file = os.path.join(
                 subject.masks_dir(), 'anatomy', 'seg_pve_1.nii.gz')
-            gm_seg_file = os.path.join(
-                subject.masks_dir(), 'anatomy', 'seg_seg_1.nii.gz')
 
         if False:
             cmd = 'fslview {} {} -l Red -t 0.1 -b 0,0.1'.format(
@@ -481,10 +719,13 @@ class PreProcessing(object):
                 in_file=gm_pve_file,
                 op_string='-thr {} -bin'.format(thr),
                 out_file=gm_mask_name)
-            gen_mask.run()
+            self._instrumentation.run_tool(gen_mask)
         else:
             os.rename(gm_seg_file, gm_mask_name)
 
+        self._cache.record(gm_mask_name, 'segmentation', [brain_image], {})
+
+    @instrumented('bias_field')
     def estimate_bias_field(self, subject, brain_image, overwrite=False):
         """
             Bias field estimation
@@ -510,37 +751,37 @@ class PreProcessing(object):
         anat_filename = subject.anatomical_nii()
         restore_file = subject.anatomical_nii('restore')
 
-        if not overwrite and os.path.isfile(restore_file):
+        if not overwrite and self._cache.is_current(restore_file, 'bias_field', [brain_image], {}):
             print(">>>> Already performed")
             return anat_filename
 
         try:
-
-            self.__beforechange__(anat_filename,'restore')
-
             lastcwd = os.getcwd()
             os.chdir(subject.anatomical_dir())
-            fast = fsl.FAST(in_files=brain_image,                            
-                            out_basename=subject.anatomical_nii()[:-7],  # removing '.nii.gz'
-                            bias_lowpass=10,  # bias field smoothing extent (FWHM) in mm
-                            output_biascorrected=True,  # output restored image (bias-corrected image)
-                            output_biasfield=True,  # output estimated bias field
-                            img_type=1,  # T1
-                            bias_iters=5,  # number of main-loop iterations during bias-field removal
-                            no_pve=True,  # turn off PVE (partial volume estimation)
-                            iters_afterbias=1)  # number of main-loop iterations after bias-field removal
-
-            fast = fast.run()
+
+            # FAST names all its outputs (_restore, _bias, _seg) after the basename, so they are all committed together
+            with AtomicOutput(restore_file) as output:
+                fast = fsl.FAST(in_files=brain_image,
+                                out_basename=output.temp(subject.anatomical_nii()[:-7]),  # removing '.nii.gz'
+                                bias_lowpass=10,  # bias field smoothing extent (FWHM) in mm
+                                output_biascorrected=True,  # output restored image (bias-corrected image)
+                                output_biasfield=True,  # output estimated bias field
+                                img_type=1,  # T1
+                                bias_iters=5,  # number of main-loop iterations during bias-field removal
+                                no_pve=True,  # turn off PVE (partial volume estimation)
+                                iters_afterbias=1)  # number of main-loop iterations after bias-field removal
+
+                fast = self._instrumentation.run_tool(fast)
             os.chdir(lastcwd)
 
-            self.__afterchange__(anat_filename,fast.outputs.restored_image,'restore',True)
+            self._cache.record(restore_file, 'bias_field', [brain_image], {})
 
             return anat_filename
         except Exception as ex:
             print ex
-            self.__afterchange__(anat_filename,restore_file,'restore',False)
             return anat_filename
 
+    @instrumented('extract_brain')
     def extract_brain(self, subject, overwrite=False, f=0.3, g=-0.1, automatic_approval = False):
         """
             Brain Extraction
@@ -563,12 +804,13 @@ class PreProcessing(object):
 
         # Check whether brain has already been extracted
         brain_image = subject.anatomical_nii('brain')
+        brain_mask = os.path.join(subject.masks_dir(), 'anatomy', 'brain.nii.gz')
+        input_image = subject.anatomical_nii()
+        params = {'frac': f, 'vertical_gradient': g}
 
-        if not overwrite and os.path.isfile(brain_image):
+        if not overwrite and self._cache.is_current(brain_image, 'extract_brain', [input_image], params):
             print(">>>> Already performed")
             return brain_image
-
-        input_image = subject.anatomical_nii()
         
         bet = fsl.BET(in_file=input_image,
                       out_file=brain_image,
@@ -579,7 +821,7 @@ class PreProcessing(object):
                       frac=f,  # fractional intensity threshold
                       vertical_gradient=g)  # vertical gradient in fractional intensity threshold (-1, 1)
 
-        result = bet.run()
+        result = self._instrumentation.run_tool(bet)
 
         if(not automatic_approval):
             is_ok = 'n'
@@ -602,45 +844,52 @@ class PreProcessing(object):
                         raw_input(
                             "Set gradient: default is previous ({})\n".format(
                                 bet.inputs.vertical_gradient)) or bet.inputs.vertical_gradient)
-                    result = bet.run()
+                    result = self._instrumentation.run_tool(bet)
                 os.killpg(pro.pid, signal.SIGTERM)
 
         # Saves the anatomical brain after mask to the mask directory
-        os.rename(subject.anatomical_nii('brain_mask'),
-                  os.path.join(
-            subject.masks_dir(),
-            'anatomy',
-            'brain.nii.gz'))
+        os.rename(subject.anatomical_nii('brain_mask'), brain_mask)
+
+        # The recorded parameters are the requested ones, so an approved manual adjustment isn't redone next time
+        self._cache.record(brain_image, 'extract_brain', [input_image], params)
+        self._cache.record(brain_mask, 'extract_brain', [input_image], params)
 
         return brain_image
 
+    @instrumented('applymask')
     def applymask_bold(self, subject):
         """
         Applying brain.nii mask on all functional files to treat only brain area in the furthcoming analyses
 
         """
         mask_file = os.path.join(subject.masks_dir(),'anatomy', 'brain.nii.gz')
-        for task, directories in subject.dir_tree('functional').iteritems():
-            for directory in sorted(directories):
-                bold_file = os.path.join(directory, 'bold.nii.gz')
-                masked_file = bold_file.replace('.nii.gz', '_mask.nii.gz')
 
-                if os.path.isfile(masked_file):
-                    print ">>>> Masking has been already been performed for {}".format(directory)
-                    continue
+        def process(directory):
+            bold_file = os.path.join(directory, 'bold.nii.gz')
+            masked_file = self.__run_file__(directory, 'bold_mask')
+
+            if self._cache.is_current(masked_file, 'applymask', [bold_file, mask_file], {}):
+                print ">>>> Masking has been already been performed for {}".format(directory)
+                return
 
-                mask = fsl.maths.ApplyMask()
-                mask.inputs.in_file = bold_file
-                mask.inputs.mask_file = mask_file
-                mask.inputs.out_file = masked_file
-                mask.run()
+            mask = fsl.maths.ApplyMask()
+            mask.inputs.in_file = bold_file
+            mask.inputs.mask_file = mask_file
+            mask.inputs.output_type = self._intermediate_format
+            with AtomicOutput(masked_file) as output:
+                mask.inputs.out_file = output.temp()
+                self._instrumentation.run_tool(mask)
+            self._cache.record(masked_file, 'applymask', [bold_file, mask_file], {})
 
+        self.__for_each_run__(subject, process, 'bold.nii.gz')
 
 
 
 
 
-    def motion_correction(self, subject, merge_task_runs=False):
+
+    @instrumented('motion_correction')
+    def motion_correction(self, subject, merge_task_runs=False, input_name='bold_mask'):
         """
             Motion Correction
 
@@ -650,6 +899,7 @@ class PreProcessing(object):
             Parameters
                 subject = Subject Dir object
                 merge_task_runs = if true - Merges the files before motion correction and after it's done we split them back
+                input_name = the image of the single runs that is motion corrected (to input_name_mcf)
 
         """
         print ">>> Motion correction"
@@ -657,6 +907,8 @@ class PreProcessing(object):
         # TODO: Make sure we skip this step if motion is already corrected
         # (when merge is true)
 
+        single_runs = []
+
         for task, directories in subject.dir_tree('functional').iteritems():
             if merge_task_runs and len(directories) > 1:
                 # Merge the files before motion correction and then split back
@@ -674,7 +926,8 @@ class PreProcessing(object):
                     os.path.join(
                         directory,
                         'bold_mcf_intnorm.nii.gz') for directory in directories]
-                if all(map(lambda x: os.path.isfile(x), mcf_files)):
+                if all(map(lambda x: self._cache.is_current(x, 'motion_correction_merged', bold_files, {}),
+                           mcf_files)):
                     print ">>>> Motion Correction has already been performed"
                     continue
 
@@ -690,7 +943,7 @@ class PreProcessing(object):
 
                     os.mkdir(merge_dir)
 
-                if not os.path.isfile(merge_file):
+                if not self._cache.is_current(mcf_merge_file, 'motion_correction', bold_files, {}):
                     merger = fsl.Merge()
 
                     merger.inputs.in_files = bold_files
@@ -698,76 +951,140 @@ class PreProcessing(object):
                     merger.inputs.output_type = 'NIFTI_GZ'
                     merger.inputs.merged_file = merge_file
 
-                    merger.run()
+                    self._instrumentation.run_tool(merger)
 
                     self.__motion_correct_file__(
                         merge_file, mcf_merge_file, subject, merge_dir)
+                    self._cache.record(mcf_merge_file, 'motion_correction', bold_files, {})
 
                 func_lengths = [nibabel.load(x).shape[3] for x in bold_files]
                 for output_merge_file, output_files in zip(
                         [mcf_merge_file, intnorm_merge_file], [mcf_files, intnorm_files]):
-                    split_dir = os.path.join(
-                        subject.functional_dir(), 'temp_split') + '/'
-                    if(not os.path.isfile(split_dir)):
-                        os.mkdir(split_dir)
-                        splitter = fsl.Split(in_file=output_merge_file,
-                                             out_base_name=split_dir,
-                                             dimension='t')
-                        result = splitter.run()
-
-                        split_dcms = sorted(result.outputs.out_files)
-                        idx = 0
-
-                        for out_file, run_length in zip(
-                                output_files, func_lengths):
-                            input_files = split_dcms[idx:idx + run_length]
-                            merge = fsl.Merge(in_files=input_files,
-                                              dimension='t',
-                                              output_type='NIFTI_GZ',
-                                              merged_file=out_file)
-                            merge.run()
-                            idx += run_length
-
-                    shutil.rmtree(split_dir)
+                    # The intensity normalized file is created only by the example pipeline
+                    if os.path.isfile(output_merge_file):
+                        self.__split_merged__(output_merge_file, output_files, func_lengths)
+
+                for mcf_file in mcf_files:
+                    self._cache.record(mcf_file, 'motion_correction_merged', bold_files, {})
             else:
                 # No need to merge the files..
-                for directory in sorted(directories):
-                    input_file = os.path.join(directory, 'bold_mask.nii.gz')
-                    output_file = input_file.replace('.nii.gz', '_mcf.nii.gz')
+                single_runs += directories
+
+        def process(directory):
+            input_file = self.__run_file__(directory, input_name)
+            output_file = self.__run_file__(directory, input_name + '_mcf')
+
+            if self._cache.is_current(output_file, 'motion_correction', [input_file], {}):
+                 print ">>>> MC has already been performed for {}".format(directory)
+                 return
+
+            # The .par file is named after the output, so it's committed with it
+            with AtomicOutput(output_file) as output:
+                self.__motion_correct_file__(input_file, output.temp(), subject, directory,
+                                             output_type=self._intermediate_format)
+
+            self._cache.record(output_file, 'motion_correction', [input_file], {})
+
+        self.__for_each_run__(subject, process, input_name, single_runs)
+
+    def __for_each_run__(self, subject, process, input_name, directories=None):
+        """
+            Dispatches every run directory (taskxxx_runxxx) of the subject to the run pool
+
+            Parameters
+                subject = Subject Dir object
+                process = function that processes a single run directory
+                input_name = the file (relative to the run directory) the stage reads, used for memory admission
+                             (without extension for the files of the 4D chain, see __run_file__)
+                directories = the run directories to process (default: all the functional directories)
+        """
+        if directories is None:
+            directories = [directory for task_directories in subject.dir_tree('functional').itervalues()
+                           for directory in task_directories]
+        directories = sorted(directories)
 
-                    if os.path.isfile(output_file):
-                         print ">>>> MC has already been performed for {}".format(directory)
-                         continue
+        if input_name.endswith('.nii.gz'):
+            footprint_files = [os.path.join(directory, input_name) for directory in directories]
+        else:
+            footprint_files = [self.__run_file__(directory, input_name) for directory in directories]
+
+        # every run is measured on its own, under the stage that dispatched it
+        subcode, stage = self._instrumentation.current()
+        inputs = dict(zip(directories, footprint_files))
+
+        def measured(directory):
+            with self._instrumentation.measure(subcode or subject, stage, directory, inputs=[inputs[directory]]):
+                process(directory)
+
+        self._run_pool.map(measured, directories, footprint_files)
 
-                    try:
-                        self.__beforechange__(input_file,'mcf')
+    def __run_file__(self, directory, name):
+        """
+            Path of an image of the 4D chain in a run directory, name without extension (see nifti_file)
+
+            An existing image is found whether it's compressed or not, a new one is in intermediate_format
+        """
+        return nifti_file(directory, name, self._intermediate_format)
 
-                        self.__motion_correct_file__(input_file, output_file, subject, directory)
+    def __run_files__(self, subject, name):
+        return [self.__run_file__(directory, name)
+                for task_directories in subject.dir_tree('functional').itervalues()
+                for directory in sorted(task_directories)]
 
-                        self.__afterchange__(input_file,output_file,'mcf',True)
+    def __split_merged__(self, merged_file, output_files, func_lengths):
+        """
+            Splits a file that was merged along time back to the runs it was merged from
 
-                    except Exception as ex:
-                        print ex
-                        self.__afterchange__(input_file,output_file,'mcf',False)
+            The merged file is read once and every run is written directly from its slab of volumes,
+            instead of splitting it to single volumes and merging them again per run.
 
-    def __smoothing__(self,in_file,out_file,fwhm,brightness_threshold,use_median = True):
+            Parameters
+                merged_file = the merged 4D file
+                output_files = output file of each run, in the order of merging
+                func_lengths = number of volumes of each run
+        """
+        merged = nibabel.load(merged_file)
+        data = np.asanyarray(merged.dataobj)
+
+        if sum(func_lengths) != data.shape[3]:
+            raise Exception("{} has {} volumes, expected {}".format(merged_file, data.shape[3], sum(func_lengths)))
+
+        idx = 0
+        for out_file, run_length in zip(output_files, func_lengths):
+            run = nibabel.Nifti1Image(data[..., idx:idx + run_length], merged.affine, merged.header.copy())
+            with AtomicOutput(out_file) as output:
+                nibabel.save(run, output.temp())
+            idx += run_length
+
+    def __smoothing_params__(self, fwhm, brightness_threshold, use_median, engine, mask_normalized):
+        if engine == 'susan':
+            # SUSAN outputs recorded before there were engines stay current
+            return {'fwhm': fwhm, 'brightness_threshold': brightness_threshold, 'use_median': use_median}
+        return {'fwhm': fwhm, 'engine': engine, 'mask_normalized': mask_normalized}
+
+    def __smoothing__(self,in_file,out_file,fwhm,brightness_threshold,use_median = True,output_type = 'NIFTI_GZ',
+                      engine = 'susan',mask_normalized = False):
+
+        if engine == 'native':
+            print ">>>> Working on {}".format(in_file)
+            GaussianSmoother(fwhm, mask_normalized).smooth_image(in_file, out_file)
+            return
 
         sus = fsl.SUSAN()
         sus.inputs.in_file = in_file
-        sus.inputs.out_file = out_file
         sus.inputs.brightness_threshold = brightness_threshold
         sus.inputs.fwhm = fwhm
         sus.inputs.use_median = use_median
+        sus.inputs.output_type = output_type
 
         print ">>>> Working on {}".format(in_file)
 
         try:
-            self.__beforechange__(in_file,'smooth')
-            result = sus.run()
-            self.__afterchange__(in_file,out_file,'smooth',True)
+            with AtomicOutput(out_file) as output:
+                sus.inputs.out_file = output.temp()
+                result = self._instrumentation.run_tool(sus)
         except Exception as ex:
             print ex
-            self.__afterchange__(in_file,out_file,'smooth',False)
             raise ex
 
     def __motion_correct_file__(
@@ -776,7 +1093,8 @@ class PreProcessing(object):
             output_file,
             subject,
             directory,
-            use_example_pp=False):
+            use_example_pp=False,
+            output_type='NIFTI_GZ'):
         # Check whether motion correction has already been completed
 
         print ">>>> Working on {}".format(input_file)
@@ -787,7 +1105,8 @@ class PreProcessing(object):
                 subject.anatomical_dir(), 'highres001.nii.gz')
             pp.preproc.base_dir = directory
 
-            pp.preproc.run()
+            with self._instrumentation.measure(subject, tool='preproc_workflow'):
+                pp.preproc.run()
             # TODO: copy motion correction photos as well
             intnorm_file = output_file.replace('.nii.gz', '_intnorm.nii.gz')
             shutil.copy(
@@ -839,32 +1158,17 @@ class PreProcessing(object):
             mcflt = fsl.MCFLIRT(
                 in_file=input_file,
                 out_file=output_file,
-                save_plots=True)
-            result = mcflt.run()
+                save_plots=True,
+                output_type=output_type)
+            result = self._instrumentation.run_tool(mcflt)
 
             pmp = fsl.PlotMotionParams(
                 in_file=result.outputs.par_file, in_source='fsl')
 
             pmp.inputs.plot_type = 'rotations'
-            pmp.run()
+            self._instrumentation.run_tool(pmp)
             pmp.inputs.plot_type = 'translations'
-            pmp.run()
-
-    def __beforechange__(self,input_file,ext):
-         shutil.copy(input_file,input_file.replace('.nii.gz','_pre_{}.nii.gz'.format(ext)))
-
-    def __afterchange__(self,input_file,output_file,ext,success):
-        backup = input_file.replace('.nii.gz','_pre_{}.nii.gz'.format(ext))
-        if(success):
-            #shutil.copy(output_file,input_file)
-            #os.remove(output_file) - We don't remove this because that's how we check if we did the process already
-            os.remove(backup)
-        else:
-            #shutil.copy(backup,input_file)
-            if(os.exists(output_file)):
-                os.remove(output_file)
-            if(os.exists(backup)):
-                os.remove(backup)
+            self._instrumentation.run_tool(pmp)
 
 
 def test():
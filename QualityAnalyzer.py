@@ -2,68 +2,479 @@
 
 from OpenFMRIData import OpenFMRIData
 import nibabel as nib
-from statsmodels.tsa.tsatools import detrend
 import os
+import gzip
+import time
+import shutil
+import tempfile
+import traceback
+import multiprocessing
 import numpy as np
+import pandas as pd
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data
+from StageCache import StageCache
+import MotionMetrics
+
+
+def _analyze_run(args):
+	"""
+	QualityAnalyzer.analyze_run of a single run (executed inside a pool worker)
+
+	Returns
+		(run, table row, None) or (run, None, traceback) when the run failed
+	"""
+	analyzer, run, detrend_order, chunk_size = args
+
+	start = time.time()
+	try:
+		metrics = analyzer.analyze_run(run, detrend_order, chunk_size)
+	except Exception:
+		return run, None, traceback.format_exc()
+
+	row = dict((key, run[key]) for key in ['subject', 'task', 'run', 'input_key'])
+	row['task_name'] = analyzer._taskname_mapping.get(run['task'])
+	row.update((key, metrics[key]) for key in ['sfnr', 'snr', 'dvars', 'mean_fd', 'volumes'])
+	row['elapsed'] = time.time() - start
+	return run, row, None
+
+
 class QualityAnalyzer(object):
+
+	TABLE_COLUMNS = ['subject', 'task', 'task_name', 'run', 'sfnr', 'snr', 'dvars', 'mean_fd', 'volumes',
+					'elapsed', 'input_key']
+
 	def __init__(self, fmri_dataset):
 		self._fmri_dataset = fmri_dataset
 		self.__load_taskname_mapping__()
 	
 	def __load_taskname_mapping__(self):
 		with open(os.path.join(self._fmri_dataset.study_dir(), 'task_key.txt'), 'r') as fh:
-                        task_data = fh.read().splitlines()
+			task_data = fh.read().splitlines()
 
-                self._taskname_mapping = dict([(task.split('\t')[0], task.split('\t')[1]) for task in task_data])
+		self._taskname_mapping = dict([(task.split('\t')[0], task.split('\t')[1]) for task in task_data])
 
 	
-	def analyze_runs(self, subcode):
+	def analyze_runs(self, subcode, detrend_order=1, chunk_size=None):
+		"""
+		Prints the SFNR and SNR of every run of the subject and writes its detrended maps (see detrend_run)
+		to BOLD/*run_name*/qa
+
+		Parameters
+			subcode = subject code
+			detrend_order = order of the polynomial trend removed from the data (None = skip the detrending)
+			chunk_size = number of volumes in memory at once (None = whole runs, see stream_run)
+		"""
 		print ">>> Analyzing sub{:0>3d}".format(subcode)
-		subject = self._fmri_dataset.subject_dir(subcode=subcode)
-		
+
+		for run in self.run_files(subcode):
+			metrics = self.analyze_run(run, detrend_order, chunk_size)
+
+			print '{} \n {}\nsfnr => {:>40f} \nsnr => {:>40f}'.format(self._taskname_mapping[run['task']],run['run'],metrics['sfnr'],metrics['snr'])
+
+	def run_files(self, subcode):
+		"""
+		The QA inputs of every run of a subject
+
+		Returns
+			list of dictionaries with subject, task, run, bold (bold_mcf.nii.gz), mask (gray matter),
+			nonbrain (non brain mask), par (MCFLIRT motion parameters, None when missing) and qa_dir
+		"""
+		subject = self._fmri_dataset.load_subject_dir(subcode=subcode)
+
+		runs = []
 		for task , directories in subject.dir_tree('functional').iteritems():
 			for directory in directories:
-                                run_name = directory.split('/')[-1]
-				maskfile = os.path.join(subject.masks_dir(),run_name,'gray.nii.gz')
-				nonbrain_mask = os.path.join(subject.masks_dir(),run_name,'non_brain.nii.gz')
-
-				img = nib.load(os.path.join(directory,'bold_mcf.nii.gz'))
-				imgdata = img.get_data()
-				maskimg=nib.load(maskfile)
-				maskdata=maskimg.get_data()
-				nonbrain_maskdata = nib.load(nonbrain_mask).get_data()
-				voxmean=np.mean(imgdata,3)
-				voxstd=np.std(imgdata,3)
-				maskvox=np.where(maskdata>0)
-				nonmaskvox=np.where(nonbrain_maskdata>0)
-				voxsfnr=voxmean/voxstd
-				meansfnr=np.mean(voxsfnr[maskvox])
-				imgsnr=np.zeros(imgdata.shape[3])
-
-				for t in range(imgdata.shape[3]):
-					tmp=imgdata[:,:,:,t]
-					tmp_brain=tmp[maskvox]
-					tmp_nonbrain=tmp[nonmaskvox]
-					maskmean=np.mean(tmp_brain)
-					imgsnr[t]=maskmean/np.std(tmp_nonbrain)
-				
+				run_name = directory.split('/')[-1]
 				task_name, run_number = run_name.split('_')
-				print '{} \n {}\nsfnr => {:>40f} \nsnr => {:>40f}'.format(self._taskname_mapping[task_name],run_number,meansfnr,np.mean(imgsnr))
-				
-				continue	
-				detrended_zscore=np.zeros(imgdata.shape)
-				detrended_data=np.zeros(imgdata.shape)
-				print imgdata.shape
-				for i in range(len(maskvox[0])):
-					tmp=imgdata[maskvox[0][i],maskvox[1][i],maskvox[2][i],:]
-					tmp_detrended=detrend(tmp)
-					detrended_data[maskvox[0][i],maskvox[1][i],maskvox[2][i],:]=tmp_detrended
-					detrended_zscore[maskvox[0][i],maskvox[1][i],maskvox[2][i],:]=(tmp_detrended - np.mean(tmp_detrended))/np.std(tmp_detrended)
-				voxmean_detrended=np.mean(detrended_data,3)
-				voxstd_detrended=np.std(detrended_data,3)
-
-
-			
+				bold_file = os.path.join(directory,'bold_mcf.nii.gz')
+				runs.append({'subject': subcode,
+							'task': task_name,
+							'run': run_number,
+							'bold': bold_file,
+							'mask': os.path.join(subject.masks_dir(),run_name,'gray.nii.gz'),
+							'nonbrain': os.path.join(subject.masks_dir(),run_name,'non_brain.nii.gz'),
+							'par': MotionMetrics.run_par_file(directory),
+							'qa_dir': os.path.join(directory,'qa')})
+		return runs
+
+	def analyze_run(self, run, detrend_order=1, chunk_size=None):
+		"""
+		Metrics of a single run (an item of run_files), see run_metrics / stream_run
+
+		The detrended maps are written to run['qa_dir'] unless detrend_order is None
+		"""
+		if chunk_size is None:
+			metrics = self.run_metrics(run['bold'], run['mask'], run['nonbrain'])
+			if detrend_order is not None:
+				self.detrend_run(run['bold'], run['mask'], run['qa_dir'], detrend_order)
+		else:
+			metrics = self.stream_run(run['bold'], run['mask'], run['nonbrain'], run['qa_dir'], detrend_order, chunk_size)
+
+		metrics['mean_fd'] = np.nan
+		if run['par'] is not None:
+			metrics['mean_fd'] = MotionMetrics.framewise_displacement(MotionMetrics.read_par(run['par']))[1:].mean()
+		return metrics
+
+	def analyze_study(self, n_jobs=None, detrend_order=1, chunk_size=None):
+		"""
+		QA of every run of every subject of the study
+
+		The runs are analyzed in a process pool, and their metrics are kept in one table (study_dir/qa/qa_metrics),
+		one row per run:
+			subject, task, task_name, run, sfnr, snr, dvars, mean_fd, volumes, elapsed (seconds), input_key
+		input_key is the provenance key (see StageCache) of the run's inputs and the QA parameters,
+		only the runs whose key changed since the table was written are analyzed again.
+		A run that fails keeps its row of the previous table (with its old input_key, so it's analyzed again
+		the next time).
+
+		The table is saved as parquet, or as csv when there is no parquet engine (pyarrow/fastparquet).
+
+		Parameters
+			n_jobs = number of runs analyzed concurrently (None = number of cores)
+			detrend_order, chunk_size = see analyze_runs
+
+		Returns
+			the table (pandas DataFrame)
+		"""
+		table = self.load_study_table()
+		current = dict()
+		if table is not None:
+			for row in table.to_dict('records'):
+				current[(row['subject'], row['task'], row['run'])] = row
+
+		cache = StageCache()
+		params = {'detrend_order': detrend_order, 'chunk_size': chunk_size}
+
+		rows = []
+		jobs = []
+		for subcode in sorted(int(code) for code in self._fmri_dataset.mapping_json().values()):
+			for run in self.run_files(subcode):
+				inputs = [run['bold'], run['mask'], run['nonbrain']] + filter(None, [run['par']])
+				run['input_key'] = cache.key('qa', inputs, params)
+				row = current.get((run['subject'], run['task'], run['run']))
+				if row is not None and row['input_key'] == run['input_key']:
+					rows.append(row)
+				else:
+					jobs.append((self, run, detrend_order, chunk_size))
+
+		print ">>> QA of {} runs ({} up to date)".format(len(jobs), len(rows))
+
+		failed = []
+		if jobs:
+			pool = multiprocessing.Pool(min(n_jobs or multiprocessing.cpu_count(), len(jobs)))
+			try:
+				for run, row, error in pool.imap_unordered(_analyze_run, jobs):
+					if error is None:
+						print ">>>> sub{:0>3d} {} {} ({:.1f}s)".format(run['subject'], run['task'], run['run'], row['elapsed'])
+						rows.append(row)
+					else:
+						previous = current.get((run['subject'], run['task'], run['run']))
+						print ">>>> sub{:0>3d} {} {} failed{}".format(run['subject'], run['task'], run['run'],
+							' (its previous row is kept)' if previous is not None else '')
+						if previous is not None:
+							rows.append(previous)
+						failed.append((run, error))
+				pool.close()
+			except KeyboardInterrupt:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+
+		for run, error in failed:
+			print "---- sub{:0>3d} {} {} ----\n{}".format(run['subject'], run['task'], run['run'], error)
+
+		table = pd.DataFrame(rows, columns=self.TABLE_COLUMNS).sort_values(['subject', 'task', 'run'])
+		table = table.reset_index(drop=True)
+		self.__save_study_table__(table)
+
+		return table
+
+	def load_study_table(self):
+		"""
+		The table of analyze_study, or None when it wasn't created yet
+		"""
+		table_file = self.__study_table_file__()
+		if table_file.endswith('.parquet'):
+			return pd.read_parquet(table_file)
+		if os.path.isfile(table_file):
+			return pd.read_csv(table_file)
+		return None
+
+	def __study_table_file__(self, ext=None):
+		table_file = os.path.join(self._fmri_dataset.study_dir(), 'qa', 'qa_metrics')
+		if ext is not None:
+			return table_file + ext
+		if os.path.isfile(table_file + '.parquet'):
+			return table_file + '.parquet'
+		return table_file + '.csv'
+
+	def __save_study_table__(self, table):
+		qa_dir = os.path.dirname(self.__study_table_file__())
+		if not os.path.isdir(qa_dir):
+			os.makedirs(qa_dir)
+
+		try:
+			with AtomicOutput(self.__study_table_file__('.parquet')) as output:
+				table.to_parquet(output.temp(), index=False)
+			stale = self.__study_table_file__('.csv')
+		except ImportError:
+			with AtomicOutput(self.__study_table_file__('.csv')) as output:
+				table.to_csv(output.temp(), index=False)
+			stale = self.__study_table_file__('.parquet')
+
+		if os.path.isfile(stale):
+			os.remove(stale)
+
+	def run_metrics(self, bold_file, maskfile, nonbrain_mask):
+		"""
+		SFNR, SNR and DVARS of a single run
+
+		The run is read once as float32 and each mask is extracted once to a (time x voxels) matrix,
+		so every statistic is a single reduction over that matrix instead of a loop over the volumes
+
+		Returns
+			dictionary with
+				sfnr = mean over the brain voxels of the voxelwise SFNR (temporal mean / temporal std)
+				snr = mean over the volumes of the per-volume SNR
+				voxsfnr = voxelwise SFNR of the brain voxels
+				snr_per_volume = mean brain signal / std of the non brain signal, per volume
+				dvars = mean of dvars_per_volume
+				dvars_per_volume = RMS over the brain voxels of the change from the previous volume
+				volumes = number of volumes
+		"""
+		img = nib.load(bold_file)
+		imgdata = float32_data(img)
+		brain_mask = nib.load(maskfile).get_data() > 0
+		nonbrain = nib.load(nonbrain_mask).get_data() > 0
+
+		# (time x voxels) matrices
+		brain_data = imgdata[brain_mask].T
+		nonbrain_data = imgdata[nonbrain].T
+
+		voxsfnr = brain_data.mean(axis=0) / brain_data.std(axis=0)
+		imgsnr = brain_data.mean(axis=1) / nonbrain_data.std(axis=1)
+		dvars = MotionMetrics.dvars(brain_data)[1:]
+
+		return {'sfnr': np.mean(voxsfnr),
+			'snr': np.mean(imgsnr),
+			'dvars': np.mean(dvars),
+			'voxsfnr': voxsfnr,
+			'snr_per_volume': imgsnr,
+			'dvars_per_volume': dvars,
+			'volumes': imgdata.shape[3]}
+
+	def detrend_run(self, bold_file, maskfile, output_dir, order=1, block_size=20000):
+		"""
+		Removes a polynomial trend from every brain voxel of a run
+
+		All the voxels share the same design matrix, so the least-squares fit of all of them is a single
+		matrix product with its pseudo-inverse. The voxels are processed in blocks of block_size and their
+		z-scores replace their data in the (time x brain voxels) matrix, which is then written to the zscore
+		image through a memory map (as stream_run does), so no 4D array is allocated besides the brain data.
+
+		Outputs (in output_dir):
+			bold_mcf_detrended_mean.nii.gz = temporal mean of every voxel
+			bold_mcf_detrended_std.nii.gz = temporal std of every voxel after the trend was removed
+			bold_mcf_detrended_zscore.nii.gz = detrended data, z-scored per voxel
+
+		Parameters
+			bold_file = the run (4D)
+			maskfile = voxels to detrend (everything outside it is 0 in the outputs)
+			output_dir = created if it doesn't exist
+			order = order of the polynomial (1 = linear trend, as statsmodels' detrend)
+			block_size = number of voxels fitted together
+		"""
+		img = nib.load(bold_file)
+		imgdata = float32_data(img)
+		brain_mask = nib.load(maskfile).get_data() > 0
+		maskvox = np.where(brain_mask)
+
+		# (time x voxels) matrix
+		brain_data = imgdata[brain_mask].T
+		volumes = brain_data.shape[0]
+		del imgdata
+
+		design = np.polynomial.legendre.legvander(np.linspace(-1, 1, volumes), order).astype(np.float32)
+		projection = np.linalg.pinv(design)
+
+		voxmean = np.zeros(brain_mask.shape, dtype=np.float32)
+		voxstd_detrended = np.zeros(brain_mask.shape, dtype=np.float32)
+
+		for start in range(0, brain_data.shape[1], block_size):
+			block = brain_data[:, start:start + block_size]
+			vox = tuple(axis[start:start + block_size] for axis in maskvox)
+
+			detrended = block - design.dot(projection.dot(block))
+			detrended_std = detrended.std(axis=0)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				zscore = (detrended - detrended.mean(axis=0)) / detrended_std
+			zscore[:, detrended_std == 0] = 0
+
+			voxmean[vox] = block.mean(axis=0)
+			voxstd_detrended[vox] = detrended_std
+			block[:] = zscore
+
+		if not os.path.isdir(output_dir):
+			os.makedirs(output_dir)
+
+		for name, data in [('mean', voxmean), ('std', voxstd_detrended)]:
+			out_img = nib.Nifti1Image(data, img.affine, img.header.copy())
+			out_img.set_data_dtype(np.float32)
+			nib.save(out_img, os.path.join(output_dir, 'bold_mcf_detrended_{}.nii.gz'.format(name)))
+
+		chunk_size = 50
+		self.__write_zscore__(img, brain_mask, ((start, brain_data[start:start + chunk_size].T)
+												for start in range(0, volumes, chunk_size)), output_dir)
+
+	def stream_run(self, bold_file, maskfile, nonbrain_mask, output_dir, order=1, chunk_size=50, mmap_cache=True):
+		"""
+		Memory bounded version of run_metrics and detrend_run
+
+		The run is read chunk_size volumes at a time, so the peak memory depends on the chunk size and the
+		number of voxels but not on the length of the run.
+		- The voxelwise mean and variance are single-pass running statistics, merged chunk by chunk
+		  (Chan et al. pairwise update), the per-volume SNR is computed per chunk.
+		- The trend is fitted from sufficient statistics: with Q the orthonormal basis of the polynomial design
+		  matrix, the coefficients Q'y are sums over the volumes, and the residual sum of squares is the
+		  centered sum of squares minus the squared coefficients of the non-constant columns.
+		- The z-scored detrended data needs the std of the whole run, so it is written in a second pass
+		  to a (time-major) memory map, and saved from it volume by volume.
+
+		A gzipped run can't be read efficiently in chunks (every chunk decompresses the file from its start),
+		so with mmap_cache it is decompressed once to output_dir/bold_mcf.nii and memory mapped.
+		The cache is removed at the end.
+
+		Returns
+			the dictionary of run_metrics
+		Outputs (in output_dir, when order is not None):
+			the maps of detrend_run
+		"""
+		if not os.path.isdir(output_dir):
+			os.makedirs(output_dir)
+
+		source = bold_file
+		if mmap_cache and bold_file.endswith('.gz'):
+			source = self.__uncompressed__(bold_file, output_dir)
+
+		try:
+			img = nib.load(source)
+			volumes = img.shape[3]
+			brain_mask = nib.load(maskfile).get_data() > 0
+			nonbrain = nib.load(nonbrain_mask).get_data() > 0
+			n_voxels = np.count_nonzero(brain_mask)
+
+			basis = None
+			if order is not None:
+				design = np.polynomial.legendre.legvander(np.linspace(-1, 1, volumes), order)
+				basis = np.linalg.qr(design)[0]
+				coefficients = np.zeros((n_voxels, basis.shape[1]))
+
+			count = 0
+			voxmean = np.zeros(n_voxels)
+			m2 = np.zeros(n_voxels)
+			imgsnr = np.zeros(volumes)
+			dvars = np.zeros(volumes - 1)
+			previous = None
+
+			for start, chunk in self.__time_chunks__(img, chunk_size):
+				# (voxels x time) matrix of the chunk
+				brain_data = chunk[brain_mask].astype(np.float64)
+				n = brain_data.shape[1]
+
+				chunk_mean = brain_data.mean(axis=1)
+				chunk_m2 = ((brain_data - chunk_mean[:, np.newaxis]) ** 2).sum(axis=1)
+				delta = chunk_mean - voxmean
+				voxmean += delta * n / (count + n)
+				m2 += chunk_m2 + delta ** 2 * count * n / (count + n)
+				count += n
+
+				imgsnr[start:start + n] = brain_data.mean(axis=0) / chunk[nonbrain].std(axis=0)
+
+				# the first volume of the chunk is compared with the last one of the previous chunk
+				with_previous = brain_data if previous is None else np.hstack([previous, brain_data])
+				dvars[max(start - 1, 0):start + n - 1] = np.sqrt((np.diff(with_previous, axis=1) ** 2).mean(axis=0))
+				previous = brain_data[:, -1:]
+
+				if basis is not None:
+					coefficients += brain_data.dot(basis[start:start + n])
+
+			voxstd = np.sqrt(m2 / count)
+			voxsfnr = voxmean / voxstd
+			metrics = {'sfnr': np.mean(voxsfnr),
+					'snr': np.mean(imgsnr),
+					'dvars': np.mean(dvars),
+					'voxsfnr': voxsfnr,
+					'snr_per_volume': imgsnr,
+					'dvars_per_volume': dvars,
+					'volumes': volumes}
+
+			if basis is not None:
+				detrended_std = np.sqrt(np.maximum(m2 - (coefficients[:, 1:] ** 2).sum(axis=1), 0) / count)
+				self.__write_detrended__(img, brain_mask, basis, coefficients, voxmean, detrended_std,
+										output_dir, chunk_size)
+		finally:
+			if source != bold_file:
+				os.remove(source)
+
+		return metrics
+
+	def __time_chunks__(self, img, chunk_size):
+		for start in range(0, img.shape[3], chunk_size):
+			yield start, np.asarray(img.dataobj[..., start:start + chunk_size], dtype=np.float32)
+
+	def __uncompressed__(self, bold_file, output_dir):
+		cache = os.path.join(output_dir, os.path.basename(bold_file)[:-3])
+		with AtomicOutput(cache) as output:
+			with gzip.open(bold_file, 'rb') as src, open(output.temp(), 'wb') as dst:
+				shutil.copyfileobj(src, dst, 1 << 24)
+		return cache
+
+	def __write_detrended__(self, img, brain_mask, basis, coefficients, voxmean, detrended_std, output_dir, chunk_size):
+		maps = [('mean', voxmean), ('std', detrended_std)]
+		for name, values in maps:
+			data = np.zeros(brain_mask.shape, dtype=np.float32)
+			data[brain_mask] = values
+			out_img = nib.Nifti1Image(data, img.affine, img.header.copy())
+			out_img.set_data_dtype(np.float32)
+			nib.save(out_img, os.path.join(output_dir, 'bold_mcf_detrended_{}.nii.gz'.format(name)))
+
+		def zscore_chunks():
+			for start, chunk in self.__time_chunks__(img, chunk_size):
+				brain_data = chunk[brain_mask].astype(np.float64)
+				n = brain_data.shape[1]
+				detrended = brain_data - coefficients.dot(basis[start:start + n].T)
+				with np.errstate(divide='ignore', invalid='ignore'):
+					values = detrended / detrended_std[:, np.newaxis]
+				values[detrended_std == 0] = 0
+				yield start, values
+
+		self.__write_zscore__(img, brain_mask, zscore_chunks(), output_dir)
+
+	def __write_zscore__(self, img, brain_mask, chunks, output_dir):
+		"""
+		Saves bold_mcf_detrended_zscore.nii.gz from (start volume, (brain voxels x volumes) z-scores) chunks,
+		through a (time-major) memory map of the 4D image
+		"""
+		fd, buffer_file = tempfile.mkstemp(dir=output_dir, suffix='.dat')
+		os.close(fd)
+		try:
+			# Fortran order: every chunk of volumes is a contiguous block of the file
+			zscore = np.memmap(buffer_file, dtype=np.float32, mode='w+', shape=img.shape, order='F')
+			for start, values in chunks:
+				volume_chunk = np.zeros(brain_mask.shape + (values.shape[1],), dtype=np.float32)
+				volume_chunk[brain_mask] = values
+				zscore[..., start:start + values.shape[1]] = volume_chunk
+			zscore.flush()
+
+			out_img = nib.Nifti1Image(zscore, img.affine, img.header.copy())
+			out_img.set_data_dtype(np.float32)
+			nib.save(out_img, os.path.join(output_dir, 'bold_mcf_detrended_zscore.nii.gz'))
+			del zscore, out_img
+		finally:
+			os.remove(buffer_file)
+
 
 def test():
 	fmri_data = OpenFMRIData('/home/user/data', '/home/user/data/raw', '/home/user/data/behavioural', 'EPITest')
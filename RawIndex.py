@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+import os
+import re
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from AtomicOutput import AtomicOutput
+
+try:
+    import dicom
+except ImportError:
+    try:
+        import pydicom as dicom
+    except ImportError:
+        dicom = None
+
+
+class RawIndex(object):
+
+    SUBJECT_REGEX = re.compile("RM_lab.*_(.*)_[0-9]{8}_[0-9]{4}")
+
+    # The kind of a series, matched on its description and protocol name
+    SERIES_PATTERNS = {'anatomical': re.compile('mprage', re.IGNORECASE),
+                       'functional': re.compile('ep2', re.IGNORECASE)}
+
+    # The series number at the end of a series directory name (ep2d_bold_0005)
+    SERIES_NUMBER_REGEX = re.compile('[_-]*[0-9]+$')
+
+    def __init__(self, raw_study_dir, index_file, n_jobs=None):
+        """
+            Index of the raw dicom directories of a study
+
+            For every series directory (raw/study_name/<subject dir>/<series dir>) we keep the number of files and
+            the header of one dicom file: series description, protocol name, TR, dimensions and acquisition time.
+            The series are matched to the anatomical / functional runs by their description and protocol.
+            The index is saved to index_file and refreshed incrementally - a subject or series directory is
+            read again only when its modification time changed.
+
+            Parameters
+                raw_study_dir = raw directory of the study (contains the subject directories)
+                index_file = where the index is saved (json)
+                n_jobs = number of series headers read concurrently (None = number of cores)
+
+            Requires pydicom for the header fields, without it only the file counts are indexed and the
+            description is the directory name without its series number
+        """
+        self._raw_study_dir = raw_study_dir
+        self._index_file = index_file
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._index = self.__load__()
+
+    def refresh(self):
+        """
+            Brings the index up to date with the raw directory and saves it
+
+            Returns
+                The index dictionary: {subject dir: {'mtime': , 'series': {series dir: series entry}}}
+        """
+        index = dict()
+        stale = []
+
+        for subject_dir in sorted(os.listdir(self._raw_study_dir)):
+            subject_path = os.path.join(self._raw_study_dir, subject_dir)
+            if not os.path.isdir(subject_path):
+                continue
+
+            cached = self._index.get(subject_dir, {'mtime': None, 'series': dict()})
+            mtime = os.path.getmtime(subject_path)
+
+            series_names = cached['series'].keys() if cached['mtime'] == mtime else \
+                [name for name in os.listdir(subject_path) if os.path.isdir(os.path.join(subject_path, name))]
+
+            index[subject_dir] = {'mtime': mtime, 'series': dict()}
+            for series_dir in series_names:
+                series_path = os.path.join(subject_path, series_dir)
+                entry = cached['series'].get(series_dir)
+                # entries indexed before the protocol name was kept are read again
+                if entry is not None and entry['mtime'] == os.path.getmtime(series_path) and 'protocol' in entry:
+                    index[subject_dir]['series'][series_dir] = entry
+                else:
+                    stale.append((subject_dir, series_dir))
+
+        if stale:
+            print ">>> Indexing {} raw series".format(len(stale))
+            pool = ThreadPool(min(self._n_jobs, len(stale)))
+            try:
+                entries = pool.map(lambda series: self.__read_series__(*series), stale)
+            finally:
+                pool.close()
+                pool.join()
+
+            for (subject_dir, series_dir), entry in zip(stale, entries):
+                index[subject_dir]['series'][series_dir] = entry
+
+        self._index = index
+        self.__save__()
+
+        return self._index
+
+    def subject_dirs(self):
+        return sorted(self._index.keys())
+
+    def subject_names(self):
+        """
+            Subject names parsed from the raw directory names (see OpenFMRIData.get_subject_names)
+        """
+        names = []
+        for subject_dir in self.subject_dirs():
+            match = self.SUBJECT_REGEX.search(subject_dir)
+            if match:
+                names.append(match.group(1))
+        return names
+
+    def subject_dir(self, subject_name):
+        """
+            The raw directory of the subject (the first one containing its name), or None
+        """
+        matches = [subject_dir for subject_dir in self.subject_dirs() if subject_name in subject_dir]
+        return matches[0] if matches else None
+
+    def series(self, subject_name, kind):
+        """
+            The series of a subject, in the order they are matched to task_order.txt
+
+            Parameters
+                kind = 'anatomical' (MPRAGE) or 'functional' (ep2), matched on the series description or
+                       protocol name (see SERIES_PATTERNS)
+            Returns
+                List of (series path, series entry)
+        """
+        pattern = self.SERIES_PATTERNS[kind]
+        subject_dir = self.subject_dir(subject_name)
+        if subject_dir is None:
+            return []
+
+        series = self._index[subject_dir]['series']
+        return [(os.path.join(self._raw_study_dir, subject_dir, series_dir), series[series_dir])
+                for series_dir in sorted(series.keys())
+                if any(pattern.search(series[series_dir].get(field) or '') for field in ['description', 'protocol'])]
+
+    def raw_series(self, subject_name):
+        """
+            The series a SubjectDir converts: {'anatomical': path, 'functional': [paths]}
+        """
+        anatomical = self.series(subject_name, 'anatomical')
+        return {'anatomical': anatomical[0][0] if anatomical else None,
+                'functional': [path for path, entry in self.series(subject_name, 'functional')]}
+
+    def check(self, subject_name, task_order=None):
+        """
+            Sanity checks of a subject's raw data, done on the index only
+
+            - the subject has an anatomical series
+            - the number of functional series matches task_order
+            - no functional series has fewer files (volumes) than the other series with the same description
+
+            Returns
+                List of problems (strings), empty when everything is fine
+        """
+        problems = []
+        if self.subject_dir(subject_name) is None:
+            return ["No raw directory for {}".format(subject_name)]
+
+        if not self.series(subject_name, 'anatomical'):
+            problems.append("{}: no MPRAGE series".format(subject_name))
+
+        functional = self.series(subject_name, 'functional')
+        if task_order is not None and len(functional) != len(task_order):
+            problems.append("{}: {} functional series for {} runs in the task order".format(
+                subject_name, len(functional), len(task_order)))
+
+        full_length = dict()
+        for path, entry in functional:
+            full_length[entry['description']] = max(full_length.get(entry['description'], 0), entry['files'])
+        for path, entry in functional:
+            if entry['files'] < full_length[entry['description']]:
+                problems.append("{}: {} has {} files, other '{}' series have {} (truncated run?)".format(
+                    subject_name, os.path.basename(path), entry['files'], entry['description'],
+                    full_length[entry['description']]))
+
+        return problems
+
+    def __read_series__(self, subject_dir, series_dir):
+        series_path = os.path.join(self._raw_study_dir, subject_dir, series_dir)
+        file_names = sorted(name for name in os.listdir(series_path)
+                            if os.path.isfile(os.path.join(series_path, name)))
+
+        entry = {'mtime': os.path.getmtime(series_path),
+                 'files': len(file_names),
+                 'description': self.SERIES_NUMBER_REGEX.sub('', series_dir) or series_dir,
+                 'protocol': None,
+                 'series_number': None,
+                 'tr': None,
+                 'rows': None,
+                 'columns': None,
+                 'slices': None,
+                 'acquisition_time': None}
+
+        if dicom is None or not file_names:
+            return entry
+
+        read_file = getattr(dicom, 'dcmread', None) or dicom.read_file
+        for file_name in file_names:
+            try:
+                header = read_file(os.path.join(series_path, file_name), stop_before_pixels=True)
+            except Exception:
+                continue  # not a dicom file
+
+            entry.update({'description': str(getattr(header, 'SeriesDescription', entry['description'])),
+                          'protocol': self.__value__(header, 'ProtocolName', str),
+                          'series_number': self.__value__(header, 'SeriesNumber', int),
+                          'tr': self.__value__(header, 'RepetitionTime', float),
+                          'rows': self.__value__(header, 'Rows', int),
+                          'columns': self.__value__(header, 'Columns', int),
+                          'slices': self.__value__(header, 'ImagesInAcquisition', int),
+                          'acquisition_time': self.__value__(header, 'AcquisitionTime', str)})
+            break
+
+        return entry
+
+    def __value__(self, header, name, cast):
+        value = getattr(header, name, None)
+        if value is None or value == '':
+            return None
+        return cast(value)
+
+    def __load__(self):
+        if not os.path.isfile(self._index_file):
+            return dict()
+
+        with open(self._index_file, 'r') as fh:
+            return json.load(fh)
+
+    def __save__(self):
+        with AtomicOutput(self._index_file) as output:
+            with open(output.temp(), 'w') as fh:
+                json.dump(self._index, fh, sort_keys=True, indent=1)
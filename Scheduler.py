@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+import os
+import time
+import threading
+import traceback
+import multiprocessing
+import nibabel
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple, OrderedDict
+
+
+SubjectResult = namedtuple('SubjectResult', ['subject', 'success', 'error', 'elapsed'])
+
+
+class SubjectsFailed(Exception):
+
+    def __init__(self, results):
+        """
+            Raised after all the subjects finished when some of them failed
+
+            Parameters
+                results = OrderedDict of <subject code, SubjectResult> of all the subjects
+        """
+        self.results = results
+        failed = ['sub{:0>3}'.format(subcode) for subcode, result in results.iteritems() if not result.success]
+        super(SubjectsFailed, self).__init__("{} subject(s) failed: {}".format(len(failed), ', '.join(failed)))
+
+
+def _run_subject(args):
+    """
+        Runs the whole preprocessing chain of a single subject (executed inside a pool worker)
+
+        Any exception is caught and returned so one failing subject doesn't bring down the others
+    """
+    preprocessing, subject, kwargs = args
+
+    start = time.time()
+    try:
+        preprocessing.analyze_subject(subject, **kwargs)
+        return SubjectResult(subject.subcode(), True, None, time.time() - start)
+    except Exception:
+        return SubjectResult(subject.subcode(), False, traceback.format_exc(), time.time() - start)
+
+
+class SubjectScheduler(object):
+
+    def __init__(self, n_jobs=1):
+        """
+            Runs the preprocessing chain of several subjects concurrently
+
+            Every subject is an independent pipeline (BET -> FAST -> MCFLIRT -> ... -> segmentation),
+            so subjects are handed to a process pool and each worker runs one subject's chain from start to end.
+
+            Parameters
+                n_jobs = number of subjects processed concurrently (None = number of cores)
+        """
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+
+    def run(self, preprocessing, subjects, kwargs):
+        """
+            Parameters
+                preprocessing = PreProcessing object (must be picklable)
+                subjects = list of SubjectDir objects
+                kwargs = arguments of PreProcessing.analyze_subject
+
+            Returns
+                OrderedDict of <subject code, SubjectResult> in the order of subjects
+
+            Raises
+                SubjectsFailed after all the subjects finished (and the summary was printed), when any failed,
+                so a script running the preprocessing exits with an error
+        """
+        jobs = [(preprocessing, subject, kwargs) for subject in subjects]
+        results = dict()
+
+        if self._n_jobs == 1 or len(jobs) <= 1:
+            for job in jobs:
+                result = _run_subject(job)
+                self.__report__(result)
+                results[result.subject] = result
+        else:
+            pool = multiprocessing.Pool(min(self._n_jobs, len(jobs)), maxtasksperchild=1)
+            try:
+                for result in pool.imap_unordered(_run_subject, jobs):
+                    self.__report__(result)
+                    results[result.subject] = result
+                pool.close()
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        ordered = OrderedDict((subject.subcode(), results[subject.subcode()]) for subject in subjects)
+        self.summary(ordered)
+
+        if not all(result.success for result in ordered.itervalues()):
+            raise SubjectsFailed(ordered)
+        return ordered
+
+    def __report__(self, result):
+        status = 'Finished' if result.success else 'Failed'
+        print ">>> {} sub{:0>3} ({:.1f}s)".format(status, result.subject, result.elapsed)
+
+    def summary(self, results):
+        print ">>> Preprocessing summary"
+        for subcode, result in results.iteritems():
+            print "sub{:0>3}\t{:<8}{:>10.1f}s".format(subcode, 'OK' if result.success else 'FAILED', result.elapsed)
+        for subcode, result in results.iteritems():
+            if not result.success:
+                print "---- sub{:0>3} ----\n{}".format(subcode, result.error)
+
+        failed = [subcode for subcode, result in results.iteritems() if not result.success]
+        print ">>> {} succeeded, {} failed".format(len(results) - len(failed), len(failed))
+
+
+def estimate_footprint(nifti_file, factor=3):
+    """
+        Estimates the memory a tool needs to process an image, from its NIfTI header only
+
+        FSL works on float32 copies of the data and usually holds the input and the output together,
+        hence the factor. Returns 0 when the file doesn't exist yet.
+    """
+    if not os.path.isfile(nifti_file):
+        return 0
+
+    shape = nibabel.load(nifti_file).header.get_data_shape()
+    return int(np.prod(shape, dtype=np.int64)) * 4 * factor
+
+
+def available_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class RunPool(object):
+
+    def __init__(self, n_jobs=1, memory_limit=None):
+        """
+            Bounded worker pool for the per-run stages (taskxxx_runxxx directories)
+
+            A run is admitted only when the estimated footprints of the running runs plus its own fit in
+            memory_limit, so large 4D runs don't get swapped out when many of them are processed together.
+            A single run is always admitted, even when it is larger than the limit.
+
+            Parameters
+                n_jobs = number of runs processed concurrently (None = number of cores)
+                memory_limit = bytes available to the running stages (None = 75% of the physical memory)
+        """
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._memory_limit = memory_limit or int(available_memory() * 0.75)
+
+    def map(self, func, directories, footprint_files):
+        """
+            Calls func(directory) for every directory
+
+            The work of the stages is done by external tools, so threads are enough to keep the cores busy.
+
+            Parameters
+                func = function that processes a single run directory
+                directories = list of run directories
+                footprint_files = the image each run reads, used to estimate its memory footprint
+
+            Raises
+                Exception listing the failed runs, after all the runs have finished
+        """
+        if self._n_jobs == 1 or len(directories) <= 1:
+            for directory in directories:
+                func(directory)
+            return
+
+        footprints = [estimate_footprint(nifti_file) for nifti_file in footprint_files]
+        condition = threading.Condition()
+        state = {'in_use': 0}
+
+        def admitted(job):
+            directory, footprint = job
+            with condition:
+                while state['in_use'] > 0 and state['in_use'] + footprint > self._memory_limit:
+                    condition.wait()
+                state['in_use'] += footprint
+            try:
+                func(directory)
+                return directory, None
+            except Exception:
+                return directory, traceback.format_exc()
+            finally:
+                with condition:
+                    state['in_use'] -= footprint
+                    condition.notify_all()
+
+        pool = ThreadPool(min(self._n_jobs, len(directories)))
+        try:
+            results = pool.map(admitted, zip(directories, footprints))
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [(directory, error) for directory, error in results if error is not None]
+        if failed:
+            raise Exception("{} run(s) failed:\n{}".format(
+                len(failed), '\n'.join('{}\n{}'.format(directory, error) for directory, error in failed)))
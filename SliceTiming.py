@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+import os
+import json
+import nibabel
+import numpy as np
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data, mask_data
+from Highpass import repetition_time
+
+
+def interleaved_order(slices):
+    """
+        Acquisition order of fsl slicetimer --odd (0 based): 0, 2, 4, ... then 1, 3, 5, ...
+    """
+    return range(0, slices, 2) + range(1, slices, 2)
+
+
+def order_to_times(order, tr):
+    """
+        Acquisition time (seconds from the start of the volume) of every slice, from the acquisition order
+
+        Parameters
+            order = slice indices (0 based) in the order they were acquired
+    """
+    times = np.zeros(len(order))
+    times[list(order)] = np.arange(len(order)) * tr / len(order)
+    return times
+
+
+# seconds per unit of the NIfTI time unit
+TIME_UNITS = {'sec': 1.0, 'msec': 1e-3, 'usec': 1e-6}
+
+
+def run_sidecar(bold_file):
+    """
+        The JSON sidecar of the run of bold_file: bold.json in its directory (the sidecar of the converted
+        bold.nii.gz, the preprocessed files of the run don't have their own)
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(bold_file)), 'bold.json')
+
+
+def sidecar_slice_times(sidecar):
+    """
+        The SliceTiming (seconds) of a JSON sidecar, or None when the sidecar or its SliceTiming is missing
+    """
+    if sidecar is None or not os.path.isfile(sidecar):
+        return None
+
+    with open(sidecar, 'r') as fh:
+        times = json.load(fh).get('SliceTiming')
+    return None if times is None else np.asarray(times, dtype=np.float64)
+
+
+def header_slice_times(img):
+    """
+        The slice times (seconds) of the NIfTI header (slice_code, slice_duration and the slice dimension), or None
+
+        slice_duration is in the time unit of xyzt_units, as the TR.
+    """
+    try:
+        times = img.header.get_slice_times()
+    except Exception:
+        return None  # the header doesn't have them
+    if times is None or any(time is None for time in times):
+        return None
+    return np.asarray(times, dtype=np.float64) * TIME_UNITS.get(img.header.get_xyzt_units()[1], 1.0)
+
+
+def shift_series(data, shift):
+    """
+        Shifts time series by a fraction of a volume with a Fourier phase ramp
+
+        The series are mirrored before the FFT so the end of the run doesn't wrap around to its start.
+
+        Parameters
+            data = (time x voxels) matrix
+            shift = volumes to shift by, the result at volume n is the signal at n + shift
+
+        Returns
+            (time x voxels) float32 matrix
+    """
+    volumes = data.shape[0]
+    padded = np.concatenate([data, data[::-1]], axis=0)
+    frequencies = np.fft.rfftfreq(padded.shape[0])[:, np.newaxis]
+
+    spectrum = np.fft.rfft(padded, axis=0) * np.exp(2j * np.pi * frequencies * shift)
+    return np.fft.irfft(spectrum, n=padded.shape[0], axis=0)[:volumes].astype(np.float32)
+
+
+class SliceTimer(object):
+
+    def __init__(self, tr=None, slice_order=None, interleaved=True, ref_time=None):
+        """
+            Slice timing correction: every slice is shifted to the same time of the volume
+
+            The acquisition time of the slices is taken from (in this order)
+                1) slice_order - custom acquisition order
+                2) the JSON sidecar of the run (SliceTiming of bold.json, as written by dcm2niix)
+                3) the NIfTI header (slice_code / slice_duration)
+                4) interleaved (fsl slicetimer --odd) or sequential ascending order
+
+            All the in-mask voxels of a slice share one shift, so a slice is shifted by one batched FFT.
+            The slices are shifted one after the other, the runs are corrected concurrently by the RunPool.
+
+            Parameters
+                tr = TR in seconds (None = from the header of the run)
+                slice_order = slice indices (0 based) in the order of acquisition
+                interleaved = the default order when nothing else is known
+                ref_time = the time (seconds from the start of the volume) the slices are shifted to
+                           (None = the middle of the TR, as slicetimer)
+        """
+        self._tr = tr
+        self._slice_order = slice_order
+        self._interleaved = interleaved
+        self._ref_time = ref_time
+
+    def slice_times(self, bold_file, img=None, sidecar=None):
+        """
+            Parameters
+                sidecar = the JSON sidecar of the run (None = bold.json in the directory of bold_file)
+
+            Returns
+                (slice times in seconds, TR, slice axis, source of the times)
+        """
+        img = img or nibabel.load(bold_file)
+        tr = self._tr or repetition_time(img)
+
+        slice_axis = img.header.get_dim_info()[2]
+        slice_axis = 2 if slice_axis is None else slice_axis
+        slices = img.shape[slice_axis]
+
+        if self._slice_order is not None:
+            return order_to_times(self._slice_order, tr), tr, slice_axis, 'custom'
+
+        times = sidecar_slice_times(sidecar or run_sidecar(bold_file))
+        if times is not None:
+            return times, tr, slice_axis, 'sidecar'
+
+        times = header_slice_times(img)
+        if times is not None:
+            return times, tr, slice_axis, 'header'
+
+        order = interleaved_order(slices) if self._interleaved else range(slices)
+        return order_to_times(order, tr), tr, slice_axis, 'interleaved' if self._interleaved else 'sequential'
+
+    def correct_image(self, in_file, out_file, mask_file=None, sidecar=None):
+        """
+            Parameters
+                in_file = 4D run
+                out_file = the corrected run (float32)
+                mask_file = voxels to correct (None = the voxels that are non zero in the first volume),
+                            everything else is 0 in out_file
+                sidecar = the JSON sidecar of the run (None = bold.json in the directory of in_file)
+
+            Returns
+                the slice times used
+        """
+        img = nibabel.load(in_file)
+        times, tr, slice_axis, source = self.slice_times(in_file, img, sidecar)
+        if len(times) != img.shape[slice_axis]:
+            raise ValueError("{} slice times for {} slices in {}".format(len(times), img.shape[slice_axis], in_file))
+
+        data = float32_data(img)
+        if mask_file is None:
+            brain_mask = data[..., 0] != 0
+        else:
+            brain_mask = mask_data(mask_file)
+
+        ref_time = tr / 2.0 if self._ref_time is None else self._ref_time
+
+        # slices as the first axis: views, so every slice writes back in place
+        slice_data = np.rollaxis(data, slice_axis)
+        slice_masks = np.rollaxis(brain_mask, slice_axis)
+
+        for index in range(len(times)):
+            mask = slice_masks[index]
+            if not mask.any():
+                slice_data[index][...] = 0
+                continue
+            # (time x voxels) matrix of the slice
+            series = slice_data[index][mask].T
+            shifted = shift_series(series, (ref_time - times[index]) / tr)
+            slice_data[index][...] = 0
+            slice_data[index][mask] = shifted.T
+
+        print ">>>> Slice times from {} (TR {}s)".format(source, tr)
+
+        out_img = nibabel.Nifti1Image(data, img.affine, img.header.copy())
+        out_img.set_data_dtype(np.float32)
+        with AtomicOutput(out_file) as output:
+            nibabel.save(out_img, output.temp())
+
+        return times
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+import multiprocessing
+import nibabel
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from scipy import ndimage
+from AtomicOutput import AtomicOutput
+from ImageData import float32_data, mask_data
+
+
+def fwhm_to_sigma(fwhm, voxel_size):
+    """
+        Gaussian sd in voxels of every axis, for a fwhm in mm
+    """
+    return [fwhm / np.sqrt(8 * np.log(2)) / size for size in voxel_size]
+
+
+class GaussianSmoother(object):
+
+    def __init__(self, fwhm, mask_normalized=False, n_jobs=None, batch_size=10):
+        """
+            Separable Gaussian smoothing of 3D/4D images, a fast alternative to SUSAN
+
+            SUSAN weights every neighbour by its brightness similarity as well, which preserves edges but
+            is much slower. Here every volume is filtered with a separable Gaussian (scipy.ndimage),
+            the volumes are split into batches that are smoothed concurrently by a thread pool.
+
+            With mask_normalized the signal outside the brain doesn't leak in: the smoothed masked image is
+            divided by the smoothed mask (the weight of the in-mask neighbours), and the voxels outside the
+            mask are 0.
+
+            Parameters
+                fwhm = fwhm of the kernel in mm
+                mask_normalized = smooth within the mask only
+                n_jobs = number of batches smoothed concurrently (None = number of cores)
+                batch_size = number of volumes in a batch
+        """
+        self._fwhm = fwhm
+        self._mask_normalized = mask_normalized
+        self._n_jobs = n_jobs or multiprocessing.cpu_count()
+        self._batch_size = batch_size
+
+    def smooth(self, data, voxel_size, brain_mask=None):
+        """
+            Parameters
+                data = 3D or 4D array (smoothed in place when it's float32)
+                voxel_size = voxel size in mm of the 3 spatial axes
+                brain_mask = 3D boolean array, required when mask_normalized
+
+            Returns
+                float32 array
+        """
+        data = np.asarray(data, dtype=np.float32)
+        volumes = data[..., np.newaxis] if data.ndim == 3 else data
+        sigma = fwhm_to_sigma(self._fwhm, voxel_size)
+
+        weights = None
+        if self._mask_normalized:
+            mask = brain_mask.astype(np.float32)
+            weights = ndimage.gaussian_filter(mask, sigma, mode='constant')
+            weights[~brain_mask] = 1  # avoids dividing by 0, these voxels are zeroed anyway
+
+        def smooth_batch(start):
+            for index in range(start, min(start + self._batch_size, volumes.shape[3])):
+                volume = volumes[..., index]
+                if weights is None:
+                    volume[...] = ndimage.gaussian_filter(volume, sigma, mode='nearest')
+                else:
+                    volume[~brain_mask] = 0
+                    volume[...] = ndimage.gaussian_filter(volume, sigma, mode='constant') / weights
+                    volume[~brain_mask] = 0
+
+        starts = range(0, volumes.shape[3], self._batch_size)
+        pool = ThreadPool(min(self._n_jobs, len(starts)))
+        try:
+            pool.map(smooth_batch, starts)
+        finally:
+            pool.close()
+            pool.join()
+
+        return data
+
+    def smooth_image(self, in_file, out_file, mask_file=None):
+        """
+            Parameters
+                mask_file = mask of the mask normalized smoothing (None = the non zero voxels of the
+                            image / of its first volume)
+        """
+        img = nibabel.load(in_file)
+        data = float32_data(img)
+
+        brain_mask = None
+        if self._mask_normalized:
+            if mask_file is None:
+                brain_mask = (data if data.ndim == 3 else data[..., 0]) != 0
+            else:
+                brain_mask = mask_data(mask_file)
+
+        smoothed = self.smooth(data, img.header.get_zooms()[:3], brain_mask)
+
+        out_img = nibabel.Nifti1Image(smoothed, img.affine, img.header.copy())
+        out_img.set_data_dtype(np.float32)
+        with AtomicOutput(out_file) as output:
+            nibabel.save(out_img, output.temp())
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+import os
+import json
+import hashlib
+from AtomicOutput import AtomicOutput
+
+
+class StageCache(object):
+
+    SIDECAR_EXT = '.prov.json'
+
+    def __init__(self, adopt_legacy=False):
+        """
+            Provenance cache of the preprocessing stage outputs
+
+            Every output gets a sidecar (<output>.prov.json) holding a key, which is the hash of the stage name,
+            its parameters and the keys of its inputs (each with its role: its position and file name).
+            The key of an input is the key of its own sidecar when it was produced by an earlier stage, or the
+            hash of its content otherwise (raw data, standard images). Keys therefore chain through the pipeline:
+            when a stage is re-run with new parameters its output gets a new key, and exactly the stages that
+            read it (directly or further downstream) stop matching.
+
+            Only stage outputs get sidecars. The content hashes of the other inputs are kept in the sidecar of
+            the stage that read them, with their size and mtime, and are reused while the input doesn't change.
+
+            Parameters
+                adopt_legacy = outputs that exist without a sidecar (created before the cache existed) are
+                               considered up to date and get a sidecar, instead of being recomputed - whatever
+                               parameters they were made with, so it's off unless asked for. An output whose
+                               sidecar doesn't match it (modified after the stage) is always out of date
+        """
+        self._adopt_legacy = adopt_legacy
+        self._content_hashes = dict()
+
+    def sidecar(self, path):
+        return path + self.SIDECAR_EXT
+
+    def is_current(self, output, stage, inputs, params):
+        """
+            Checks whether output was produced by stage from the current inputs with the same parameters
+
+            Parameters
+                output = path of the stage output
+                stage = name of the stage
+                inputs = list of the files the stage reads
+                params = dictionary of the stage parameters
+
+            Returns
+                True when the stage can be skipped
+        """
+        if not os.path.exists(output):
+            return False
+
+        if not os.path.isfile(self.sidecar(output)):
+            if self._adopt_legacy:
+                self.record(output, stage, inputs, params)
+                return True
+            return False
+
+        provenance = self.__read__(output)
+        if provenance is None:
+            # the output was modified or partially rewritten after its sidecar was written
+            print ">>>> {} is out of date (changed since {} recorded it)".format(output, stage)
+            return False
+
+        if provenance.get('stage') is None:
+            # a legacy output whose content hash was kept when a later stage read it
+            if self._adopt_legacy:
+                self.record(output, stage, inputs, params)
+                return True
+            return False
+
+        if provenance.get('key') != self.key(stage, inputs, params, provenance):
+            print ">>>> {} is out of date ({} inputs or parameters changed)".format(output, stage)
+            return False
+
+        return True
+
+    def record(self, output, stage, inputs, params):
+        """
+            Writes the sidecar of a stage output after the stage finished successfully
+        """
+        input_keys = dict((path, self.file_key(path)) for path in inputs)
+        input_stats = dict((path, self.__stat__(path)) for path in inputs
+                           if os.path.exists(path) and self.__read__(path) is None)
+        self.__write__(output, {'stage': stage,
+                                'key': self.__stage_hash__(stage, inputs, input_keys, params),
+                                'params': params,
+                                'inputs': input_keys,
+                                'input_stats': input_stats})
+
+    def invalidate(self, output):
+        if os.path.isfile(self.sidecar(output)):
+            os.remove(self.sidecar(output))
+
+    def relocate(self, path, new_path):
+        """
+            Moves the sidecar of path to new_path, which holds the same data (e.g. path after compression)
+
+            The key is kept, so the stages that read path are still up to date when they read new_path
+        """
+        provenance = self.__read__(path)
+        if provenance is None:
+            return
+
+        self.__write__(new_path, provenance)
+        self.invalidate(path)
+
+    def key(self, stage, inputs, params, recorded=None):
+        """
+            Parameters
+                recorded = provenance of an earlier record of the stage, whose content hashes of the inputs
+                           are reused when the inputs didn't change since
+        """
+        input_keys = dict((path, self.file_key(path, recorded)) for path in inputs)
+        return self.__stage_hash__(stage, inputs, input_keys, params)
+
+    def file_key(self, path, recorded=None):
+        """
+            The provenance key of a stage output, or the content hash of any other file
+
+            Hashing the raw 4D data is expensive, so the hash is taken from recorded (see key) or from this
+            object's memory when the size and mtime of the file didn't change
+        """
+        if not os.path.exists(path):
+            return 'missing'
+
+        provenance = self.__read__(path)
+        if provenance is not None:
+            return provenance['key']
+
+        stat = self.__stat__(path)
+        if recorded is not None and recorded.get('input_stats', dict()).get(path) == stat:
+            return recorded['inputs'][path]
+
+        fingerprint = (path,) + tuple(stat)
+        if fingerprint not in self._content_hashes:
+            self._content_hashes[fingerprint] = self.__content_hash__(path)
+        return self._content_hashes[fingerprint]
+
+    def __stage_hash__(self, stage, inputs, input_keys, params):
+        # every input key with its role (position and file name), so swapping two inputs changes the key
+        roles = sorted(('{}:{}'.format(position, os.path.basename(path)), input_keys[path])
+                       for position, path in enumerate(inputs))
+        description = json.dumps({'stage': stage, 'inputs': roles, 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha1(description).hexdigest()
+
+    def __stat__(self, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    def __content_hash__(self, path):
+        sha = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def __read__(self, path):
+        """
+            Returns the sidecar of path, or None when it is missing or path was modified after it was written
+        """
+        sidecar = self.sidecar(path)
+        if not os.path.isfile(sidecar):
+            return None
+
+        with open(sidecar, 'r') as fh:
+            try:
+                provenance = json.load(fh)
+            except ValueError:
+                return None
+
+        stat = os.stat(path)
+        if provenance.get('size') != stat.st_size or provenance.get('mtime') != stat.st_mtime:
+            return None
+
+        return provenance
+
+    def __write__(self, path, provenance):
+        stat = os.stat(path)
+        provenance['size'] = stat.st_size
+        provenance['mtime'] = stat.st_mtime
+
+        # a crash can't leave a truncated sidecar behind
+        with AtomicOutput(self.sidecar(path)) as output:
+            with open(output.temp(), 'w') as fh:
+                json.dump(provenance, fh, sort_keys=True, indent=1)
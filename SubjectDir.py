@@ -1,12 +1,21 @@
 ﻿#!/usr/bin/python
 
 import os
+import json
+import time
+import hashlib
+import shutil
+import subprocess
+import multiprocessing
 from glob import glob
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 import pandas as pd
+from AtomicOutput import AtomicOutput
 
 class SubjectDir(object):
-    def __init__(self, subject_code, path, raw_path=None, task_order=None, task_mapping=None, createbehavdict=None):
+    def __init__(self, subject_code, path, raw_path=None, task_order=None, task_mapping=None, createbehavdict=None,
+                 dcm_jobs=None, reingest=False, raw_series=None):
         """
 		Subject Directory Initialization
 
@@ -16,6 +25,11 @@ class SubjectDir(object):
 			task_order.txt: List from to task_order.txt
 			task_mapping: List from task_mapping.txt
 			createbehavdict: dictionary[2] {'func': function that creates the conditions of the models, 'behav': behavioural path}
+			dcm_jobs: Number of dicom series converted concurrently (None = number of cores)
+			reingest: Refresh an existing directory from raw_path - only the dicom series that are new or
+			          changed since they were converted are converted again
+			raw_series: {'anatomical': MPRAGE directory, 'functional': [ep2 directories]} from the study's RawIndex.
+			            When not given the series are found by globbing raw_path
 		"""
 
         print("Subject {}".format(subject_code))
@@ -26,6 +40,9 @@ class SubjectDir(object):
         self._task_mapping = task_mapping
         self._subject_code = subject_code
         self._create_behav_dict = createbehavdict
+        self._dcm_jobs = dcm_jobs or multiprocessing.cpu_count()
+        self._conversion_timings = dict()
+        self._raw_series = raw_series
 
         self._subdirs = {'functional': 'BOLD',
                          'anatomical': 'anatomy',
@@ -48,6 +65,10 @@ class SubjectDir(object):
                 print("Preparing the subject subdirectories")
                 self.__create_subject_dirtree__()
 
+        elif reingest and raw_path is not None:
+            print("Re-ingesting the subject from {}".format(raw_path))
+            self.__create_subject_dirtree__()
+
         self.__load_dirtree__()
 
     def __isValid__(self, path):
@@ -154,49 +175,160 @@ class SubjectDir(object):
             func(self, onset_dirs, behav)
 
     def __dcm_convert__(self, source_directory, target_directory, target_filename, rename_prefix, erase=False):
-        cmd = "dcm2nii -o {} {} > /dev/null".format(target_directory, source_directory)
-        os.system(cmd)
+        """
+		Converts a single dicom series to target_directory/target_filename.nii.gz
+
+		dcm2nii writes to a staging directory of its own, so the file we rename can only come from this series
+		even when other series are converted into the same directory at the same time
+
+		Returns the conversion time in seconds
+		"""
+        start = time.time()
 
-        nii_files = glob("{}/{}*".format(target_directory, rename_prefix))
-        if (len(nii_files) == 0):
-            print("Error: Check that your dicom files are ok, dcm2nii doesn't convert well")
-        os.rename(nii_files[0], os.path.join(target_directory, '{}.nii.gz'.format(target_filename)))
+        staging_dir = os.path.join(target_directory,
+                                   '.dcm2nii_{}'.format(os.path.basename(source_directory.rstrip('/'))))
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
 
-        if erase:
-            for file_name in glob("{}/*".format(target_directory)):
-                if target_filename not in file_name:
-                    os.remove(file_name)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['dcm2nii', '-o', staging_dir, source_directory], stdout=devnull)
+
+            nii_files = sorted(glob("{}/{}*".format(staging_dir, rename_prefix)))
+            if (len(nii_files) == 0):
+                raise Exception("Error: Check that your dicom files are ok, dcm2nii doesn't convert well ({})".format(
+                    source_directory))
+            os.rename(nii_files[0], os.path.join(target_directory, '{}.nii.gz'.format(target_filename)))
+
+            if not erase:
+                for file_name in glob("{}/*".format(staging_dir)):
+                    os.rename(file_name, os.path.join(target_directory, os.path.basename(file_name)))
+        finally:
+            shutil.rmtree(staging_dir)
+
+        return time.time() - start
 
     def __dcm_to_nii__(self, dummy=False):
         """
 		Converts the dicom files:
 			- MPRAGE directory ->  NIFTY in anatomical folder(anatomy/highres001.nii.gz)
 			- ep2 directories ->  NIFTY in functional folder(bold/taskxxx_runxxx/bold.nii.gz)
+
+		All the series are converted concurrently (dcm_jobs at a time)
 		"""
-        raw_anatomical = glob("{}/*MPRAGE*".format(self._raw_path))[
-            0]  # The anatomical directory in the raw data contains MPRAGE
-        raw_functional_dirs = sorted(
-            glob("{}/*ep2*".format(self._raw_path)))  # The functional directories in the raw data contains ep2
+        if self._raw_series is not None:
+            raw_anatomical = self._raw_series['anatomical']
+            raw_functional_dirs = self._raw_series['functional']
+        else:
+            raw_anatomical = glob("{}/*MPRAGE*".format(self._raw_path))[
+                0]  # The anatomical directory in the raw data contains MPRAGE
+            raw_functional_dirs = sorted(
+                glob("{}/*ep2*".format(self._raw_path)))  # The functional directories in the raw data contains ep2
 
         print("Converting DCM to NII")
 
-        if dummy:
-            print "self.__dcm_convert__(raw_anatomical, self.anatomical_dir(), 'highres001', 'co', True)"
-        else:
-            self.__dcm_convert__(raw_anatomical, self.anatomical_dir(), 'highres001', 'co', True)
+        conversions = [(raw_anatomical, self.anatomical_dir(), 'highres001', 'co', True)]
+
+        # Matching the tasks(from task_order.txt.txt) to the functional directories of the raw data(ep2) and converting the dicom files to nifty
+        for raw_functional_directory, run_name in zip(raw_functional_dirs, self._task_order):
+            conversions.append((raw_functional_directory,
+                                os.path.join(self.functional_dir(), run_name),
+                                'bold',
+                                '',
+                                False))
 
         if dummy:
-            print "creating functional niis"
-        else:
-            # Matching the tasks(from task_order.txt.txt) to the functional directories of the raw data(ep2) and converting the dicom files to nifty
-            for raw_functional_directory, run_name in zip(raw_functional_dirs, self._task_order):
-                self.__dcm_convert__(raw_functional_directory,
-                                     os.path.join(self.functional_dir(), run_name),
-                                     'bold',
-                                     '',
-                                     False)
+            for conversion in conversions:
+                print "self.__dcm_convert__{}".format(conversion)
+            return
+
+        # Series that didn't change since they were converted are kept as they are. An output converted before
+        # the fingerprints were kept (no fingerprint recorded) is adopted with the current fingerprint of its series,
+        # reconverting it would rewrite the bold files and invalidate every stage that was run on them
+        fingerprints = self.__load_fingerprints__()
+        changed = []
+        adopted = False
+        for conversion in conversions:
+            source_directory, target_directory, target_filename = conversion[:3]
+            target = os.path.relpath(os.path.join(target_directory, '{}.nii.gz'.format(target_filename)), self._path)
+            fingerprint = self.__series_fingerprint__(source_directory)
+            converted = os.path.isfile(os.path.join(self._path, target))
+
+            if converted and target not in fingerprints:
+                fingerprints[target] = fingerprint
+                adopted = True
+                print "{:<50s}{:>9s}".format(os.path.basename(source_directory.rstrip('/')), 'adopted')
+            elif converted and fingerprints[target] == fingerprint:
+                print "{:<50s}{:>9s}".format(os.path.basename(source_directory.rstrip('/')), 'unchanged')
+            else:
+                changed.append((conversion, target, fingerprint))
+
+        if len(changed) == 0:
+            if adopted:
+                self.__save_fingerprints__(fingerprints)
+            print("Finished Converting DCM to NII")
+            return
+
+        def convert(job):
+            conversion, target, fingerprint = job
+            return self.__dcm_convert__(*conversion)
+
+        pool = ThreadPool(min(self._dcm_jobs, len(changed)))
+        try:
+            timings = pool.map(convert, changed)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (conversion, target, fingerprint), elapsed in zip(changed, timings):
+            series = os.path.basename(conversion[0].rstrip('/'))
+            self._conversion_timings[series] = elapsed
+            fingerprints[target] = fingerprint
+            print "{:<50s}{:>8.1f}s".format(series, elapsed)
+
+        self.__save_fingerprints__(fingerprints)
+
         print("Finished Converting DCM to NII")
 
+    def __series_fingerprint__(self, source_directory):
+        """
+		Fingerprint of a raw dicom series: the name, size and modification time of every file in it
+		"""
+        sha = hashlib.sha1()
+        file_names = sorted(os.listdir(source_directory))
+        for file_name in file_names:
+            stat = os.stat(os.path.join(source_directory, file_name))
+            sha.update("{}\t{}\t{}\n".format(file_name, stat.st_size, stat.st_mtime))
+
+        return {'source': os.path.basename(source_directory.rstrip('/')),
+                'files': len(file_names),
+                'hash': sha.hexdigest()}
+
+    def __fingerprints_file__(self):
+        return os.path.join(self._path, '.raw_fingerprints.json')
+
+    def __load_fingerprints__(self):
+        """
+		Fingerprints of the converted series, by their output file (relative to the subject directory)
+		"""
+        if not os.path.isfile(self.__fingerprints_file__()):
+            return dict()
+
+        with open(self.__fingerprints_file__(), 'r') as fh:
+            return json.load(fh)
+
+    def __save_fingerprints__(self, fingerprints):
+        with AtomicOutput(self.__fingerprints_file__()) as output:
+            with open(output.temp(), 'w') as fh:
+                json.dump(fingerprints, fh, sort_keys=True, indent=1)
+
+    def conversion_timings(self):
+        """
+		Conversion time (seconds) of every dicom series converted by this object
+		"""
+        return self._conversion_timings
+
     def path(self):
         return self._path
 
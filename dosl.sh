@@ -9,62 +9,21 @@ flavor=$3
 dir=${DATA_DIR}/LP/mvpa
 ds_dir=${dir}/ds/${flavor}
 res_dir=${dir}/results/${flavor}
+code_dir="$(dirname "$0")"
 mkdir -p ${dir}/results/${flavor}
-for iter in `seq 0 $nperm`;
-        do
-	if [ "$iter" = "0" ]; then
-		pymvpa2 searchlight \
-			-i ${ds_dir}/sub${sub}_14_hrf.hdf5 \
-			--payload pymvpa2_cv_setup.py \
-			--neighbors 2 \
-			--cv-balance-training 'equal' \
-			--scatter-rois 2 \
-			--nproc 40\
-			-o ${res_dir}/sub${sub}_14_hrf_sl_orig.hdf5
-			
-		pymvpa2 searchlight \
-			-i ${ds_dir}/sub${sub}_23_hrf.hdf5 \
-			--payload pymvpa2_cv_setup.py \
-			--neighbors 2 \
-			--cv-balance-training 'equal' \
-			--scatter-rois 2 \
-			--nproc 40\
-			-o ${res_dir}/sub${sub}_23_hrf_sl_orig.hdf5
-	else
-		iter="$(zeropad $iter 3)"
-		echo $iter
-		pymvpa2 searchlight \
-			-i ${ds_dir}/sub${sub}_14_hrf.hdf5 \
-			--payload pymvpa2_cv_setup.py \
-			--neighbors 2 \
-			--cv-balance-training 'equal' \
-			--scatter-rois 2 \
-			--nproc 40\
-			-o ${res_dir}/sub${sub}_14_hrf_sl_perm${iter}.hdf5
-		# save some space: we only need the samples
-			pymvpa2 dump \
-				-i ${res_dir}/sub${sub}_14_hrf_sl_perm${iter}.hdf5 \
-				-o ${res_dir}/sub${sub}_14_hrf_sl_perm${iter}.npy \
-				-f npy \
-				-s
-		
-
-		pymvpa2 searchlight \
-			-i ${ds_dir}/sub${sub}_23_hrf.hdf5 \
-			--payload pymvpa2_cv_setup.py \
-			--neighbors 2 \
-			--cv-balance-training 'equal' \
-			--scatter-rois 2 \
-			--nproc 40\
-			-o ${res_dir}/sub${sub}_23_hrf_sl_perm${iter}.hdf5
-		# save some space: we only need the samples
-			pymvpa2 dump \
-				-i ${res_dir}/sub${sub}_23_hrf_sl_perm${iter}.hdf5 \
-				-o ${res_dir}/sub${sub}_23_hrf_sl_perm${iter}.npy \
-				-f npy \
-				-s
-		rm ${res_dir}/sub${sub}_14_hrf_sl_perm${iter}.hdf5
-		rm ${res_dir}/sub${sub}_23_hrf_sl_perm${iter}.hdf5
-	fi
-done 
+# The original labels and nperm permutations of condition within chunks, in one session per contrast:
+# all the maps go to one PermutationStore: row 0 is the original map, rows 1..nperm the permutations
+for contrast in 14 23;
+	do
+	python ${code_dir}/permutation_sl.py \
+		-i ${ds_dir}/sub${sub}_${contrast}_hrf.hdf5 \
+		--payload ${code_dir}/pymvpa2_cv_setup.py \
+		--radius 2 \
+		--scatter 2 \
+		--permutations ${nperm} \
+		--seed $((10#${sub})) \
+		--nproc 40 \
+		--cache-dir ${dir}/neighborhoods \
+		-o ${res_dir}/sub${sub}_${contrast}_hrf_sl_perms
+done
 date;
@@ -11,6 +11,7 @@ from mvpa2.mappers.zscore import zscore
 #from nilearn.image import smooth_img
 import nibabel as nb
 import numpy as np
+from MotionMetrics import load_scrub
 
 
 
@@ -27,7 +28,19 @@ def detrend(ds):
 	poly_detrend(ds, polyord=1, chunks_attr='chunks')
 	zscore(ds, chunks_attr='chunks', dtype='float32')
 	return ds
-def make_ds(sub, datapath, flavor):
+def scrub(ds, datapath):
+	# drops the volumes marked by MotionMetrics (motion_scrub.txt of the run)
+	run_dir = _opj(datapath, 'sub%.3i' % ds.sa.subj[0], 'BOLD', 'task%.3i_run%.3i' % (ds.sa.task[0], ds.sa.run[0]))
+	keep = load_scrub(run_dir)
+	if keep is None:
+		raise IOError("No scrubbing mask in {}, run MotionMetrics first".format(run_dir))
+	if len(keep) != len(ds):
+		raise ValueError("{} has {} volumes in the scrubbing mask and {} samples".format(run_dir, len(keep), len(ds)))
+	return ds[keep]
+def make_ds(sub, datapath, flavor, scrub_volumes=False):
+	preproc_ds = detrend
+	if scrub_volumes:
+		preproc_ds = lambda ds: detrend(scrub(ds, datapath))
 	of = OpenFMRIDataset(datapath)
 	ds = of.get_model_bold_dataset(
 	    model_id=1, subj_id=sub,
@@ -36,7 +49,7 @@ def make_ds(sub, datapath, flavor):
 		datapath, 'sub%.3i' % sub, 'masks', 'task001_run001',
 		'grey.nii.gz'),
 	    #preproc_img=smooth,
-	    preproc_ds = detrend, 
+	    preproc_ds = preproc_ds, 
 	    modelfx=fit_event_hrf_model,
 	    time_attr='time_coords',
 	    condition_attr='condition')
@@ -56,7 +69,8 @@ def main():
 	data_dir   	= os.environ.get('DATA_DIR') or '/home/user/data'
 	study_name 	= os.environ.get('STUDY_NAME') or 'LP'
 	flavor		= 'mcf'
-	make_ds(sub, _opj(data_dir,study_name),flavor)
+	scrub_volumes	= os.environ.get('SCRUB') == '1'
+	make_ds(sub, _opj(data_dir,study_name),flavor,scrub_volumes)
 
 
 if __name__ == '__main__':
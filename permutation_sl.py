@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from mvpa2.base.hdf5 import h5load
+from mvpa2.datasets.base import Dataset
+from mvpa2.mappers.zscore import zscore
+from NeighborhoodIndex import NeighborhoodIndex
+from PermutationStore import PermutationStore
+from KernelCV import PrecomputedKernelCV
+from FastSearchlight import FastSearchlight
+
+
+# What the workers score: set before the pool is created, so the forked workers inherit the dataset and the
+# measure instead of having them pickled for every task
+_state = dict()
+
+
+def _score_block(task):
+    """
+        Scores of the spheres of a block of centers under some of the label sets (executed inside a pool worker)
+
+        Parameters
+            task = (centers, positions of the label sets in _state['labels'])
+
+        Returns
+            (centers, (label sets x centers) float32 matrix)
+    """
+    centers, positions = task
+    dataset, measure, index, attr = [_state[key] for key in ['dataset', 'measure', 'index', 'attr']]
+    labels = [_state['labels'][position] for position in positions]
+
+    scores = np.empty((len(labels), len(centers)), dtype=np.float32)
+    for column, center in enumerate(centers):
+        if isinstance(measure, PrecomputedKernelCV):
+            # one kernel of the sphere for all the folds and label sets
+            scores[:, column] = measure.scores(dataset.samples[:, index[center]], labels, dataset.sa.chunks)
+            continue
+
+        sphere = dataset[:, index[center]]
+        for row, permutation in enumerate(labels):
+            sphere.sa[attr] = permutation
+            scores[row, column] = np.asarray(measure(sphere).samples).ravel()[0]
+
+    return centers, scores
+
+
+def load_payload(payload):
+    """
+        The measure (obj) of a pymvpa2 searchlight payload script, such as pymvpa2_cv_setup.py
+    """
+    namespace = dict()
+    execfile(payload, namespace)
+    return namespace['obj']
+
+
+def permute_within(labels, chunks, rng):
+    """
+        The labels shuffled within every chunk (as AttributePermutator(attr, limit='chunks'))
+    """
+    permuted = labels.copy()
+    for chunk in np.unique(chunks):
+        members = np.nonzero(chunks == chunk)[0]
+        permuted[members] = labels[rng.permutation(members)]
+    return permuted
+
+
+def scatter_centers(index):
+    """
+        Centers whose spheres don't contain each other's centers (as pymvpa2 searchlight --scatter-rois),
+        chosen greedily in feature order
+    """
+    covered = np.zeros(len(index), dtype=bool)
+    centers = []
+    for center in range(len(index)):
+        if not covered[center]:
+            centers.append(center)
+            covered[index[center]] = True
+    return np.array(centers)
+
+
+class PermutationSearchlight(object):
+
+    def __init__(self, measure, radius, permutations, seed=0, nproc=None, cache_dir=None, scatter=None,
+                 attr='condition', limit='chunks', block_size=50):
+        """
+            Searchlight of the original labels and of label permutations in a single session
+
+            The dataset is loaded and the neighborhoods are looked up once, then a pool of worker processes
+            (kept alive for the whole session) scores blocks of spheres: every sphere is extracted once and
+            scored under the original labels and all the permutations.
+
+            Parameters
+                measure = the measure of a sphere, e.g. the cross validation of pymvpa2_cv_setup.py, or a
+                          PrecomputedKernelCV (the same linear SVM cross validation, from one kernel per sphere)
+                          or a FastSearchlight (closed-form classifiers of all the spheres at once, in this process)
+                radius = sphere radius in voxels
+                permutations = number of label permutations
+                seed = seed of the permutations, the same seed always gives the same permutations
+                nproc = number of worker processes (None = number of cores)
+                cache_dir = directory of the saved neighborhood indexes (see NeighborhoodIndex)
+                scatter = score only centers at least this radius apart (None = every voxel)
+                attr = the permuted sample attribute
+                limit = the labels are permuted within the groups of this sample attribute
+                block_size = number of spheres in a worker task
+        """
+        self._measure = measure
+        self._radius = radius
+        self._permutations = permutations
+        self._seed = seed
+        self._nproc = nproc or multiprocessing.cpu_count()
+        self._cache_dir = cache_dir
+        self._scatter = scatter
+        self._attr = attr
+        self._limit = limit
+        self._block_size = block_size
+
+    def labels(self, dataset):
+        """
+            (permutations + 1) label arrays, the first one is the original labels
+        """
+        rng = np.random.RandomState(self._seed)
+        labels = dataset.sa[self._attr].value
+        chunks = dataset.sa[self._limit].value
+        return [labels] + [permute_within(labels, chunks, rng) for _ in range(self._permutations)]
+
+    def centers(self, dataset):
+        voxel_indices = dataset.fa.voxel_indices
+        if self._scatter is None:
+            return np.arange(dataset.nfeatures)
+        return scatter_centers(NeighborhoodIndex.cached(voxel_indices, self._scatter, self._cache_dir))
+
+    def __call__(self, dataset, rows=None):
+        """
+            Parameters
+                rows = the label sets scored (None = all of them, 0 = the original labels, i = permutation i),
+                       the permutations are the same whichever rows are scored
+
+            Returns
+                Dataset of rows x features scores, sa.permutation = the label set of every row,
+                fa.center = the features that were scored (the others are NaN)
+        """
+        centers = self.centers(dataset)
+        rows = np.arange(self._permutations + 1) if rows is None else np.asarray(rows)
+        scores = np.empty((len(rows), dataset.nfeatures), dtype=np.float32)
+        first = 0
+        for block_rows, block_scores in self.row_blocks(dataset, rows):
+            scores[first:first + len(block_rows)] = block_scores
+            first += len(block_rows)
+        return self.__result__(dataset, scores, centers, rows)
+
+    def row_blocks(self, dataset, rows=None, row_block=None):
+        """
+            Scores the label sets in blocks of rows, so every block can be saved as soon as it's done
+
+            The dataset, the neighborhoods and the worker processes are set up once for all the blocks.
+            Every sphere is extracted once per block and scored under all the label sets of the block.
+
+            Parameters
+                rows = the label sets scored (see __call__)
+                row_block = number of label sets in a block (None = all of them in one block)
+
+            Returns
+                generator of (rows, (rows x features) scores), the features that weren't scored are NaN
+        """
+        index = NeighborhoodIndex.cached(dataset.fa.voxel_indices, self._radius, self._cache_dir)
+        centers = self.centers(dataset)
+        labels = self.labels(dataset)
+        rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+        row_block = row_block or max(len(rows), 1)
+        center_blocks = [centers[start:start + self._block_size]
+                         for start in range(0, len(centers), self._block_size)]
+
+        start = time.time()
+        if isinstance(self._measure, FastSearchlight):
+            print ">>> {} spheres x {} label sets".format(len(centers), len(rows))
+            for first in range(0, len(rows), row_block):
+                block_rows = rows[first:first + row_block]
+                scores = np.empty((len(block_rows), dataset.nfeatures), dtype=np.float32)
+                scores[:] = np.nan
+                scores[:, centers] = self._measure.scores(dataset.samples, [labels[row] for row in block_rows],
+                                                          dataset.sa.chunks, index, centers)
+                print ">>>> {}/{} label sets ({:.0f}s)".format(first + len(block_rows), len(rows),
+                                                              time.time() - start)
+                yield block_rows, scores
+            return
+
+        print ">>> {} spheres x {} label sets, {} processes".format(len(centers), len(rows), self._nproc)
+        _state.update({'dataset': dataset, 'measure': self._measure, 'index': index, 'attr': self._attr,
+                       'labels': labels})
+        pool = multiprocessing.Pool(self._nproc)
+        try:
+            for first in range(0, len(rows), row_block):
+                block_rows = rows[first:first + row_block]
+                scores = np.empty((len(block_rows), dataset.nfeatures), dtype=np.float32)
+                scores[:] = np.nan
+
+                tasks = [(center_block, block_rows) for center_block in center_blocks]
+                for block, block_scores in pool.imap_unordered(_score_block, tasks):
+                    scores[:, block] = block_scores
+                print ">>>> {}/{} label sets ({:.0f}s)".format(first + len(block_rows), len(rows),
+                                                              time.time() - start)
+                yield block_rows, scores
+        finally:
+            pool.close()
+            pool.join()
+            _state.clear()
+
+    def __result__(self, dataset, scores, centers, rows):
+        scored = np.zeros(dataset.nfeatures, dtype=bool)
+        scored[centers] = True
+
+        result = Dataset(scores, sa={'permutation': rows}, fa=dataset.fa.copy(deep=False),
+                         a=dataset.a.copy(deep=False))
+        result.fa['center'] = scored
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Searchlight of the original labels and of label permutations '
+                                                 '(within chunks) in a single session')
+    parser.add_argument('-i', '--input', required=True, help='dataset (hdf5)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='PermutationStore directory of the maps of all the label sets (created when missing)')
+    parser.add_argument('--rows', type=int, nargs=2, metavar=('START', 'STOP'),
+                        help='score only the label sets START..STOP-1 (0 = the original labels), several processes '
+                             'can fill disjoint rows of the same store')
+    parser.add_argument('--payload', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'pymvpa2_cv_setup.py'),
+                        help='script that defines the measure of a sphere as obj')
+    parser.add_argument('--gram', action='store_true',
+                        help='linear SVM on one precomputed kernel per sphere instead of the payload (the measure of '
+                             'pymvpa2_cv_setup.py, folds by chunks)')
+    parser.add_argument('--backend', choices=FastSearchlight.BACKENDS, default=None,
+                        help='closed-form classifier of all the spheres at once instead of the payload '
+                             '(see FastSearchlight)')
+    parser.add_argument('--radius', type=float, default=2, help='sphere radius in voxels')
+    parser.add_argument('--permutations', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nproc', type=int, default=None, help='worker processes (default: number of cores)')
+    parser.add_argument('--row-block', type=int, default=None,
+                        help='label sets scored and written to the store together, an interrupted run loses at most '
+                             'the block in progress (default: the rows of a block file of the store)')
+    parser.add_argument('--scatter', type=float, default=None, help='score only centers this far apart')
+    parser.add_argument('--zscore', action='store_true', help='z-score the dataset (as pymvpa2_permute_ds.fx)')
+    parser.add_argument('--cache-dir', default=os.environ.get('NEIGHBORHOOD_CACHE'),
+                        help='neighborhood index directory (default: $NEIGHBORHOOD_CACHE or next to the input)')
+    args = parser.parse_args()
+
+    dataset = h5load(args.input)
+    if args.zscore:
+        zscore(dataset, chunks_attr=None)
+
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(args.input)), 'neighborhoods')
+    if args.backend is not None:
+        measure, measure_name = FastSearchlight(args.backend), args.backend
+    elif args.gram:
+        measure, measure_name = PrecomputedKernelCV(), 'gram'
+    else:
+        measure, measure_name = load_payload(args.payload), os.path.basename(args.payload)
+    searchlight = PermutationSearchlight(measure, args.radius, args.permutations, args.seed,
+                                         args.nproc, cache_dir, args.scatter)
+
+    # the number of permutations is the number of rows of the store, more of them can be appended later
+    metadata = {'input': os.path.abspath(args.input), 'measure': measure_name, 'radius': args.radius,
+                'seed': args.seed, 'scatter': args.scatter, 'zscore': args.zscore, 'within': 'chunks'}
+    if 'voxel_dim' in dataset.a:
+        metadata['voxel_dim'] = [int(size) for size in dataset.a.voxel_dim]
+    if 'imgaffine' in dataset.a:
+        metadata['affine'] = np.asarray(dataset.a.imgaffine).tolist()
+    store = PermutationStore.create(args.output, args.permutations + 1, dataset.fa.voxel_indices, metadata)
+
+    rows = np.arange(args.permutations + 1)
+    if args.rows is not None:
+        rows = np.arange(args.rows[0], min(args.rows[1], args.permutations + 1))
+    rows = store.missing_rows(rows)
+    if len(rows) == 0:
+        print ">>> All the rows of {} are done".format(args.output)
+        return
+
+    for block_rows, scores in searchlight.row_blocks(dataset, rows, args.row_block or store.block_rows()):
+        store.write(block_rows, scores)
+    print ">>> {} rows written to {}".format(len(rows), args.output)
+
+
+if __name__ == '__main__':
+    main()
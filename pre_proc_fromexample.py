@@ -22,7 +22,6 @@ import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
 
 
 
@@ -318,17 +317,24 @@ coregister = pe.Node(interface=fsl.FLIRT(dof=6),
                      name = 'coregister')
 
 """
-Use :class:`nipype.algorithms.rapidart` to determine which of the
-images in the functional series are outliers based on deviations in
-intensity and/or movement.
+Use :class:`MotionMetrics` to determine which of the images in the functional
+series are outliers based on framewise displacement and/or DVARS, and which
+volumes to drop by scrubbing (motion_metrics.txt, motion_scrub.txt).
 """
 
-art = pe.MapNode(interface=ra.ArtifactDetect(use_differences = [True, False],
-                                             use_norm = True,
-                                             norm_threshold = 1,
-                                             zintensity_threshold = 3,
-                                             parameter_source = 'FSL',
-                                             mask_type = 'file'),
+def detect_outliers(realigned_files, realignment_parameters, mask_file):
+    import os
+    from MotionMetrics import MotionMetrics, METRICS_FILE, SCRUB_FILE
+    MotionMetrics(fd_threshold=1, dvars_threshold=3).analyze_run(
+        realignment_parameters, realigned_files, mask_file, os.getcwd())
+    return os.path.abspath(METRICS_FILE), os.path.abspath(SCRUB_FILE)
+
+art = pe.MapNode(interface=util.Function(input_names=['realigned_files',
+                                                      'realignment_parameters',
+                                                      'mask_file'],
+                                         output_names=['metrics_file',
+                                                       'scrub_file'],
+                                         function=detect_outliers),
                  iterfield=['realigned_files', 'realignment_parameters'],
                  name="art")
 
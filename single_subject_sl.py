@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from mvpa2.measures.searchlight import sphere_searchlight
+from mvpa2.measures.searchlight import Searchlight
 from mvpa2.clfs.svm import LinearCSVMC
 from mvpa2.generators.partition import NFoldPartitioner
 from mvpa2.measures.base import CrossValidation
@@ -10,9 +10,30 @@ from mvpa2.cmdline.helpers import arg2ds
 from mvpa2.generators.permutation import AttributePermutator
 from mvpa2.clfs.stats import MCNullDist
 from mvpa2.datasets.mri import map2nifti
+from mvpa2.datasets.base import Dataset
+from NeighborhoodIndex import NeighborhoodIndex, NeighborhoodQueryEngine
+from FastSearchlight import FastSearchlight
 import sys
 import os.path
-def do_searchlight(glm_dataset, radius, output_basename, with_null_prob=False):
+def fast_searchlight(glm_dataset, radius, backend, cache_dir=None):
+	# accuracy map of a closed-form classifier (see FastSearchlight), all the spheres scored at once
+	index = NeighborhoodIndex.cached(glm_dataset.fa.voxel_indices, radius, cache_dir)
+	accuracy = FastSearchlight(backend).accuracy(glm_dataset.samples, glm_dataset.sa.condition,
+						     glm_dataset.sa.chunks, index)
+	return Dataset(accuracy[None, :], fa=glm_dataset.fa.copy(deep=False), a=glm_dataset.a.copy(deep=False))
+def do_searchlight(glm_dataset, radius, output_basename, with_null_prob=False, cache_dir=None, backend='svm'):
+	if backend != 'svm':
+		if with_null_prob:
+			raise ValueError("The {} backend has no null distribution here, use permutation_sl.py --backend".format(backend))
+		sl_map = fast_searchlight(glm_dataset, radius, backend, cache_dir)
+		map2nifti(sl_map, imghdr=glm_dataset.a.imghdr).to_filename('{}-acc.nii.gz'.format(output_basename))
+		sl_map.samples *= -1
+		sl_map.samples += 1
+		map2nifti(sl_map, imghdr=glm_dataset.a.imghdr).to_filename('{}-err.nii.gz'.format(output_basename))
+		return
+	# the spheres come from the neighborhood index of the mask (saved in cache_dir), so the permutations
+	# and every later call with the same mask and radius don't search them again
+	queryengine = NeighborhoodQueryEngine(radius, space='voxel_indices', cache_dir=cache_dir)
 	clf  = LinearCSVMC(space='condition')
 #		clf = RbfCSVMC(C=5.0)
 	splt = NFoldPartitioner()
@@ -35,12 +56,12 @@ def do_searchlight(glm_dataset, radius, output_basename, with_null_prob=False):
 		distr_est = MCNullDist(repeater,tail='left', measure=null_sl,
 				       enable_ca=['dist_samples'])
 		"""
-		sl = sphere_searchlight(cv, radius=radius, space='voxel_indices',
+		sl = Searchlight(cv, queryengine=queryengine,
 				null_dist=distr_est,
 				enable_ca=['roi_sizes','roi_feature_ids'])
 	else:
 
-		sl = sphere_searchlight(cv, radius=radius, space='voxel_indices',
+		sl = Searchlight(cv, queryengine=queryengine,
 				enable_ca=['roi_sizes','roi_feature_ids'])
 	#ds = glm_dataset.copy(deep=False,
 	#		       sa=['condition','chunks'],
@@ -71,10 +92,12 @@ def do_searchlight(glm_dataset, radius, output_basename, with_null_prob=False):
 if __name__ == '__main__':
 	filename = sys.argv[1]
 	radius   = int(sys.argv[2])
+	backend  = sys.argv[3] if len(sys.argv) > 3 else 'svm'
 	print filename		
-	output_basename = os.path.join('{}_r{}_c-{}'.format(filename, radius,'linear'))
+	output_basename = os.path.join('{}_r{}_c-{}'.format(filename, radius,'linear' if backend == 'svm' else backend))
 	print output_basename
+	cache_dir = os.environ.get('NEIGHBORHOOD_CACHE') or os.path.join(os.path.dirname(os.path.abspath(filename)), 'neighborhoods')
 	ds = arg2ds([filename])
 	do_searchlight(ds, radius, output_basename ,
 						#False)
-						True)
+						backend == 'svm', cache_dir, backend)
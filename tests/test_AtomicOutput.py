@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AtomicOutput import AtomicOutput
+
+
+class AtomicOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='test-atomic-')
+        self.output_file = os.path.join(self.temp_dir, 'bold_mcf.nii.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, path, content):
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def read(self, path):
+        with open(path, 'r') as fh:
+            return fh.read()
+
+    def test_commit(self):
+        with AtomicOutput(self.output_file) as output:
+            self.write(output.temp(), 'new')
+            self.write(output.temp(os.path.join(self.temp_dir, 'bold_mcf.par')), 'motion')
+            self.assertFalse(os.path.exists(self.output_file))
+
+        self.assertEqual(self.read(self.output_file), 'new')
+        self.assertEqual(self.read(os.path.join(self.temp_dir, 'bold_mcf.par')), 'motion')
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['bold_mcf.nii.gz', 'bold_mcf.par'])
+
+    def test_failed_commit(self):
+        # the tool didn't write its output: the old output is kept, its side outputs are dropped
+        self.write(self.output_file, 'old')
+        with self.assertRaises(IOError):
+            with AtomicOutput(self.output_file) as output:
+                self.write(output.temp(os.path.join(self.temp_dir, 'bold_mcf.par')), 'motion')
+
+        self.assertEqual(self.read(self.output_file), 'old')
+        self.assertEqual(os.listdir(self.temp_dir), ['bold_mcf.nii.gz'])
+
+    def test_exception_rolls_back(self):
+        self.write(self.output_file, 'old')
+        with self.assertRaises(RuntimeError):
+            with AtomicOutput(self.output_file) as output:
+                self.write(output.temp(), 'partial')
+                raise RuntimeError("the tool crashed")
+
+        self.assertEqual(self.read(self.output_file), 'old')
+        self.assertEqual(os.listdir(self.temp_dir), ['bold_mcf.nii.gz'])
+
+    def test_allow_existing(self):
+        self.write(self.output_file, 'old')
+        with AtomicOutput(self.output_file, allow_existing=True):
+            pass
+        self.assertEqual(self.read(self.output_file), 'old')
+
+    def test_temp_outside_the_directory(self):
+        self.assertRaises(ValueError, AtomicOutput(self.output_file).temp, '/tmp/elsewhere/bold.nii.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from KernelCV import nfold_splits
+from NeighborhoodIndex import NeighborhoodIndex
+from FastSearchlight import FastSearchlight
+
+
+def sphere_accuracy(backend, samples, labels, chunks, shrinkage=None):
+    """
+        The cross validated accuracy of one sphere, a classifier at a time
+    """
+    accuracies = []
+    for train, test in nfold_splits(chunks):
+        classes = np.unique(labels[train])
+        members = [samples[train][labels[train] == label] for label in classes]
+        means = np.array([member.mean(axis=0) for member in members])
+        priors = np.log([len(member) / float(len(train)) for member in members])
+
+        if backend == 'correlation':
+            evidence = np.array([[np.corrcoef(sample, mean)[0, 1] for mean in means] for sample in samples[test]])
+        elif backend == 'gnb':
+            variances = np.array([member.var(axis=0) + 1e-9 for member in members])
+            evidence = np.array([[(-0.5 * np.log(2 * np.pi * variance) - (sample - mean) ** 2 / (2 * variance)).sum()
+                                  + prior for mean, variance, prior in zip(means, variances, priors)]
+                                 for sample in samples[test]])
+        else:
+            centered = np.vstack([member - mean for member, mean in zip(members, means)])
+            covariance = centered.T.dot(centered) / len(centered)
+            scale = np.trace(covariance) / len(covariance) * np.eye(len(covariance))
+            covariance = (1 - shrinkage) * covariance + shrinkage * scale + 1e-9 * np.eye(len(covariance))
+            weights = np.linalg.solve(covariance, means.T)
+            evidence = samples[test].dot(weights) - 0.5 * (means * weights.T).sum(axis=1) + priors
+
+        accuracies.append(np.mean(classes[np.argmax(evidence, axis=1)] == labels[test]))
+    return np.mean(accuracies)
+
+
+class FastSearchlightTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.voxel_indices = np.column_stack(np.nonzero(np.ones((5, 5, 4), dtype=bool)))
+        self.chunks = np.repeat(np.arange(3), 9)
+        self.labels = np.tile(np.repeat(['a', 'b', 'c'], 3), 3)
+        self.samples = rng.normal(0, 1, (len(self.labels), len(self.voxel_indices)))
+        self.samples[self.labels == 'a', :30] += 0.8
+        self.index = NeighborhoodIndex.build(self.voxel_indices, 1.5)
+        self.centers = np.arange(0, len(self.index), 7)
+
+    def compare(self, searchlight, backend, shrinkage=None):
+        fast = searchlight.accuracy(self.samples, self.labels, self.chunks, self.index, self.centers)
+        loop = [sphere_accuracy(backend, self.samples[:, self.index[center]], self.labels, self.chunks, shrinkage)
+                for center in self.centers]
+        np.testing.assert_allclose(fast, loop, atol=1e-6)
+
+    def test_correlation_matches_sphere_loop(self):
+        self.compare(FastSearchlight('correlation'), 'correlation')
+
+    def test_gnb_matches_sphere_loop(self):
+        self.compare(FastSearchlight('gnb'), 'gnb')
+
+    def test_lda_matches_sphere_loop(self):
+        self.compare(FastSearchlight('lda', shrinkage=0.3, batch_size=4), 'lda', shrinkage=0.3)
+
+    def test_scores_of_label_sets(self):
+        rng = np.random.RandomState(1)
+        labels = [self.labels, rng.permutation(self.labels)]
+        searchlight = FastSearchlight('gnb')
+        scores = searchlight.scores(self.samples, labels, self.chunks, self.index, self.centers)
+
+        self.assertEqual(scores.shape, (2, len(self.centers)))
+        for row, permutation in enumerate(labels):
+            np.testing.assert_allclose(scores[row], searchlight.accuracy(self.samples, permutation, self.chunks,
+                                                                         self.index, self.centers))
+
+
+if __name__ == '__main__':
+    unittest.main()
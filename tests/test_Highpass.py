@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Highpass import HighpassFilter, running_line_matrix, dct_basis
+
+
+def fslmaths_bptf(series, sigma):
+    """
+        The highpass of fslmaths -bptf (FSL >= 5.0.7) a volume at a time, as in bandpass_temporal_filter
+        of FSL's newimagefns.cc
+    """
+    half_width = int(sigma * 3)
+    filtered = np.empty(len(series))
+    for t in range(len(series)):
+        a = b = c = d = n = 0.0
+        for tt in range(max(t - half_width, 0), min(t + half_width, len(series) - 1) + 1):
+            dt = tt - t
+            w = np.exp(-0.5 * dt * dt / (sigma * sigma))
+            a += w * dt
+            b += w * series[tt]
+            c += w * dt * dt
+            d += w * dt * series[tt]
+            n += w
+        denominator = c * n - a * a
+        filtered[t] = series[t] - (b * c - a * d) / denominator if denominator != 0 else series[t]
+    return filtered
+
+
+class HighpassTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        times = np.arange(120, dtype=np.float64)[:, np.newaxis]
+        self.data = 1000 + 0.5 * times + 20 * np.sin(times / 15.0) + rng.normal(0, 5, (120, 6))
+
+    def test_running_line_matches_fslmaths(self):
+        for sigma in [28, 7.5, 2]:
+            expected = np.column_stack([fslmaths_bptf(voxel, sigma) for voxel in self.data.T])
+            np.testing.assert_allclose(HighpassFilter(sigma=sigma).filter(self.data), expected, rtol=0, atol=1e-3)
+
+    def test_window_of_a_single_volume(self):
+        # int(3 * 0.3) = 0: fslmaths leaves the run as it is
+        self.assertFalse(running_line_matrix(10, 0.3).any())
+        np.testing.assert_allclose(HighpassFilter(sigma=0.3).filter(self.data), self.data, rtol=1e-6)
+
+    def test_keep_mean(self):
+        filtered = HighpassFilter(sigma=10).filter(self.data)
+        kept = HighpassFilter(sigma=10, keep_mean=True).filter(self.data)
+        np.testing.assert_allclose(kept, filtered + self.data.mean(axis=0), rtol=1e-6)
+
+    def test_dct(self):
+        basis = dct_basis(120, 40)
+        np.testing.assert_allclose(basis.T.dot(basis), np.eye(basis.shape[1]), atol=1e-10)
+
+        drift = self.data[:, :1] - self.data.mean(axis=0) + basis.dot(np.arange(basis.shape[1]))[:, np.newaxis]
+        filtered = HighpassFilter(sigma=20, method='dct').filter(drift)
+        np.testing.assert_allclose(filtered.mean(axis=0), 0, atol=1e-3)
+        np.testing.assert_allclose(basis.T.dot(filtered), 0, atol=1e-2)
+
+    def test_cutoff(self):
+        np.testing.assert_allclose(HighpassFilter(cutoff=100).filter(self.data, tr=2.0),
+                                   HighpassFilter(sigma=25).filter(self.data))
+        self.assertRaises(ValueError, HighpassFilter(cutoff=100).filter, self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from KernelCV import PrecomputedKernelCV, kernel_folds, nfold_splits
+
+try:
+    from sklearn.svm import SVC
+except ImportError:
+    SVC = None
+
+
+class KernelCVTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.chunks = np.repeat(np.arange(4), 6)
+        self.labels = np.tile(np.repeat(['a', 'b'], 3), 4)
+        self.samples = rng.normal(0, 1, (len(self.labels), 10))
+        self.samples[self.labels == 'a', :3] += 1.5
+
+    def test_nfold_splits(self):
+        splits = nfold_splits(self.chunks)
+        self.assertEqual(len(splits), 4)
+        for chunk, (train, test) in enumerate(splits):
+            np.testing.assert_array_equal(test, np.arange(chunk * 6, chunk * 6 + 6))
+            np.testing.assert_array_equal(np.sort(np.concatenate([train, test])), np.arange(24))
+
+    def test_kernel_folds(self):
+        for train, test, train_kernel, test_kernel, C in kernel_folds(self.samples, self.chunks):
+            np.testing.assert_allclose(train_kernel, self.samples[train].dot(self.samples[train].T))
+            np.testing.assert_allclose(test_kernel, self.samples[test].dot(self.samples[train].T))
+            # PyMVPA's scaling of a negative C
+            mean_norm = np.linalg.norm(self.samples[train], axis=1).mean()
+            self.assertAlmostEqual(C, 1.0 / mean_norm ** 2)
+
+    def test_positive_C(self):
+        self.assertTrue(all(fold[4] == 2.5 for fold in kernel_folds(self.samples, self.chunks, C=2.5)))
+
+    @unittest.skipIf(SVC is None, "scikit-learn isn't installed")
+    def test_matches_a_linear_svm(self):
+        rng = np.random.RandomState(1)
+        label_sets = [self.labels] + [rng.permutation(self.labels) for _ in range(3)]
+        cv = PrecomputedKernelCV()
+
+        expected = []
+        for labels in label_sets:
+            accuracies = []
+            for train, test, _, _, C in cv.folds(self.samples, self.chunks):
+                clf = SVC(kernel='linear', C=C, tol=5e-5).fit(self.samples[train], labels[train])
+                accuracies.append(np.mean(clf.predict(self.samples[test]) == labels[test]))
+            expected.append(np.mean(accuracies))
+
+        np.testing.assert_allclose(cv.scores(self.samples, label_sets, self.chunks), expected, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
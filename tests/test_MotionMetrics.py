@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MotionMetrics
+
+
+PARAMS = np.array([[0.00, 0.00, 0.0, 0.0, 0.0, 0.0],
+                   [0.01, 0.00, 0.0, 1.0, 0.0, 0.0],
+                   [0.01, -0.02, 0.0, 1.0, 0.5, -0.5]])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_framewise_displacement(self):
+        # |1| + 50 * |0.01| and |0.5| + |-0.5| + 50 * |-0.02|
+        np.testing.assert_allclose(MotionMetrics.framewise_displacement(PARAMS), [0, 1.5, 2.0])
+
+    def test_framewise_displacement_of_concatenated_runs(self):
+        fd = MotionMetrics.framewise_displacement(np.vstack([PARAMS, PARAMS[::-1]]), [3, 3])
+        np.testing.assert_allclose(fd, [0, 1.5, 2.0, 0, 2.0, 1.5])
+
+    def test_dvars(self):
+        # the change of the second volume is (3, 4): sqrt((9 + 16) / 2)
+        brain_data = np.array([[0.0, 0.0], [3.0, 4.0], [3.0, 4.0]])
+        np.testing.assert_allclose(MotionMetrics.dvars(brain_data), [0, np.sqrt(12.5), 0])
+
+    def test_intensity_mask(self):
+        data = np.zeros((10, 10, 10, 3))
+        data[2:8, 2:8, 2:8] = 1000
+        data[0, 0] = 50  # dim background
+        np.testing.assert_array_equal(MotionMetrics.intensity_mask(data), data[..., 0] == 1000)
+
+    def test_scrub_mask(self):
+        flags = np.zeros(8, dtype=bool)
+        flags[3] = True
+        np.testing.assert_array_equal(MotionMetrics.scrub_mask(flags), [1, 1, 0, 0, 0, 0, 1, 1])
+
+
+class StudyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.study_dir = tempfile.mkdtemp(prefix='test-motion-')
+        rng = np.random.RandomState(0)
+        self.brain = np.zeros((6, 6, 4), dtype=bool)
+        self.brain[1:5, 1:5, 1:3] = True
+
+        self.expected = dict()
+        for subject in ['sub001', 'sub002']:
+            run_dir = os.path.join(self.study_dir, subject, 'BOLD', 'task001_run001')
+            mask_dir = os.path.join(self.study_dir, subject, 'masks', 'anatomy')
+            for directory in [run_dir, mask_dir]:
+                os.makedirs(directory)
+
+            data = np.zeros(self.brain.shape + (3,), dtype=np.float32)
+            data[self.brain] = 1000 + rng.normal(0, 1, (self.brain.sum(), 3))
+            data[0, 0, 0] = [0, 5000, 0]  # bright voxel outside of the brain mask
+            nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), os.path.join(run_dir, 'bold_mcf.nii.gz'))
+            nibabel.save(nibabel.Nifti1Image(self.brain.astype(np.uint8), np.eye(4)),
+                         os.path.join(mask_dir, 'brain.nii.gz'))
+            np.savetxt(os.path.join(run_dir, 'bold_mcf.nii.gz.par'), PARAMS)
+            self.expected[run_dir] = MotionMetrics.dvars(data[self.brain].T)
+
+    def tearDown(self):
+        shutil.rmtree(self.study_dir)
+
+    def test_analyze_study(self):
+        results = MotionMetrics.MotionMetrics(fd_threshold=1.8, n_jobs=2, memory_limit=1).analyze_study(self.study_dir)
+
+        self.assertEqual(sorted(results), sorted(self.expected))
+        for run_dir, result in results.iteritems():
+            np.testing.assert_allclose(result['fd'], [0, 1.5, 2.0])
+            np.testing.assert_allclose(result['dvars'], self.expected[run_dir], rtol=1e-5)
+            np.testing.assert_array_equal(result['outliers'], [False, False, True])
+            np.testing.assert_array_equal(MotionMetrics.load_scrub(run_dir), [True, False, False])
+
+            metrics = np.loadtxt(os.path.join(run_dir, MotionMetrics.METRICS_FILE))
+            np.testing.assert_allclose(metrics[:, 0], [0, 1.5, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NeighborhoodIndex import NeighborhoodIndex
+
+
+class NeighborhoodIndexTest(unittest.TestCase):
+
+    def test_matches_distances(self):
+        mask = np.random.RandomState(0).uniform(size=(7, 6, 5)) > 0.3
+        voxel_indices = np.column_stack(np.nonzero(mask))
+        index = NeighborhoodIndex.build(voxel_indices, 2)
+
+        distances = np.sqrt(((voxel_indices[:, np.newaxis] - voxel_indices[np.newaxis]) ** 2).sum(axis=2))
+        self.assertEqual(len(index), len(voxel_indices))
+        for center in range(len(voxel_indices)):
+            np.testing.assert_array_equal(index[center], np.nonzero(distances[center] <= 2)[0])
+
+
+    def test_cached_reloads_the_same_index(self):
+        voxel_indices = np.column_stack(np.nonzero(np.ones((4, 4, 3), dtype=bool)))
+        cache_dir = tempfile.mkdtemp(prefix='test-neighborhoods-')
+        try:
+            built = NeighborhoodIndex.cached(voxel_indices, 1.5, cache_dir)
+            loaded = NeighborhoodIndex.load(os.path.join(cache_dir, built.key() + '.npz'))
+        finally:
+            shutil.rmtree(cache_dir)
+
+        self.assertEqual(loaded.key(), built.key())
+        np.testing.assert_array_equal(loaded.indptr(), built.indptr())
+        np.testing.assert_array_equal(loaded.indices(), built.indices())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PermutationStore import PermutationStore
+
+
+def _write_row(args):
+    path, row, values = args
+    PermutationStore(path).write([row], values[np.newaxis])
+
+
+class PermutationStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='test-store-')
+        self.path = os.path.join(self.temp_dir, 'sub001_14_hrf_sl_perms')
+        self.voxel_indices = np.column_stack(np.nonzero(np.ones((3, 3, 2), dtype=bool)))
+        self.metadata = {'seed': 1, 'radius': 2, 'voxel_dim': [3, 3, 2]}
+        self.values = np.random.RandomState(0).uniform(size=(11, len(self.voxel_indices))).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create(self, rows=11, metadata=None):
+        return PermutationStore.create(self.path, rows, self.voxel_indices, metadata or self.metadata, block_rows=4)
+
+    def test_create(self):
+        store = self.create()
+        self.assertEqual(store.shape(), (11, len(self.voxel_indices)))
+        self.assertEqual(store.block_rows(), 4)
+        np.testing.assert_array_equal(store.voxel_indices(), self.voxel_indices)
+        np.testing.assert_array_equal(store.missing_rows(), np.arange(11))
+        self.assertTrue(np.isnan(store.read()).all())
+        # no block is written before its rows are
+        self.assertFalse([name for name in os.listdir(self.path) if name.startswith('scores_')])
+
+    def test_write_and_reopen(self):
+        store = self.create()
+        rows = np.array([0, 5, 6, 10])
+        store.write(rows, self.values[rows])
+
+        reopened = PermutationStore(self.path)
+        np.testing.assert_array_equal(reopened.missing_rows(), [1, 2, 3, 4, 7, 8, 9])
+        np.testing.assert_array_equal(reopened.missing_rows([4, 5, 6, 7]), [4, 7])
+        np.testing.assert_array_equal(reopened.read(rows), self.values[rows])
+        np.testing.assert_array_equal(reopened.original(), self.values[0])
+        np.testing.assert_array_equal(reopened.read([5, 10], voxels=[2, 7]), self.values[np.ix_([5, 10], [2, 7])])
+        self.assertTrue(np.isnan(reopened.read(slice(1, 5))).all())
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if name.startswith('scores_')),
+                         ['scores_000000.npy', 'scores_000004.npy', 'scores_000008.npy'])
+
+    def test_writers_of_disjoint_rows(self):
+        first, second = self.create(), self.create()
+        first.write([0, 1], self.values[[0, 1]])
+        second.write([2, 3], self.values[[2, 3]])
+        np.testing.assert_array_equal(self.create().read(slice(0, 4)), self.values[:4])
+
+    def test_concurrent_writers(self):
+        self.create()
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(_write_row, [(self.path, row, self.values[row]) for row in range(11)])
+        finally:
+            pool.close()
+            pool.join()
+
+        store = PermutationStore(self.path)
+        self.assertEqual(len(store.missing_rows()), 0)
+        np.testing.assert_array_equal(store.read(), self.values)
+
+    def test_permutations_and_image(self):
+        store = self.create()
+        store.write(np.arange(11), self.values)
+        np.testing.assert_array_equal(store.permutations(voxels=[1, 3]), self.values[1:, [1, 3]])
+
+        volume = store.image(3).get_data()
+        np.testing.assert_array_equal(volume[tuple(self.voxel_indices.T)], self.values[3])
+
+    def test_extend(self):
+        self.create().write([0, 10], self.values[[0, 10]])
+        store = self.create(rows=20)
+        self.assertEqual(PermutationStore(self.path).shape()[0], 20)
+        np.testing.assert_array_equal(store.missing_rows(), [row for row in range(20) if row not in [0, 10]])
+        np.testing.assert_array_equal(store.read(10), self.values[10])
+
+    def test_different_metadata(self):
+        self.create()
+        self.assertRaises(ValueError, self.create, 11, dict(self.metadata, seed=2))
+
+    def test_rows_outside_the_store(self):
+        self.assertRaises(IndexError, self.create().write, [11], self.values[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Benchmark import SyntheticStudy
+from QualityAnalyzer import QualityAnalyzer
+
+
+class QualityAnalyzerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='test-qa-')
+        study = SyntheticStudy(cls.data_dir, subjects=1, runs=1, shape=(12, 12, 10), volumes=37, trials=2)
+        study.create()
+
+        cls.analyzer = QualityAnalyzer(study.fmri_data())
+        cls.files = cls.analyzer.run_files(1)[0]
+        cls.brain_mask = nibabel.load(cls.files['mask']).get_data() > 0
+        cls.brain_data = np.asarray(nibabel.load(cls.files['bold']).dataobj)[cls.brain_mask].astype(np.float64)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def maps(self, output_dir):
+        return dict((name, np.asarray(nibabel.load(os.path.join(output_dir, 'bold_mcf_detrended_{}.nii.gz'.format(
+            name))).dataobj)) for name in ['mean', 'std', 'zscore'])
+
+    def test_detrend_matches_polyfit(self):
+        output_dir = os.path.join(self.data_dir, 'detrend')
+        self.analyzer.detrend_run(self.files['bold'], self.files['mask'], output_dir, block_size=100)
+        maps = self.maps(output_dir)
+
+        # (voxels x time) residuals of a per-voxel linear fit
+        volumes = np.arange(self.brain_data.shape[1])
+        residuals = np.array([voxel - np.polyval(np.polyfit(volumes, voxel, 1), volumes)
+                              for voxel in self.brain_data])
+        std = residuals.std(axis=1)
+
+        np.testing.assert_allclose(maps['mean'][self.brain_mask], self.brain_data.mean(axis=1), rtol=1e-5)
+        np.testing.assert_allclose(maps['std'][self.brain_mask], std, rtol=1e-3)
+        np.testing.assert_allclose(maps['zscore'][self.brain_mask], residuals / std[:, np.newaxis], atol=1e-3)
+        self.assertFalse(maps['zscore'][~self.brain_mask].any())
+
+    def test_stream_matches_whole_run(self):
+        whole_dir = os.path.join(self.data_dir, 'whole')
+        stream_dir = os.path.join(self.data_dir, 'stream')
+        whole = self.analyzer.run_metrics(self.files['bold'], self.files['mask'], self.files['nonbrain'])
+        self.analyzer.detrend_run(self.files['bold'], self.files['mask'], whole_dir)
+
+        # a chunk size that doesn't divide the run, so the last chunk is shorter
+        stream = self.analyzer.stream_run(self.files['bold'], self.files['mask'], self.files['nonbrain'], stream_dir,
+                                          chunk_size=10)
+
+        self.assertEqual(stream['volumes'], whole['volumes'])
+        for key in ['sfnr', 'snr', 'dvars']:
+            self.assertAlmostEqual(stream[key] / whole[key], 1, places=4)
+        for key in ['voxsfnr', 'snr_per_volume', 'dvars_per_volume']:
+            np.testing.assert_allclose(stream[key], whole[key], rtol=1e-4)
+
+        whole_maps, stream_maps = self.maps(whole_dir), self.maps(stream_dir)
+        for name in ['mean', 'std']:
+            np.testing.assert_allclose(stream_maps[name], whole_maps[name], rtol=1e-4)
+        np.testing.assert_allclose(stream_maps['zscore'], whole_maps['zscore'], atol=1e-3)
+        self.assertFalse(os.path.isfile(os.path.join(stream_dir, 'bold_mcf.nii')))
+
+
+class StudyTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='test-qa-table-')
+        study = SyntheticStudy(self.data_dir, subjects=1, runs=2, shape=(10, 10, 8), volumes=20, trials=1)
+        study.create()
+        self.analyzer = QualityAnalyzer(study.fmri_data())
+        self.qa_dir = os.path.join(study.fmri_data().study_dir(), 'qa')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_failed_run_keeps_its_row(self):
+        table = self.analyzer.analyze_study(n_jobs=1, detrend_order=None)
+        self.assertEqual(len(table), 2)
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            # the csv fallback when there's no parquet engine
+            self.assertEqual(os.listdir(self.qa_dir), ['qa_metrics.csv'])
+
+        broken = self.analyzer.run_files(1)[1]
+        with open(broken['bold'], 'w') as fh:
+            fh.write('not a NIfTI file')
+
+        rerun = self.analyzer.analyze_study(n_jobs=1, detrend_order=None)
+        self.assertEqual(len(rerun), 2)
+        np.testing.assert_allclose(rerun['sfnr'], table['sfnr'])
+        # the kept row has its old key, so the run is analyzed again next time
+        self.assertEqual(list(rerun['input_key']), list(table['input_key']))
+        self.assertEqual(len(self.analyzer.load_study_table()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
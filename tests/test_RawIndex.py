@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RawIndex import RawIndex
+
+
+class RawIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='test-raw-')
+        self.raw_dir = os.path.join(self.temp_dir, 'raw')
+        self.subject_dir = 'RM_lab_AV_AzOr_20160124_1030'
+        for series_dir, files in [('localizer_0001', 3), ('t1_MPRAGE_0002', 176), ('ep2d_bold_0003', 10),
+                                  ('ep2d_bold_0004', 10), ('ep2d_bold_0005', 6)]:
+            series_path = os.path.join(self.raw_dir, self.subject_dir, series_dir)
+            os.makedirs(series_path)
+            for index in range(files):
+                open(os.path.join(series_path, '{:04d}.dcm'.format(index)), 'w').close()
+
+        self.index_file = os.path.join(self.temp_dir, 'raw_index.json')
+        self.index = RawIndex(self.raw_dir, self.index_file, n_jobs=2)
+        self.index.refresh()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_series(self):
+        self.assertEqual(self.index.subject_names(), ['AzOr'])
+        raw_series = self.index.raw_series('AzOr')
+        self.assertEqual(os.path.basename(raw_series['anatomical']), 't1_MPRAGE_0002')
+        self.assertEqual([os.path.basename(path) for path in raw_series['functional']],
+                         ['ep2d_bold_0003', 'ep2d_bold_0004', 'ep2d_bold_0005'])
+
+    def test_matched_on_the_header(self):
+        # a series is matched on its description / protocol, whatever its directory is called
+        series = self.index._index[self.subject_dir]['series']
+        series['series_0007'] = dict(series['ep2d_bold_0003'], description='fMRI_run4', protocol='ep2d_bold_TR2')
+        series['ep2d_bold_0004']['description'] = 'ep2d_bold_moco'
+        series['ep2d_bold_0004']['protocol'] = 'MoCoSeries'
+
+        functional = [os.path.basename(path) for path, entry in self.index.series('AzOr', 'functional')]
+        self.assertEqual(functional, ['ep2d_bold_0003', 'ep2d_bold_0004', 'ep2d_bold_0005', 'series_0007'])
+
+        series['ep2d_bold_0005'].update(description='localizer', protocol='localizer')
+        functional = [os.path.basename(path) for path, entry in self.index.series('AzOr', 'functional')]
+        self.assertNotIn('ep2d_bold_0005', functional)
+
+    def test_truncated_run(self):
+        problems = self.index.check('AzOr', ['task001_run001', 'task001_run002', 'task001_run003'])
+        self.assertEqual(len(problems), 1)
+        self.assertIn('ep2d_bold_0005 has 6 files', problems[0])
+
+    def test_saved_index(self):
+        with open(self.index_file, 'r') as fh:
+            saved = json.load(fh)
+        self.assertEqual(saved[self.subject_dir]['series']['ep2d_bold_0003']['description'], 'ep2d_bold')
+        self.assertFalse([name for name in os.listdir(self.temp_dir) if name.startswith('.tmp-')])
+
+        reloaded = RawIndex(self.raw_dir, self.index_file)
+        self.assertEqual(reloaded.raw_series('AzOr'), self.index.raw_series('AzOr'))
+
+
+if __name__ == '__main__':
+    unittest.main()
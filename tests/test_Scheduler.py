@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Scheduler import SubjectScheduler, SubjectsFailed, RunPool
+
+
+class Subject(object):
+
+    def __init__(self, subcode):
+        self._subcode = subcode
+
+    def subcode(self):
+        return self._subcode
+
+
+class Preprocessing(object):
+
+    def analyze_subject(self, subject, fail=()):
+        if subject.subcode() in fail:
+            raise RuntimeError("sub{:0>3} failed".format(subject.subcode()))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_all_succeed(self):
+        results = SubjectScheduler(1).run(Preprocessing(), [Subject(1), Subject(2)], dict())
+        self.assertEqual(list(results), [1, 2])
+        self.assertTrue(all(result.success for result in results.values()))
+
+    def test_failed_subject_is_raised_after_the_others(self):
+        with self.assertRaises(SubjectsFailed) as raised:
+            SubjectScheduler(1).run(Preprocessing(), [Subject(1), Subject(2), Subject(3)], {'fail': (2,)})
+
+        results = raised.exception.results
+        self.assertEqual([result.success for result in results.values()], [True, False, True])
+        self.assertIn('sub002 failed', results[2].error)
+        self.assertIn('sub002', str(raised.exception))
+
+    def test_failed_run_is_raised_after_the_others(self):
+        done = []
+
+        def process(directory):
+            done.append(directory)
+            if directory == 'task001_run001':
+                raise RuntimeError("no output")
+
+        directories = ['task001_run001', 'task001_run002']
+        self.assertRaises(Exception, RunPool(2, memory_limit=1).map, process, directories, directories)
+        self.assertEqual(sorted(done), directories)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SliceTiming import SliceTimer, shift_series
+
+
+class ShiftSeriesTest(unittest.TestCase):
+
+    def test_fractional_shift_of_a_sinusoid(self):
+        # cos(pi k (n + 1/2) / N) is symmetric about both ends of the run, so its mirrored series is an exact
+        # period and the phase ramp shifts it without edge effects
+        volumes = 40
+        n = np.arange(volumes, dtype=np.float64)[:, np.newaxis]
+        k = np.array([1, 3, 7])
+        data = np.cos(np.pi * k * (n + 0.5) / volumes)
+
+        for shift in [0.3, -0.45, 1.25]:
+            expected = np.cos(np.pi * k * (n + 0.5 + shift) / volumes)
+            np.testing.assert_allclose(shift_series(data, shift), expected, atol=1e-5)
+
+    def test_no_shift(self):
+        data = np.random.RandomState(0).normal(size=(25, 4))
+        np.testing.assert_allclose(shift_series(data, 0), data, atol=1e-5)
+
+
+class SliceTimesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp(prefix='test-stc-')
+        self.bold_file = os.path.join(self.run_dir, 'bold_mask_mcf_hp.nii.gz')
+        self.img = nibabel.Nifti1Image(np.ones((4, 4, 4, 10), dtype=np.float32), np.eye(4))
+        self.img.header.set_zooms((3.0, 3.0, 3.0, 2.0))
+        self.img.header.set_xyzt_units('mm', 'sec')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def save(self):
+        nibabel.save(self.img, self.bold_file)
+
+    def test_sidecar_of_the_run(self):
+        times = [0.0, 1.0, 0.5, 1.5]
+        with open(os.path.join(self.run_dir, 'bold.json'), 'w') as fh:
+            json.dump({'SliceTiming': times}, fh)
+        self.save()
+
+        found, tr, slice_axis, source = SliceTimer().slice_times(self.bold_file)
+        self.assertEqual(source, 'sidecar')
+        self.assertEqual((tr, slice_axis), (2.0, 2))
+        np.testing.assert_allclose(found, times)
+
+    def test_given_sidecar(self):
+        sidecar = os.path.join(self.run_dir, 'other.json')
+        with open(sidecar, 'w') as fh:
+            json.dump({'SliceTiming': [1.5, 1.0, 0.5, 0.0]}, fh)
+        self.save()
+
+        found, _, _, source = SliceTimer().slice_times(self.bold_file, sidecar=sidecar)
+        self.assertEqual(source, 'sidecar')
+        np.testing.assert_allclose(found, [1.5, 1.0, 0.5, 0.0])
+
+    def test_header_in_msec(self):
+        self.img.header.set_zooms((3.0, 3.0, 3.0, 2000.0))
+        self.img.header.set_xyzt_units('mm', 'msec')
+        self.img.header.set_dim_info(slice=2)
+        self.img.header['slice_code'] = 1  # sequential increasing
+        self.img.header['slice_duration'] = 500.0
+        self.img.header['slice_end'] = 3
+        self.save()
+
+        found, tr, _, source = SliceTimer().slice_times(self.bold_file)
+        self.assertEqual(source, 'header')
+        self.assertEqual(tr, 2.0)
+        np.testing.assert_allclose(found, [0.0, 0.5, 1.0, 1.5])
+
+    def test_default_interleaved(self):
+        self.save()
+        found, _, _, source = SliceTimer().slice_times(self.bold_file)
+        self.assertEqual(source, 'interleaved')
+        np.testing.assert_allclose(found, [0.0, 1.0, 0.5, 1.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
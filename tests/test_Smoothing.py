@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import nibabel
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Smoothing import GaussianSmoother, fwhm_to_sigma
+
+
+class SmoothingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = rng.normal(100, 10, (9, 8, 7, 5)).astype(np.float32)
+        self.voxel_size = (2.0, 2.0, 3.0)
+        self.sigma = fwhm_to_sigma(6.0, self.voxel_size)
+        self.brain_mask = np.zeros((9, 8, 7), dtype=bool)
+        self.brain_mask[2:7, 2:6, 1:6] = True
+
+    def test_fwhm_to_sigma(self):
+        # fwhm = 2 * sqrt(2 ln 2) * sigma = 2.3548 * sigma
+        np.testing.assert_allclose(fwhm_to_sigma(2.3548200450309493, [1.0, 0.5, 2.0]), [1.0, 2.0, 0.5])
+        np.testing.assert_allclose(self.sigma, [6.0 / 2.35482 / 2, 6.0 / 2.35482 / 2, 6.0 / 2.35482 / 3], rtol=1e-5)
+
+    def test_smooth(self):
+        expected = np.stack([ndimage.gaussian_filter(self.data[..., t], self.sigma, mode='nearest')
+                             for t in range(5)], axis=-1)
+        smoothed = GaussianSmoother(6.0, n_jobs=2, batch_size=2).smooth(self.data.copy(), self.voxel_size)
+        np.testing.assert_allclose(smoothed, expected, rtol=1e-5)
+
+    def test_mask_normalized(self):
+        smoothed = GaussianSmoother(6.0, mask_normalized=True).smooth(self.data.copy(), self.voxel_size,
+                                                                      self.brain_mask)
+
+        weights = ndimage.gaussian_filter(self.brain_mask.astype(np.float64), self.sigma, mode='constant')
+        for t in range(5):
+            masked = np.where(self.brain_mask, self.data[..., t], 0).astype(np.float64)
+            expected = ndimage.gaussian_filter(masked, self.sigma, mode='constant')[self.brain_mask] / \
+                weights[self.brain_mask]
+            np.testing.assert_allclose(smoothed[..., t][self.brain_mask], expected, rtol=1e-4)
+        self.assertFalse(smoothed[~self.brain_mask].any())
+
+    def test_mask_normalized_keeps_a_constant(self):
+        # the weights of the in-mask neighbours add up to 1, so nothing leaks from outside of the mask
+        data = np.where(self.brain_mask, 50, 1000).astype(np.float32)
+        smoothed = GaussianSmoother(6.0, mask_normalized=True).smooth(data, self.voxel_size, self.brain_mask)
+        np.testing.assert_allclose(smoothed[self.brain_mask], 50, rtol=1e-5)
+
+    def test_smooth_image(self):
+        temp_dir = tempfile.mkdtemp(prefix='test-smooth-')
+        try:
+            img = nibabel.Nifti1Image(self.data, np.eye(4))
+            img.header.set_zooms(self.voxel_size + (2.0,))
+            in_file, out_file = os.path.join(temp_dir, 'bold.nii.gz'), os.path.join(temp_dir, 'bold_smooth.nii.gz')
+            nibabel.save(img, in_file)
+
+            GaussianSmoother(6.0).smooth_image(in_file, out_file)
+            expected = GaussianSmoother(6.0).smooth(self.data.copy(), self.voxel_size)
+            np.testing.assert_allclose(nibabel.load(out_file).get_data(), expected, rtol=1e-6)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StageCache import StageCache
+
+
+class StageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='test-cache-')
+        self.bold = self.write('bold.nii', 'raw data')
+        self.mask = self.write('mask.nii', 'mask data')
+        self.output = self.write('bold_mask.nii', 'masked data')
+        self.params = {'frac': 0.5}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as fh:
+            fh.write(content)
+        return path
+
+    def record(self, cache=None):
+        (cache or StageCache()).record(self.output, 'mask', [self.bold, self.mask], self.params)
+
+    def is_current(self, params=None, inputs=None, cache=None):
+        return (cache or StageCache()).is_current(self.output, 'mask', inputs or [self.bold, self.mask],
+                                                  params or self.params)
+
+    def test_hit(self):
+        self.record()
+        self.assertTrue(self.is_current())
+
+    def test_missing_output(self):
+        self.record()
+        os.remove(self.output)
+        self.assertFalse(self.is_current())
+
+    def test_changed_input(self):
+        self.record()
+        time.sleep(0.01)
+        self.write('bold.nii', 'other raw data')
+        self.assertFalse(self.is_current())
+
+    def test_changed_params(self):
+        self.record()
+        self.assertFalse(self.is_current(params={'frac': 0.3}))
+
+    def test_modified_output(self):
+        self.record()
+        self.write('bold_mask.nii', 'edited')
+        self.assertFalse(self.is_current())
+
+    def test_swapped_inputs(self):
+        # the same content hashes in other roles are another stage run
+        self.write('mask.nii', 'raw data')
+        self.write('bold.nii', 'mask data')
+        cache = StageCache()
+        self.assertNotEqual(cache.key('mask', [self.bold, self.mask], self.params),
+                            cache.key('mask', [self.mask, self.bold], self.params))
+
+    def test_downstream_key_changes_with_upstream(self):
+        self.record()
+        downstream = self.write('bold_mask_mcf.nii', 'motion corrected')
+        StageCache().record(downstream, 'mcf', [self.output], dict())
+        self.assertTrue(StageCache().is_current(downstream, 'mcf', [self.output], dict()))
+
+        self.params = {'frac': 0.3}
+        self.write('bold_mask.nii', 'masked again')
+        self.record()
+        self.assertFalse(StageCache().is_current(downstream, 'mcf', [self.output], dict()))
+
+    def test_no_sidecar_next_to_raw_inputs(self):
+        self.record()
+        self.assertEqual(sorted(name for name in os.listdir(self.temp_dir) if name.endswith(StageCache.SIDECAR_EXT)),
+                         ['bold_mask.nii' + StageCache.SIDECAR_EXT])
+
+    def test_recorded_input_hashes_are_reused(self):
+        self.record()
+        cache = StageCache()
+        cache.__content_hash__ = lambda path: self.fail("{} was hashed again".format(path))
+        self.assertTrue(self.is_current(cache=cache))
+
+    def test_legacy_output(self):
+        self.assertFalse(self.is_current())
+        self.assertFalse(os.path.exists(StageCache().sidecar(self.output)))
+
+        self.assertTrue(self.is_current(cache=StageCache(adopt_legacy=True)))
+        self.assertTrue(self.is_current())
+        self.assertFalse(self.is_current(params={'frac': 0.3}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SubjectDir import SubjectDir
+
+
+class ReingestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='test-subject-')
+        self.path = os.path.join(self.temp_dir, 'sub001')
+        self.task_order = ['task001_run001', 'task001_run002']
+
+        raw_dir = os.path.join(self.temp_dir, 'raw')
+        self.raw_series = {'anatomical': os.path.join(raw_dir, 't1_MPRAGE_2'),
+                           'functional': [os.path.join(raw_dir, 'ep2d_bold_{}'.format(run)) for run in [3, 4]]}
+        for series in [self.raw_series['anatomical']] + self.raw_series['functional']:
+            os.makedirs(series)
+            for index in range(3):
+                with open(os.path.join(series, '{:04d}.dcm'.format(index)), 'w') as fh:
+                    fh.write(series)
+
+        # a subject converted before the fingerprints were kept
+        for directory in ['anatomy', 'model', 'masks', 'behav'] + [os.path.join('BOLD', run) for run in self.task_order]:
+            os.makedirs(os.path.join(self.path, directory))
+        self.outputs = [os.path.join(self.path, 'anatomy', 'highres001.nii.gz')] + \
+                       [os.path.join(self.path, 'BOLD', run, 'bold.nii.gz') for run in self.task_order]
+        for output in self.outputs:
+            with open(output, 'w') as fh:
+                fh.write('converted')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def subject(self):
+        return SubjectDir(1, self.path, os.path.dirname(self.raw_series['anatomical']), self.task_order,
+                          reingest=True, raw_series=self.raw_series)
+
+    def test_existing_outputs_are_adopted(self):
+        # dcm2nii isn't called: the existing outputs are adopted instead of converted again
+        self.subject()
+
+        with open(os.path.join(self.path, '.raw_fingerprints.json'), 'r') as fh:
+            fingerprints = json.load(fh)
+        self.assertEqual(sorted(fingerprints), sorted(os.path.relpath(output, self.path) for output in self.outputs))
+        self.assertEqual(fingerprints['BOLD/task001_run002/bold.nii.gz']['source'], 'ep2d_bold_4')
+        for output in self.outputs:
+            with open(output, 'r') as fh:
+                self.assertEqual(fh.read(), 'converted')
+
+        self.assertFalse([name for name in os.listdir(self.path) if name.startswith('.tmp-')])
+
+    def test_changed_series_is_converted(self):
+        self.subject()
+        with open(os.path.join(self.raw_series['functional'][1], '0003.dcm'), 'w') as fh:
+            fh.write('a new slice')
+
+        # the conversion itself needs dcm2nii, the converted series are recorded instead
+        converted = []
+        original = SubjectDir.__dict__['__dcm_convert__']
+        SubjectDir.__dcm_convert__ = lambda self, source, *args: converted.append(source) or 0.0
+        try:
+            self.subject()
+        finally:
+            SubjectDir.__dcm_convert__ = original
+
+        self.assertEqual(converted, [self.raw_series['functional'][1]])
+
+
+if __name__ == '__main__':
+    unittest.main()